@@ -159,6 +159,27 @@ def test_get_metrics_ArgumentParser_xrfi_run():
     # try to set something
     args = a.parse_args(['--sig_adj', '3.0'])
     assert args.sig_adj == 3.0
+    assert not args.single_pass
+    args = a.parse_args(['--single_pass'])
+    assert args.single_pass
+    assert a.parse_args(['--n_threads', '4']).n_threads == 4
+    assert a.parse_args(['--packed_flags']).packed_flags
+    assert args.n_workers is None
+    assert args.executor == 'thread'
+    args = a.parse_args(['--n_workers', '4', '--executor', 'process'])
+    assert args.n_workers == 4
+    assert args.executor == 'process'
+    assert a.parse_args([]).prefetch
+    assert not a.parse_args(['--no_prefetch']).prefetch
+    assert a.parse_args(['--verbose']).verbose
+    assert a.parse_args([]).data_chunk_size is None
+    assert a.parse_args(['--data_chunk_size', '50']).data_chunk_size == 50
+    assert not a.parse_args([]).container
+    assert a.parse_args(['--container']).container
+    assert a.parse_args([]).validate == 'all'
+    assert a.parse_args(['--validate', 'io']).validate == 'io'
+    assert not a.parse_args([]).profile
+    assert a.parse_args(['--profile']).profile
 
 
 def test_get_metrics_ArgumentParser_day_threshold_run():
@@ -166,6 +187,19 @@ def test_get_metrics_ArgumentParser_day_threshold_run():
     # First try defaults - test a few of them
     args = a.parse_args(['fooey'])
     assert args.nsig_f_adj == 3.0
+    assert args.n_threads is None
+    assert a.parse_args(['fooey', '--n_threads', '4']).n_threads == 4
+    assert args.prefetch
+    assert not args.verbose
+    args = a.parse_args(['fooey', '--no_prefetch', '--verbose'])
+    assert not args.prefetch
+    assert args.verbose
+    assert not args.container
+    assert a.parse_args(['fooey', '--container']).container
+    assert args.validate == 'all'
+    assert a.parse_args(['fooey', '--validate', 'none']).validate == 'none'
+    assert not args.profile
+    assert a.parse_args(['fooey', '--profile']).profile
     assert args.nsig_f == 7.0
     assert args.data_files == ['fooey']
     # try to set something
@@ -4,14 +4,21 @@
 import pytest
 import os
 import shutil
+import warnings
+import time
+import threading
+import pickle
+from functools import partial
 import hera_qm.xrfi as xrfi
 import numpy as np
+import h5py
 import pyuvdata.tests as uvtest
 from pyuvdata import UVData
 from pyuvdata import UVCal
 import hera_qm.utils as utils
 from hera_qm.data import DATA_PATH
 from pyuvdata import UVFlag
+from pyuvdata import utils as uvutils
 
 
 test_d_file = os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvcAA')
@@ -50,6 +57,29 @@ def test_uvflag():
     assert np.all(uvf.flag_array[uvf.ant_2_array == xant, :, :, :])
 
 
+def test_flag_xants_several():
+    uv = UVData()
+    uv.read_miriad(test_d_file)
+    uvc = UVCal()
+    uvc.read_calfits(test_c_file)
+    for uvo in [uv, UVFlag(uv, mode='flag'), uvc, UVFlag(uvc, mode='flag')]:
+        uvo.flag_array[:] = False
+        if isinstance(uvo, UVCal) or (isinstance(uvo, UVFlag) and uvo.type == 'antenna'):
+            ants = uvo.ant_array[:2]
+            flagged = np.isin(uvo.ant_array, ants)
+        else:
+            ants = uvo.get_ants()[:2] if isinstance(uvo, UVData) else uvo.ant_1_array[:2]
+            flagged = (uvo.ant_1_array == ants[0]) | (uvo.ant_2_array == ants[0])
+            flagged |= (uvo.ant_1_array == ants[1]) | (uvo.ant_2_array == ants[1])
+        for xants in [list(ants), tuple(ants), set(ants), np.array(ants)]:
+            uvf = xrfi.flag_xants(uvo, xants, inplace=False)
+            assert np.all(uvf.flag_array[flagged])
+            assert not np.any(uvf.flag_array[~flagged])
+        xrfi.flag_xants(uvo, set(ants))
+        assert np.all(uvo.flag_array[flagged])
+        assert not np.any(uvo.flag_array[~flagged])
+
+
 def test_input_error():
     pytest.raises(ValueError, xrfi.flag_xants, 4, 0)
 
@@ -165,6 +195,10 @@ def test_robus_divide():
     b = np.array([2., 0., 1e-9], dtype=np.float32)
     c = xrfi.robust_divide(a, b)
     assert np.array_equal(c, np.array([1. / 2., np.inf, np.inf]))
+    out = np.zeros(3, dtype=np.float32)
+    c = xrfi.robust_divide(a, b, out=out)
+    assert c is out
+    assert np.array_equal(c, np.array([1. / 2., np.inf, np.inf]))
 
 
 @pytest.fixture(scope='function')
@@ -190,7 +224,7 @@ def test_medmin(fake_data):
     assert np.allclose(medmin, fake_data.shape[0] - 1)
 
     # Test error when wrong dimensions are passed
-    pytest.raises(ValueError, xrfi.medmin, np.ones((5, 4, 3)))
+    pytest.raises(ValueError, xrfi.medmin, np.ones((5, 4, 3, 2)))
 
 
 def test_medminfilt(fake_data):
@@ -212,6 +246,19 @@ def test_medminfilt(fake_data):
     assert np.allclose(d_filt, ans)
 
 
+def test_medminfilt_random():
+    # compare to medmin evaluated directly on every (truncated) box
+    np.random.seed(182)
+    data = np.random.randn(20, 30)
+    for Kt, Kf in [(3, 4), (8, 8), (2, 20)]:
+        ans = np.zeros_like(data)
+        for i in range(data.shape[0]):
+            for j in range(data.shape[1]):
+                box = data[max(0, i - Kt):i + Kt, max(0, j - Kf):j + Kf]
+                ans[i, j] = xrfi.medmin(box)
+        assert np.allclose(xrfi.medminfilt(data, Kt=Kt, Kf=Kf), ans)
+
+
 def test_detrend_deriv(fake_data):
     # make fake data
     for i in range(fake_data.shape[0]):
@@ -242,7 +289,7 @@ def test_detrend_deriv(fake_data):
     pytest.raises(ValueError, xrfi.detrend_deriv, fake_data, dt=False, df=False)
 
     # Test error when wrong dimensions are passed
-    pytest.raises(ValueError, xrfi.detrend_deriv, np.ones((5, 4, 3)))
+    pytest.raises(ValueError, xrfi.detrend_deriv, np.ones((5, 4, 3, 2)))
 
 
 def test_detrend_medminfilt(fake_data):
@@ -296,9 +343,196 @@ def test_detrend_medfilt(fake_data):
     assert np.allclose(ans, dm)
 
 
-def test_detrend_medfilt_3d_error():
+def test_detrend_medfilt_4d_error():
     # Test error when wrong dimensions are passed
-    pytest.raises(ValueError, xrfi.detrend_medfilt, np.ones((5, 4, 3)))
+    pytest.raises(ValueError, xrfi.detrend_medfilt, np.ones((5, 4, 3, 2)))
+
+
+@pytest.mark.parametrize('algorithm,kwargs',
+                         [('medmin', {}), ('medminfilt', {'Kt': 2, 'Kf': 3}),
+                          ('detrend_deriv', {}), ('detrend_medminfilt', {'Kt': 2, 'Kf': 3}),
+                          ('detrend_medfilt', {'Kt': 3, 'Kf': 4}),
+                          ('detrend_medfilt', {'Kt': 3, 'Kf': 4, 'backend': 'running'}),
+                          ('detrend_masked_medfilt', {'Kt': 3, 'Kf': 4}),
+                          ('detrend_meanfilt', {'Kt': 3, 'Kf': 4}),
+                          ('zscore_full_array', {}), ('zscore_full_array', {'modified': True})])
+def test_algorithm_stack(algorithm, kwargs):
+    # A stack of waterfalls gives the same result as each waterfall on its own
+    np.random.seed(182)
+    data = np.abs(np.random.randn(4, 12, 15)) + np.arange(15)
+    flags = np.zeros(data.shape, dtype=np.bool)
+    flags[1, 5, 7] = True
+    alg_func = xrfi.algorithm_dict[algorithm]
+    out = alg_func(data, flags=flags, **kwargs)
+    for wf, fwf, out_wf in zip(data, flags, out):
+        assert np.allclose(alg_func(wf, flags=fwf, **kwargs), out_wf)
+
+
+def test_modzscore_1d_stack():
+    np.random.seed(182)
+    data = np.random.randn(3, 200)
+    data[1, 50] = 500
+    for detrend in [True, False]:
+        out = xrfi.modzscore_1d(data, detrend=detrend)
+        assert out.shape == data.shape
+        for d, o in zip(data, out):
+            assert np.allclose(xrfi.modzscore_1d(d, detrend=detrend), o)
+    pytest.raises(ValueError, xrfi.modzscore_1d, np.ones((3, 4, 5)))
+
+
+def test_running_medfilt2d():
+    from scipy.signal import medfilt2d
+    np.random.seed(182)
+    data = np.random.randn(40, 50)
+    for kernel_size in [(3, 3), (17, 17), (5, 21), (81, 101)]:
+        assert np.array_equal(xrfi._running_medfilt2d(data, kernel_size),
+                              medfilt2d(data, kernel_size=kernel_size))
+    # Repeated values and several row blocks
+    data = np.round(data)
+    assert np.array_equal(xrfi._running_medfilt2d(data, (5, 7), block_rows=8),
+                          medfilt2d(data, kernel_size=(5, 7)))
+    pytest.raises(ValueError, xrfi._running_medfilt2d, data, (4, 5))
+    # Stacks are filtered in one sweep
+    data = np.random.randn(3, 20, 30)
+    assert np.array_equal(xrfi._running_medfilt2d(data, (5, 7)),
+                          [medfilt2d(d, kernel_size=(5, 7)) for d in data])
+
+
+def test_running_medfilt2d_valid():
+    np.random.seed(182)
+    data = np.round(np.random.randn(2, 20, 30), 1)
+    valid = np.random.rand(*data.shape) > 0.3
+    valid[1, 5:12, 5:12] = False
+    d_sm = xrfi._running_medfilt2d(data, (5, 7), block_rows=7, valid=valid)
+    # compare with the nanmedian of each window, padding with invalid samples
+    padded = np.pad(np.where(valid, data, np.nan), ((0, 0), (2, 2), (3, 3)),
+                    mode='constant', constant_values=np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for k in range(2):
+            for i in range(20):
+                for j in range(30):
+                    assert np.array_equal(d_sm[k, i, j],
+                                          np.nanmedian(padded[k, i:i + 5, j:j + 7]),
+                                          equal_nan=True)
+    assert np.all(np.isnan(d_sm[1, 7:10, 8:9]))
+
+
+def test_detrend_medfilt_running_backend():
+    np.random.seed(182)
+    data = np.random.randn(50, 80)
+    for Kt, Kf in [(8, 8), (2, 16)]:
+        dm = xrfi.detrend_medfilt(data, Kt=Kt, Kf=Kf)
+        dm_run = xrfi.detrend_medfilt(data, Kt=Kt, Kf=Kf, backend='running')
+        assert np.array_equal(dm, dm_run)
+    data = data + 1j * np.random.randn(50, 80)
+    dm = xrfi.detrend_medfilt(data, Kt=8, Kf=8)
+    dm_run = xrfi.detrend_medfilt(data, Kt=8, Kf=8, backend='running')
+    assert np.array_equal(dm, dm_run)
+    pytest.raises(ValueError, xrfi.detrend_medfilt, data, backend='foo')
+
+
+def test_median_detrend_complex():
+    # real and imaginary parts smoothed together match smoothing each on its own
+    from scipy.signal import medfilt2d
+    np.random.seed(182)
+    data = np.random.randn(2, 30, 40) + 1j * np.random.randn(2, 30, 40)
+    for backend in ['scipy', 'running']:
+        d_rs, sig = xrfi._median_detrend(data, (5, 7), backend=backend)
+        for d, r, s in zip(data, d_rs, sig):
+            d_sm = medfilt2d(d.real, (5, 7)) + 1j * medfilt2d(d.imag, (5, 7))
+            assert np.array_equal(r, d - d_sm)
+            assert np.array_equal(s, np.sqrt(medfilt2d(np.abs(d - d_sm)**2, (5, 7)) / .456))
+    # real data are never promoted to complex
+    out = xrfi.modzscore_1d(data[0].real)
+    assert not np.iscomplexobj(out)
+    assert np.allclose(out, xrfi.modzscore_1d(data[0].real + 0j).real)
+
+
+def test_detrend_masked_medfilt():
+    np.random.seed(182)
+    data = np.random.randn(50, 60) + .1 * np.arange(60)
+    # without flags, only the edges differ from detrend_medfilt
+    dm = xrfi.detrend_masked_medfilt(data, Kt=4, Kf=4)
+    assert np.array_equal(dm[8:-8, 8:-8], xrfi.detrend_medfilt(data, Kt=4, Kf=4)[8:-8, 8:-8])
+    # flagged values do not affect the unflagged metric
+    flags = np.zeros(data.shape, dtype=np.bool)
+    flags[25, :] = True
+    data[25, :] = 10000.
+    dm1 = xrfi.detrend_masked_medfilt(data, flags=flags, Kt=4, Kf=4)
+    data[25, :] = 0.
+    dm2 = xrfi.detrend_masked_medfilt(data, flags=flags, Kt=4, Kf=4)
+    assert np.allclose(dm1[~flags], dm2[~flags])
+    # and the flagged spike stands out
+    data[25, :] = 10000.
+    assert np.all(dm1[25] > 100)
+    # a fully flagged region gives infinite metrics
+    flags[:, 20:40] = True
+    dm = xrfi.detrend_masked_medfilt(data, flags=flags, Kt=4, Kf=4)
+    assert np.all(np.isinf(dm[:, 25:35]))
+    # complex data
+    data = data + 1j * np.random.randn(50, 60)
+    dm = xrfi.detrend_masked_medfilt(data, flags=flags, Kt=4, Kf=4)
+    assert dm.dtype == data.dtype
+    pytest.raises(ValueError, xrfi.detrend_masked_medfilt, np.ones((5, 4, 3, 2)))
+
+
+@pytest.mark.parametrize('algorithm,kwargs',
+                         [('detrend_medfilt', {}), ('detrend_medfilt', {'backend': 'running'}),
+                          ('detrend_masked_medfilt', {}), ('detrend_meanfilt', {}),
+                          ('detrend_meanfilt', {'backend': 'sat'})])
+def test_detrend_n_threads(algorithm, kwargs):
+    # Tiles processed in threads are stitched back to the serial result
+    np.random.seed(182)
+    data = np.random.randn(2, 45, 70) + np.arange(70)
+    data[0, 3, 4] = np.nan
+    flags = np.random.rand(*data.shape) < 0.1
+    alg_func = xrfi.algorithm_dict[algorithm]
+    # the cumulative sums of the sat backend start at different pixels in each tile
+    compare = np.allclose if kwargs.get('backend') == 'sat' else np.array_equal
+    for Kt, Kf in [(2, 3), (1, 1)]:
+        serial = alg_func(data, flags=flags, Kt=Kt, Kf=Kf, **kwargs)
+        for n_threads in [2, 3, 8]:
+            threaded = alg_func(data, flags=flags, Kt=Kt, Kf=Kf, n_threads=n_threads, **kwargs)
+            assert compare(serial, threaded, equal_nan=True)
+        assert compare(alg_func(data[1], flags=flags[1], Kt=Kt, Kf=Kf, **kwargs),
+                       alg_func(data[1], flags=flags[1], Kt=Kt, Kf=Kf, n_threads=4, **kwargs))
+
+
+@pytest.mark.parametrize('algorithm,kwargs',
+                         [('detrend_medfilt', {}), ('detrend_medfilt', {'backend': 'running'}),
+                          ('detrend_masked_medfilt', {}), ('detrend_meanfilt', {}),
+                          ('detrend_meanfilt', {'backend': 'sat'})])
+def test_detrend_workspace(algorithm, kwargs):
+    np.random.seed(182)
+    data = np.random.randn(2, 30, 40) + np.arange(40)
+    data[0, 3, 4] = np.nan
+    flags = np.random.rand(*data.shape) < 0.1
+    alg_func = xrfi.algorithm_dict[algorithm]
+    ws = xrfi.Workspace()
+    for d in [data, data[0], data + 1j * data[::-1], data, data[0]]:
+        f = flags[:d.shape[0]] if d.ndim == 3 else flags[0]
+        ans = alg_func(d, flags=f, Kt=2, Kf=3, **kwargs)
+        metric = alg_func(d, flags=f, Kt=2, Kf=3, workspace=ws, **kwargs)
+        assert np.array_equal(metric, ans, equal_nan=True)
+        assert metric.dtype == ans.dtype
+        out = np.zeros_like(ans)
+        metric = alg_func(d, flags=f, Kt=2, Kf=3, workspace=ws, out=out, **kwargs)
+        assert metric is out
+        assert np.array_equal(out, ans, equal_nan=True)
+    # buffers are only reallocated when the shape or type changes
+    nallocs = ws.n_allocations
+    for i in range(3):
+        alg_func(data[0], flags=flags[0], Kt=2, Kf=3, workspace=ws, **kwargs)
+    assert ws.n_allocations == nallocs
+    assert ws.n_requests > nallocs
+    ws.clear()
+    alg_func(data[0], flags=flags[0], Kt=2, Kf=3, workspace=ws, **kwargs)
+    assert ws.n_allocations > nallocs
+    # tiles do not use the workspace, but the result is written to out
+    out = np.zeros_like(data)
+    alg_func(data, flags=flags, Kt=2, Kf=3, workspace=ws, out=out, n_threads=2, **kwargs)
+    assert np.allclose(out, alg_func(data, flags=flags, Kt=2, Kf=3, **kwargs), equal_nan=True)
 
 
 def test_detrend_meanfilt(fake_data):
@@ -337,6 +571,55 @@ def test_detrend_meanfilt_flags(fake_data):
     assert np.allclose(dm1, dm2)
 
 
+def test_detrend_meanfilt_sat_backend():
+    np.random.seed(182)
+    data = np.random.randn(3, 40, 60) + np.linspace(0, 5, 60)
+    data[:, 2, 3] = np.nan
+    flags = np.random.rand(*data.shape) < 0.2
+    # a block with no valid entries
+    flags[:, 10:30, 20:45] = True
+    for Kt, Kf in [(1, 1), (3, 8), (8, 3)]:
+        for f in [None, flags]:
+            # stacks and single waterfalls
+            dm = xrfi.detrend_meanfilt(data, flags=f, Kt=Kt, Kf=Kf)
+            dm_sat = xrfi.detrend_meanfilt(data, flags=f, Kt=Kt, Kf=Kf, backend='sat')
+            assert np.allclose(dm, dm_sat, equal_nan=True)
+            f0 = None if f is None else f[0]
+            dm_sat = xrfi.detrend_meanfilt(data[0], flags=f0, Kt=Kt, Kf=Kf, backend='sat')
+            assert np.allclose(dm[0], dm_sat, equal_nan=True)
+    data = data[0] + 1j * np.random.randn(40, 60)
+    dm = xrfi.detrend_meanfilt(data, flags=flags[0], Kt=3, Kf=3)
+    dm_sat = xrfi.detrend_meanfilt(data, flags=flags[0], Kt=3, Kf=3, backend='sat')
+    assert np.allclose(dm, dm_sat, equal_nan=True)
+    pytest.raises(ValueError, xrfi.detrend_meanfilt, data, backend='foo')
+
+
+def test_box_sum():
+    np.random.seed(182)
+    data = np.random.randn(2, 30, 40)
+    data[0, 5, 7] = np.inf
+    data[0, 6, 9] = -np.inf
+    data[1, 20, 30] = np.inf
+    data[1, 12, 3] = np.nan
+    Kt, Kf = 2, 3
+    out = xrfi._box_sum(data, Kt, Kf)
+    ans = np.zeros_like(out)
+    for i in range(out.shape[1]):
+        for j in range(out.shape[2]):
+            ans[:, i, j] = np.sum(data[:, i:i + 2 * Kt + 1, j:j + 2 * Kf + 1], axis=(1, 2))
+    # non-finite values only affect the boxes holding them
+    assert np.array_equal(np.isnan(out), np.isnan(ans))
+    assert np.array_equal(out[np.isinf(ans)], ans[np.isinf(ans)])
+    assert np.allclose(out[np.isfinite(ans)], ans[np.isfinite(ans)])
+    assert np.sum(np.isfinite(out)) > out.size // 2
+    # single precision input is summed in double precision
+    data32 = (np.random.randn(40, 40) + 1e4).astype(np.float32)
+    out = xrfi._box_sum(data32, Kt, Kf)
+    assert out.dtype == np.float32
+    assert np.allclose(out[-1, -1], np.sum(data32[-2 * Kt - 1:, -2 * Kf - 1:], dtype=np.float64),
+                       rtol=1e-6, atol=0)
+
+
 def test_zscore_full_array(fake_data):
     # Make some fake data
     np.random.seed(182)
@@ -393,6 +676,48 @@ def test_modzscore_1d_no_detrend():
     assert np.isclose(np.median(np.abs(out)), .67, rtol=.1)
 
 
+def test_modzscore_1d_flags():
+    np.random.seed(182)
+    data = np.random.randn(3, 200)
+    flags = np.zeros_like(data, dtype=bool)
+    for detrend in [True, False]:
+        # no flags is the same as not passing any
+        assert np.array_equal(xrfi.modzscore_1d(data, flags=flags, detrend=detrend),
+                              xrfi.modzscore_1d(data, detrend=detrend))
+    flags[:, 20:60] = True
+    data2 = data.copy()
+    data2[flags] = 1000.
+    for detrend in [True, False]:
+        out = xrfi.modzscore_1d(data2, flags=flags, detrend=detrend)
+        # flagged samples don't bias the statistics of the others, but get zscores
+        assert np.all(np.abs(out[~flags]) < 10)
+        assert np.all(out[flags] > 100)
+        for d, f, o in zip(data2, flags, out):
+            assert np.allclose(xrfi.modzscore_1d(d, flags=f, detrend=detrend), o)
+
+
+def test_nanmedian():
+    np.random.seed(182)
+    for shape in [(50, 30), (7, 700)]:
+        data = np.random.randn(*shape)
+        assert np.array_equal(xrfi._nanmedian(data), np.median(data, axis=1))
+        data[np.random.rand(*shape) < .2] = np.nan
+        data[2] = np.nan
+        ans = np.nanmedian(data, axis=1)
+        assert np.array_equal(xrfi._nanmedian(data), ans, equal_nan=True)
+        assert np.array_equal(xrfi._nanmedian(data, n_threads=3), ans, equal_nan=True)
+    # nans in a few channels (one partition) and in a different number of samples
+    # in each row (np.nanmedian)
+    data = np.random.randn(100, 200)
+    data[:, 10:20] = np.nan
+    assert np.array_equal(xrfi._nanmedian(data), np.nanmedian(data, axis=1))
+    data[np.arange(200)[None, :] < np.arange(100)[:, None]] = np.nan
+    data[-1] = np.nan
+    ans = np.nanmedian(data, axis=1)
+    assert np.array_equal(xrfi._nanmedian(data), ans, equal_nan=True)
+    assert np.array_equal(xrfi._nanmedian(data, n_threads=3), ans, equal_nan=True)
+
+
 def test_modzscore_1d():
     npix = 1000
     np.random.seed(182)
@@ -612,6 +937,221 @@ def test_ws_flag_waterfall():
     pytest.raises(ValueError, xrfi._ws_flag_waterfall, d3, f3)
 
 
+def test_ws_flag_waterfall_dense():
+    # compare to growing the flags one neighbor at a time until they converge
+    from scipy.signal import convolve
+    np.random.seed(21)
+    for shape, kernel in [((500,), [1, 0, 1]), ((60, 80), [[0, 1, 0], [1, 0, 1], [0, 1, 0]])]:
+        metric = 3 * np.random.randn(*shape)
+        metric[..., 10:30] += 3
+        metric[np.random.rand(*shape) < .01] = np.nan
+        fin = np.random.rand(*shape) < .01
+        fout = fin.copy()
+        while True:
+            nflags = np.sum(fout)
+            fout |= convolve(fout, kernel, mode='same').astype(bool) & (metric >= 2.)
+            if np.sum(fout) == nflags:
+                break
+        assert np.array_equal(xrfi._ws_flag_waterfall(metric, fin, nsig=2.), fout)
+
+
+def test_ws_flag_stack():
+    np.random.seed(21)
+    metric = 3 * np.random.randn(2, 3, 20, 30)
+    fin = np.random.rand(*metric.shape) < .02
+    fout = xrfi._ws_flag_stack(metric, fin, nsig=2.)
+    for i in range(2):
+        for j in range(3):
+            assert np.array_equal(fout[i, j], xrfi._ws_flag_waterfall(metric[i, j], fin[i, j]))
+    # waterfalls along other axes, in either order
+    fout2 = xrfi._ws_flag_stack(metric.transpose(3, 0, 2, 1), fin.transpose(3, 0, 2, 1),
+                                nsig=2., axes=(0, 2))
+    assert np.array_equal(fout2, fout.transpose(3, 0, 2, 1))
+
+
+def test_collapse_marginals():
+    np.random.seed(21)
+    arr = np.random.randn(30, 1, 8, 2) + 1j * np.random.randn(30, 1, 8, 2)
+    arr[4, 0, 3, 1] = np.inf
+    weights = np.random.rand(30, 1, 8, 2)
+    groups = np.random.randint(0, 5, 30)
+    weights[groups == 2] = 0
+    weights[:, :, 6] = 0
+    flags = np.random.rand(30, 1, 8, 2) < .5
+    flags[groups == 1] = True
+    for avg_method in ['mean', 'absmean', 'quadmean']:
+        ans_t = [uvutils.collapse(arr[groups == g], avg_method, weights=weights[groups == g])
+                 for g in range(6)]
+        ans_f = uvutils.collapse(arr, avg_method, weights=weights, axis=(0, 1, 3))
+        for chunk_size in [None, 7]:
+            out_f, out_t, unflagged = xrfi._collapse_marginals(
+                arr, avg_method, 2, time_inv=groups, ntimes=6, weights=weights, flags=flags,
+                chunk_size=chunk_size)
+            # times and channels without weight are infinite
+            assert np.array_equal(np.isinf(out_t), [False, False, True, False, False, True])
+            assert np.allclose(out_t[[0, 1, 3, 4]], np.array(ans_t)[[0, 1, 3, 4]])
+            assert np.array_equal(np.isinf(out_f), np.isinf(ans_f))
+            assert np.allclose(out_f[np.isfinite(ans_f)], ans_f[np.isfinite(ans_f)])
+            for g in range(6):
+                assert np.array_equal(unflagged[g], np.any(~flags[groups == g], axis=(0, 1, 3)))
+    # time along another axis
+    out_f, out_t, unflagged = xrfi._collapse_marginals(arr.real, 'mean', 1, time_axis=2)
+    assert unflagged is None
+    assert np.allclose(out_f, uvutils.collapse(arr.real, 'mean', axis=(0, 2, 3)))
+    assert np.allclose(out_t, uvutils.collapse(arr.real, 'mean', axis=(0, 1, 3)))
+    # other methods are collapsed by pyuvdata
+    barr = arr.real > 1
+    for avg_method in ['or', 'and']:
+        out_f, out_t, unflagged = xrfi._collapse_marginals(barr, avg_method, 2, time_inv=groups,
+                                                           ntimes=6, flags=flags)
+        assert np.array_equal(out_f, uvutils.collapse(barr, avg_method, axis=(0, 1, 3)))
+        for g in range(6):
+            assert out_t[g] == uvutils.collapse(barr[groups == g], avg_method)
+            assert np.array_equal(unflagged[g], np.any(~flags[groups == g], axis=(0, 1, 3)))
+    pytest.raises(ValueError, xrfi._collapse_marginals, arr, 'or', 2)
+    pytest.raises(ValueError, xrfi._collapse_marginals, arr, 'foo', 2)
+
+
+def test_baseline_groups():
+    baseline_array = np.array([5, 3, 5, 3, 7, 5, 3, 7, 9])
+    groups = xrfi._baseline_groups(baseline_array)
+    assert len(groups) == 3
+    np.testing.assert_array_equal(groups[0], [[8]])
+    np.testing.assert_array_equal(groups[1], [[4, 7]])
+    np.testing.assert_array_equal(groups[2], [[1, 3, 6], [0, 2, 5]])
+
+
+def test_packed_flags():
+    np.random.seed(21)
+    for shape in [(3, 5), (10, 1, 64, 2), (130,)]:
+        f1 = np.random.rand(*shape) < .3
+        p1 = xrfi.PackedFlags(f1)
+        assert np.array_equal(p1.unpack(), f1)
+        assert p1.packed.nbytes == np.packbits(f1).nbytes
+        p2 = xrfi.PackedFlags.from_packed(p1.packed, shape)
+        assert p2.shape == shape
+        assert np.array_equal(p2.unpack(), f1)
+    pytest.raises(ValueError, xrfi.PackedFlags.from_packed, np.zeros(3, dtype=np.uint8), (4, 7))
+
+
+def test_flag_expression():
+    uv = UVData()
+    uv.read_miriad(test_d_file)
+    np.random.seed(21)
+    uvfs = []
+    for i in range(3):
+        uvf = UVFlag(uv, mode='flag', waterfall=True, history='flags {}'.format(i))
+        uvf.flag_array = np.random.rand(*uvf.flag_array.shape) < .1
+        uvfs.append(uvf)
+    ans = uvfs[0] | uvfs[1] | uvfs[2]
+    expr = xrfi.FlagExpression(uvfs[0]) | uvfs[1]
+    expr |= xrfi.FlagExpression(uvfs[2])
+    assert len(expr.operands) == 3
+    out = expr.evaluate()
+    assert out == ans
+    assert out.history == ans.history
+    # the operands are unchanged
+    assert not np.array_equal(uvfs[0].flag_array, out.flag_array)
+
+    # catch errors
+    pytest.raises(ValueError, xrfi.FlagExpression, 5)
+    pytest.raises(ValueError, xrfi.FlagExpression().evaluate)
+    uvf = UVFlag(uv, mode='flag')
+    pytest.raises(ValueError, xrfi.FlagExpression(uvfs[0], uvf).evaluate)
+    uvf = UVFlag(uv, waterfall=True)
+    pytest.raises(ValueError, xrfi.FlagExpression(uvfs[0], uvf).evaluate)
+    # the operands must have the same type and metadata
+    uvf = UVFlag(uv, mode='flag')
+    pytest.raises(ValueError, xrfi.FlagExpression(uvf, uvfs[0]).evaluate)
+    for param in ['time_array', 'freq_array', 'polarization_array']:
+        uvf = uvfs[1].copy()
+        setattr(uvf, param, getattr(uvf, param) + 1)
+        pytest.raises(ValueError, xrfi.FlagExpression(uvfs[0], uvf).evaluate)
+    uvf = uvfs[1].copy()
+    uvf.flag_array = uvf.flag_array[:, :10]
+    pytest.raises(ValueError, xrfi.FlagExpression(uvfs[0], uvf).evaluate)
+
+
+def test_write_read_flags():
+    uv = UVData()
+    uv.read_miriad(test_d_file)
+    uvf = UVFlag(uv, mode='flag')
+    np.random.seed(21)
+    uvf.flag_array = np.random.rand(*uvf.flag_array.shape) < .3
+    flag_array = uvf.flag_array
+    for packed in [False, True]:
+        xrfi.write_flags(uvf, test_outfile, clobber=True, packed=packed)
+        assert uvf.flag_array is flag_array
+        uvf2 = xrfi.read_flags(test_outfile)
+        assert uvf2 == uvf
+        assert np.array_equal(uvf2.flag_array, uvf.flag_array)
+    # lists of files are combined in time
+    uvf2 = xrfi.read_flags([test_outfile, test_outfile], run_check=False)
+    assert np.array_equal(uvf2.flag_array, np.concatenate([uvf.flag_array] * 2))
+    # metrics are written as usual
+    uvm = UVFlag(uv)
+    xrfi.write_flags(uvm, test_outfile, clobber=True, packed=True)
+    assert xrfi.read_flags(test_outfile) == uvm
+    # packed flag files are marked, and only read_flags reads them
+    xrfi.write_flags(uvf, test_outfile, clobber=True, packed=True)
+    with h5py.File(test_outfile, 'r') as f:
+        assert f.attrs['flag_format'] == 'packed'
+    pytest.raises(ValueError, UVFlag, test_outfile)
+    with h5py.File(test_outfile, 'a') as f:
+        del f['Data/packed_flag_array']
+    pytest.raises(ValueError, xrfi.read_flags, test_outfile)
+    os.remove(test_outfile)
+
+
+def test_flags_container(tmpdir):
+    uv = UVData()
+    uv.read_miriad(test_d_file)
+    np.random.seed(21)
+    uvf = UVFlag(uv, mode='flag')
+    uvf.flag_array = np.random.rand(*uvf.flag_array.shape) < .3
+    uvm = UVFlag(uv, waterfall=True, label='metrics')
+    uvm.metric_array = np.random.rand(*uvm.metric_array.shape)
+    uvw = UVFlag(uv, mode='flag', waterfall=True, history='other history')
+    uvw.flag_array[1] = True
+    products = {'flags': uvf, 'metrics': uvm, 'waterfall': uvw}
+    container = os.path.join(tmpdir.strpath, 'test.xrfi.h5')
+    for packed in [False, True]:
+        for asynchronous in [False, True]:
+            with xrfi.FlagsContainerWriter(container, clobber=True, packed=packed,
+                                           asynchronous=asynchronous) as writer:
+                for product, obj in products.items():
+                    writer.write(product, obj)
+            for product, obj in products.items():
+                uvf2 = xrfi.read_flags(container, product=product)
+                assert uvf2 == obj
+                assert uvf2.history == obj.history
+                assert uvf2.label == obj.label
+            # the metadata the products share are stored once
+            with h5py.File(container, 'r') as f:
+                headers = [f['Products'][product]['Header'] for product in products]
+                assert headers[1]['freq_array'] == headers[2]['freq_array']
+                assert headers[1]['type'] == headers[2]['type']
+                assert headers[0]['type'] != headers[1]['type']
+    # lists of containers are combined in time
+    uvf2 = xrfi.read_flags([container, container], product='waterfall', run_check=False)
+    assert np.array_equal(uvf2.flag_array, np.concatenate([uvw.flag_array] * 2))
+    # flags are applied from containers
+    uv2 = uv.copy()
+    xrfi.flag_apply(container, uv2, keep_existing=False, product='flags')
+    assert np.array_equal(uv2.flag_array, uvf.flag_array)
+
+    # catch errors
+    pytest.raises(ValueError, xrfi.FlagsContainerWriter, container)
+    pytest.raises(ValueError, xrfi.read_flags, container)
+    pytest.raises(ValueError, xrfi.read_flags, container, product='foo')
+    xrfi.write_flags(uvw, test_outfile, clobber=True)
+    pytest.raises(ValueError, xrfi.read_flags, test_outfile, product='flags')
+    os.remove(test_outfile)
+    with xrfi.FlagsContainerWriter(container, clobber=True) as writer:
+        writer.write('flags', uvf)
+        pytest.raises(ValueError, writer.write, 'flags', uvw)
+
+
 def test_xrfi_waterfall():
     # test basic functions
     np.random.seed(21)
@@ -652,6 +1192,87 @@ def test_xrfi_waterfall_error():
         xrfi.xrfi_waterfall(data, algorithm='not_an_algorithm')
 
 
+@pytest.mark.parametrize("algorithm", ['detrend_medfilt', 'detrend_masked_medfilt',
+                                       'detrend_meanfilt'])
+def test_streaming_detrender(algorithm):
+    np.random.seed(21)
+    data = np.abs(np.random.randn(60, 50)) + np.linspace(1, 3, 50)
+    data[20:24, 10:14] += 30
+    data[40, :] += 2.5
+    prior_flags = np.zeros(data.shape, dtype=bool)
+    prior_flags[:, ::17] = True
+    for flags in [None, prior_flags]:
+        sd = xrfi.StreamingDetrender(Kt=2, Kf=3, algorithm=algorithm)
+        metrics, new_flags = [], []
+        # integrations arrive one or a few at a time
+        for t0, t1 in [(0, 1), (1, 2), (2, 7), (7, 8), (8, 30), (30, 31), (31, 60)]:
+            m, f = sd.add_integrations(data[t0:t1], None if flags is None else flags[t0:t1])
+            assert sd.n_metric == max(t1 - 4, 0)
+            assert sd.n_flags <= sd.n_metric
+            assert sd._data.shape[0] <= 9
+            metrics.append(m)
+            new_flags.append(f)
+        m, f = sd.finalize()
+        metrics.append(m)
+        new_flags.append(f)
+        assert np.array_equal(np.concatenate(metrics),
+                              xrfi.algorithm_dict[algorithm](data, flags=flags, Kt=2, Kf=3),
+                              equal_nan=True)
+        assert np.array_equal(np.concatenate(new_flags),
+                              xrfi.xrfi_waterfall(data, flags=flags, Kt=2, Kf=3,
+                                                  algorithm=algorithm))
+        assert sd.n_in == 0
+
+
+def test_streaming_detrender_short_file():
+    np.random.seed(21)
+    data = np.abs(np.random.randn(5, 20))
+    sd = xrfi.StreamingDetrender(Kt=8, Kf=8)
+    m, f = sd.add_integrations(data)
+    assert m.shape == (0, 20)
+    assert f.shape == (0, 20)
+    with uvtest.check_warnings(UserWarning, match='K1 value 8 is larger than the data'):
+        m, f = sd.finalize()
+    assert np.array_equal(m, xrfi.detrend_medfilt(data, Kt=5, Kf=8))
+    assert f.shape == (5, 20)
+    m, f = sd.finalize()
+    assert m.shape == (0, 0)
+
+
+def test_streaming_detrender_max_flag_lag():
+    np.random.seed(21)
+    data = .1 * np.random.randn(100, 20)
+    # a channel above nsig_adj in places, connected to a seed late in the file
+    data[:, 10] = .35
+    data[90, 10] = 100
+    batch_flags = xrfi.xrfi_waterfall(data, Kt=2, Kf=2)
+    assert np.sum(batch_flags) == 8
+    for max_flag_lag in [None, 1]:
+        sd = xrfi.StreamingDetrender(Kt=2, Kf=2, max_flag_lag=max_flag_lag)
+        new_flags = []
+        for t in range(100):
+            new_flags.append(sd.add_integrations(data[t])[1])
+            if max_flag_lag is not None:
+                assert sd._metric.shape[0] <= max_flag_lag
+        new_flags.append(sd.finalize()[1])
+        new_flags = np.concatenate(new_flags)
+        if max_flag_lag is None:
+            assert np.array_equal(new_flags, batch_flags)
+        else:
+            # rows returned before the seed arrived miss its watershed
+            assert np.all(batch_flags[new_flags])
+            assert np.sum(new_flags) < np.sum(batch_flags)
+
+
+def test_streaming_detrender_errors():
+    pytest.raises(ValueError, xrfi.StreamingDetrender, algorithm='detrend_deriv')
+    pytest.raises(ValueError, xrfi.StreamingDetrender, Kt=0)
+    sd = xrfi.StreamingDetrender()
+    sd.add_integrations(np.ones(10))
+    pytest.raises(ValueError, sd.add_integrations, np.ones(11))
+    pytest.raises(ValueError, sd.add_integrations, np.ones(10), np.zeros(11, dtype=bool))
+
+
 def test_flag():
     # setup
     uv = UVData()
@@ -731,6 +1352,17 @@ def test_flag():
     flag_array[:2, :, :] = True
     assert np.allclose(uvf.flag_array, flag_array)
 
+    # methods the single pass collapse does not implement are left to pyuvdata
+    uvm.metric_array = np.zeros(uvm.metric_array.shape, dtype=bool)
+    uvm.metric_array[:, 0, :] = True
+    uvf = xrfi.flag(uvm, nsig_p=6., nsig_f=.5, avg_method='or', run_check=False)
+    flag_array = np.zeros_like(uvf.flag_array, dtype=np.bool)
+    flag_array[:, 0, :] = True
+    assert np.array_equal(uvf.flag_array, flag_array)
+    uvf = xrfi.watershed_flag(uvm, uvf, nsig_p=6., nsig_t=.5, avg_method='and',
+                              inplace=False, run_check=False)
+    assert np.array_equal(uvf.flag_array, flag_array)
+
     # catch errors
     pytest.raises(ValueError, xrfi.flag, 2)
     uvm.type = 'blah'
@@ -773,6 +1405,47 @@ def test_flag_apply():
     assert np.allclose(uv.flag_array[:, :, 0, :], True)
     assert np.allclose(uv.flag_array[:, :, 1:, :], False)
 
+    # several waterfalls are combined before broadcasting to baselines
+    uv.flag_array[:] = False
+    uvf2 = UVFlag(uv, mode='flag', waterfall=True)
+    uvf2.flag_array[1, 5, :] = True
+    net_flags = xrfi.flag_apply([uvf, uvf2], uv, return_net_flags=True)
+    assert net_flags.type == 'baseline'
+    assert np.array_equal(net_flags.flag_array, uv.flag_array)
+    assert np.all(uv.flag_array[:, :, 0, :])
+    assert np.array_equal(uv.flag_array[:, 0, 5, 0], uv.time_array == np.unique(uv.time_array)[1])
+    assert np.sum(uv.flag_array) == uv.Nblts + uv.Nbls
+    # mismatched frequencies or polarizations
+    uvf2.freq_array = uvf2.freq_array + 1e6
+    pytest.raises(ValueError, xrfi.flag_apply, uvf2, uv)
+    uvf2 = UVFlag(uv, mode='flag', waterfall=True)
+    uvf2.polarization_array[:] = -6
+    pytest.raises(ValueError, xrfi.flag_apply, uvf2, uv)
+    # mismatched telescope, antennas or channels, as UVFlag.to_baseline checks
+    for param, change in [('telescope_location', lambda x: x + 100.),
+                          ('antenna_names', lambda x: x[::-1]),
+                          ('antenna_positions', lambda x: x + 1.),
+                          ('channel_width', lambda x: 2 * x)]:
+        uvf2 = UVFlag(uv, mode='flag', waterfall=True)
+        setattr(uvf2, param, change(np.asarray(getattr(uvf2, param))))
+        pytest.raises(ValueError, xrfi.flag_apply, uvf2, uv)
+    # but antennas that are only sorted differently match
+    uvf2 = UVFlag(uv, mode='flag', waterfall=True)
+    for param in ['antenna_names', 'antenna_numbers', 'antenna_positions']:
+        setattr(uvf2, param, np.asarray(getattr(uvf2, param))[::-1])
+    xrfi.flag_apply(uvf2, uv)
+    # times that uv does not have
+    uvf2.time_array = uvf2.time_array + 1.
+    pytest.raises(ValueError, xrfi.flag_apply, uvf2, uv)
+
+    # and from files with packed flags
+    uv.flag_array[:] = False
+    xrfi.write_flags(uvf, test_outfile, clobber=True, packed=True)
+    xrfi.flag_apply(test_outfile, uv)
+    assert np.allclose(uv.flag_array[:, :, 0, :], True)
+    assert np.allclose(uv.flag_array[:, :, 1:, :], False)
+    os.remove(test_outfile)
+
     uv = UVCal()
     uv.read_calfits(test_c_file)
     uv.flag_array = np.zeros_like(uv.flag_array, dtype=np.bool)
@@ -781,6 +1454,10 @@ def test_flag_apply():
     xrfi.flag_apply(uvf, uv)
     assert np.allclose(uv.flag_array[:, :, 0, :, :], True)
     assert np.allclose(uv.flag_array[:, :, 1:, :, :], False)
+    # the times must be those of uv
+    uvf2 = uvf.copy()
+    uvf2.time_array = uvf2.time_array + 1.
+    pytest.raises(ValueError, xrfi.flag_apply, uvf2, uv)
 
     # catch errors
     pytest.raises(ValueError, xrfi.flag_apply, uvf, 2)
@@ -802,6 +1479,10 @@ def test_calculate_metric_vis():
     filtered = xrfi.detrend_medfilt(np.abs(wf), Kt=3)
     assert np.allclose(filtered, uvf.metric_array[inds, 0, :, 0])
 
+    # Batches of baselines give the same result
+    uvf2 = xrfi.calculate_metric(uv, 'detrend_medfilt', batch_size=5, Kt=3)
+    assert np.allclose(uvf.metric_array, uvf2.metric_array)
+
 
 def test_calculate_metric_gains():
     # Cal gains version
@@ -814,6 +1495,39 @@ def test_calculate_metric_gains():
     filtered = xrfi.detrend_medfilt(np.abs(wf), Kt=3, Kf=3)
     assert np.allclose(filtered, uvf.metric_array[0, 0, :, :, 0])
 
+    # Batches of antennas give the same result
+    uvf2 = xrfi.calculate_metric(uvc, 'detrend_medfilt', batch_size=3, Kt=3, Kf=3)
+    assert np.allclose(uvf.metric_array, uvf2.metric_array)
+
+
+def test_calculate_metric_gains_layout():
+    # The median detrenders give the same metrics on the native (Nfreqs, Ntimes)
+    # waterfalls of a UVCal object as on transposed ones, and the mean filter
+    # the same to within rounding.
+    uvc = UVCal()
+    uvc.read_calfits(test_c_file)
+    np.random.seed(19)
+    uvc.flag_array = np.random.rand(*uvc.flag_array.shape) < .1
+    # (Nants, Nfreqs, Ntimes, Njones) -> (Nants * Njones, Ntimes, Nfreqs)
+    shape = (-1, uvc.Ntimes, uvc.Nfreqs)
+    data = np.abs(uvc.gain_array[:, 0]).transpose(0, 3, 2, 1).reshape(shape)
+    flags = uvc.flag_array[:, 0].transpose(0, 3, 2, 1).reshape(shape)
+    for algorithm in ['detrend_medfilt', 'detrend_masked_medfilt', 'detrend_meanfilt']:
+        alg_func = xrfi.algorithm_dict[algorithm]
+        uvf = xrfi.calculate_metric(uvc, algorithm, Kt=3, Kf=5)
+        transposed = alg_func(data, flags=flags, Kt=3, Kf=5)
+        transposed = transposed.reshape(uvc.Nants_data, uvc.Njones, uvc.Ntimes, uvc.Nfreqs)
+        transposed = transposed.transpose(0, 3, 2, 1)
+        native = alg_func(np.ascontiguousarray(np.swapaxes(data, 1, 2)),
+                          flags=np.ascontiguousarray(np.swapaxes(flags, 1, 2)), Kt=5, Kf=3)
+        native = np.moveaxis(native.reshape(uvc.Nants_data, uvc.Njones, uvc.Nfreqs,
+                                            uvc.Ntimes), 1, -1)
+        assert np.array_equal(uvf.metric_array[:, 0], transposed)
+        if algorithm == 'detrend_meanfilt':
+            assert np.allclose(native, transposed)
+        else:
+            assert np.array_equal(native, transposed)
+
 
 def test_calculate_metric_chisq():
     # Cal chisq version
@@ -885,6 +1599,284 @@ def test_xrfi_h1c_idr2_2_pipe():
     assert len(uvf_m.polarization_array) == 1
     assert uvf_m.weights_array.max() == 1.
 
+    uvf_m2, uvf_f2 = xrfi.xrfi_pipe(uvc, Kt=3, n_threads=2)
+    assert np.array_equal(uvf_m.metric_array, uvf_m2.metric_array)
+    assert np.array_equal(uvf_f.flag_array, uvf_f2.flag_array)
+
+
+@pytest.mark.parametrize('alg', ['detrend_medfilt', 'detrend_meanfilt', 'detrend_masked_medfilt'])
+def test_xrfi_pipe_float32(alg):
+    # Single precision metrics agree with double precision ones to much better
+    # than the flagging thresholds, so the flags only differ for pixels within
+    # rounding of a threshold. On the test files they do not differ at all.
+    uv = UVData()
+    uv.read_miriad(test_d_file)
+    uvc = UVCal()
+    uvc.read_calfits(test_c_file)
+    for obj in [uv, uvc]:
+        uvf_m, uvf_f = xrfi.xrfi_pipe(obj.copy(), alg=alg, Kt=3)
+        uvf_m32, uvf_f32 = xrfi.xrfi_pipe(obj.copy(), alg=alg, Kt=3, dtype=np.float32)
+        assert uvf_m32.metric_array.dtype == np.float32
+        assert uvf_m32.weights_array.dtype == np.float32
+        finite = np.isfinite(uvf_m.metric_array)
+        assert np.array_equal(finite, np.isfinite(uvf_m32.metric_array))
+        assert np.allclose(uvf_m.metric_array[finite], uvf_m32.metric_array[finite],
+                           rtol=1e-3, atol=1e-2)
+        assert np.array_equal(uvf_f.flag_array, uvf_f32.flag_array)
+
+
+def test_chi_sq_pipe_float32():
+    uvc = UVCal()
+    uvc.read_calfits(test_c_file)
+    uvf_m, uvf_f = xrfi.chi_sq_pipe(uvc.copy())
+    uvf_m32, uvf_f32 = xrfi.chi_sq_pipe(uvc.copy(), dtype=np.float32)
+    assert uvf_m32.metric_array.dtype == np.float32
+    assert np.allclose(uvf_m.metric_array, uvf_m32.metric_array, rtol=1e-3, atol=1e-2)
+    assert np.array_equal(uvf_f.flag_array, uvf_f32.flag_array)
+    uvf_f, uvf_wf = xrfi.xrfi_h1c_pipe(uvc.copy(), Kt=3)
+    uvf_f32, uvf_wf32 = xrfi.xrfi_h1c_pipe(uvc.copy(), Kt=3, dtype=np.float32)
+    assert np.array_equal(uvf_f.flag_array, uvf_f32.flag_array)
+    assert np.array_equal(uvf_wf.flag_array, uvf_wf32.flag_array)
+
+
+@pytest.mark.parametrize('ant_str', [None, 'cross'])
+def test_xrfi_pipe_chunked(ant_str):
+    uv = UVData()
+    uv.read(test_uvh5_file, ant_str=ant_str)
+    uvf_init = UVFlag(uv, mode='flag', waterfall=True)
+    uvf_init.flag_array[1, 50:60] = True
+    xrfi.flag_apply(uvf_init, uv, force_pol=True)
+    uvf_m, uvf_f = xrfi.xrfi_pipe(uv, alg='detrend_meanfilt', Kt=3, label='Data.')
+    for chunk_size in [50, uv.Nbls]:
+        uvf_mc, uvf_fc = xrfi.xrfi_pipe_chunked(test_uvh5_file, uvf_flags=uvf_init,
+                                                chunk_size=chunk_size, ant_str=ant_str,
+                                                alg='detrend_meanfilt', Kt=3, label='Data.')
+        assert uvf_mc == uvf_m
+        assert np.allclose(uvf_mc.metric_array, uvf_m.metric_array, rtol=1e-10, atol=1e-10)
+        assert np.array_equal(uvf_fc.flag_array, uvf_f.flag_array)
+        assert uvf_fc.label == 'Data. Flags.'
+
+    # errors
+    pytest.raises(ValueError, xrfi._metric_waterfall_chunked, test_uvh5_file,
+                  'detrend_meanfilt', 0)
+    pytest.raises(ValueError, xrfi._metric_waterfall_chunked, test_uvh5_file,
+                  'detrend_meanfilt', 7, wf_method='or')
+    # only uvh5 files are read in chunks
+    pytest.raises(ValueError, xrfi._metric_waterfall_chunked, test_d_file,
+                  'detrend_meanfilt', 7)
+    pytest.raises(ValueError, xrfi.xrfi_run, test_c_file, test_c_file, test_uvh5_file,
+                  test_d_file, 'Just a test', data_chunk_size=50)
+
+
+def test_run_stages():
+    order = []
+
+    def stage(name):
+        def func(*args):
+            order.append(name)
+            return (name,) + args
+        return func
+
+    stages = [('a', stage('a'), []),
+              ('b', stage('b'), ['a']),
+              ('c', stage('c'), ['a'], ['b']),
+              ('d', stage('d'), ['c', 'b'])]
+    results = xrfi._run_stages(stages)
+    assert order == ['a', 'b', 'c', 'd']
+    assert results['a'] == ('a',)
+    assert results['c'] == ('c', ('a',))
+    assert results['d'] == ('d', results['c'], results['b'])
+    for n_workers in [1, 3]:
+        for prefetch in [False, True]:
+            order = []
+            timings = {}
+            assert xrfi._run_stages(stages, n_workers=n_workers, prefetch=prefetch,
+                                    timings=timings) == results
+            assert order.index('a') < order.index('b') < order.index('c') < order.index('d')
+            assert sorted(timings.keys()) == ['a', 'b', 'c', 'd']
+            assert all(run_time >= 0 and wait >= 0 for run_time, wait in timings.values())
+    # prefetched stages run while the others compute, and their wait is timed
+    read2_started = threading.Event()
+    compute_overlapped = []
+
+    def read2():
+        read2_started.set()
+
+    def compute(*args):
+        compute_overlapped.append(read2_started.wait(10))
+    stages = [('read1', partial(np.arange, 4), []),
+              ('read2', read2, []),
+              ('compute', compute, ['read1']),
+              ('use', lambda *args: None, ['compute', 'read2'])]
+    timings = {}
+    xrfi._run_stages(stages, prefetch=True, timings=timings)
+    assert compute_overlapped == [True]
+    # read1 only starts as compute is ready, so compute waits for it
+    assert timings['compute'][1] > 0
+    assert all(run_time >= 0 and wait >= 0 for run_time, wait in timings.values())
+    # inputs are read one stage ahead of the first stage that needs them
+    events = []
+
+    def log(name, *args):
+        events.append(name)
+        return name
+    stages = [('read1', partial(log, 'read1'), []),
+              ('read2', partial(log, 'read2'), []),
+              ('a', partial(log, 'a'), ['read1']),
+              ('b', partial(log, 'b'), ['a']),
+              ('c', partial(log, 'c'), ['b']),
+              ('d', partial(log, 'd'), ['c', 'read2'])]
+    for n_workers in [None, 2]:
+        del events[:]
+        results = xrfi._run_stages(stages, n_workers=n_workers, prefetch=True)
+        assert results['d'] == 'd'
+        assert sorted(events) == ['a', 'b', 'c', 'd', 'read1', 'read2']
+        assert events.index('b') < events.index('read2') < events.index('d')
+    # stages run in processes must be picklable
+    stages = [('a', partial(np.arange, 4), []),
+              ('b', partial(np.multiply, 2), ['a']),
+              ('c', np.add, ['a', 'b'])]
+    results = xrfi._run_stages(stages, n_workers=2, executor='process')
+    assert np.array_equal(results['c'], 3 * np.arange(4))
+
+    # errors
+    pytest.raises(ValueError, xrfi._run_stages, [('a', stage('a'), ['b'])])
+    pytest.raises(ValueError, xrfi._run_stages, [('a', stage('a'), []), ('b', stage('b'), [], ['c'])])
+    pytest.raises(ValueError, xrfi._run_stages, [('a', stage('a'), []), ('a', stage('a'), [])])
+    pytest.raises(ValueError, xrfi._run_stages, [('a', stage('a'), [])], executor='foo')
+
+    def fail():
+        raise RuntimeError('stage failed')
+    pytest.raises(RuntimeError, xrfi._run_stages, [('a', fail, []), ('b', stage('b'), ['a'])],
+                  n_workers=2)
+    # stages are recorded in the stats of a context
+    context = xrfi.PipelineContext(profile=True)
+    stages = [('a', partial(np.arange, 4), []),
+              ('b', partial(np.multiply, 2), ['a'])]
+    xrfi._run_stages(stages, context=context)
+    assert list(context.stats.keys()) == ['a', 'b']
+    assert all(stats[0] == 1 and stats[1] >= 0 for stats in context.stats.values())
+    context = xrfi.PipelineContext(profile=True)
+    xrfi._run_stages(stages, n_workers=2, executor='process', context=context)
+    assert sorted(context.stats.keys()) == ['a', 'b']
+
+
+def test_pipeline_context(monkeypatch):
+    pytest.raises(ValueError, xrfi.PipelineContext, validate='foo')
+    for validate, step, io in [('all', True, True), ('io', False, True), ('none', False, False)]:
+        context = xrfi.PipelineContext(validate=validate, check_extra=False)
+        assert context.step_checks() == {'run_check': step, 'check_extra': False,
+                                         'run_check_acceptability': True}
+        assert context.io_checks()['run_check'] == io
+
+    # count the checks made
+    checks = []
+    check = UVFlag.check
+
+    def counted_check(self, *args, **kwargs):
+        checks.append(self.mode)
+        return check(self, *args, **kwargs)
+    monkeypatch.setattr(UVFlag, 'check', counted_check)
+    uvc = UVCal()
+    uvc.read_calfits(test_c_file)
+    uvm = UVFlag(uvc, waterfall=True, mode='metric')
+    uvm.metric_array = np.zeros_like(uvm.metric_array)
+    uvm.metric_array[0, 0, 0] = 7.
+    uvf = xrfi.flag(uvm, nsig_p=6.)
+    assert len(checks) > 0
+    # the context overrides run_check
+    for validate in ['io', 'none']:
+        context = xrfi.PipelineContext(validate=validate)
+        checks = []
+        uvf2 = xrfi.flag(uvm, nsig_p=6., context=context, run_check=True)
+        assert uvf2 == uvf
+        assert checks == []
+        context.check_output(uvf2)
+        assert len(checks) == (1 if validate == 'io' else 0)
+    checks = []
+    xrfi.flag(uvm, nsig_p=6., context=xrfi.PipelineContext())
+    assert len(checks) > 0
+    # nothing is recorded unless profiling
+    context = xrfi.PipelineContext()
+    xrfi.flag(uvm, nsig_p=6., context=context)
+    assert context.stats == {}
+
+    # the pipeline functions are recorded as stages, within the stages they are called in
+    context = xrfi.PipelineContext(profile=True)
+    with context.stage('outer'):
+        xrfi.xrfi_pipe(uvc, alg='detrend_medfilt', Kt=2, Kf=2, context=context)
+        x = np.ones(2**20)
+    del x
+    # in the order the stages ended
+    assert list(context.stats.keys()) == ['flag', 'watershed_flag', 'xrfi_pipe', 'outer']
+    calls, seconds, peak = context.stats['outer']
+    assert calls == 1
+    assert seconds >= context.stats['xrfi_pipe'][1] >= context.stats['flag'][1]
+    # the array of 8 MB was traced
+    assert peak >= 8
+    with context.stage('outer'):
+        pass
+    assert context.stats['outer'][0] == 2
+    assert context.stats['outer'][1] >= seconds
+
+    # the policy and stats are pickled
+    context2 = pickle.loads(pickle.dumps(context))
+    assert context2.stats == context.stats
+    assert context2.validate == 'all' and context2.profile
+    with context2.stage('outer'):
+        pass
+    assert context2.stats['outer'][0] == 3
+
+
+def test_prefetch():
+    args = [(i,) for i in range(5)]
+    for prefetch in [False, True]:
+        waits = []
+        assert list(xrfi._prefetch(np.square, args, prefetch=prefetch,
+                                   waits=waits)) == [i ** 2 for i in range(5)]
+        assert len(waits) == 5
+    assert list(xrfi._prefetch(np.square, [])) == []
+    # the next call runs while the current result is used
+    started = [threading.Event() for _ in range(2)]
+    overlapped = [started[1].wait(10) for _ in xrfi._prefetch(lambda i: started[i].set(),
+                                                              [(0,), (1,)])]
+    assert overlapped == [True, True]
+
+
+def test_print_timings(capsys):
+    xrfi._print_timings({'read': (1., 0.), 'compute': (2., 0.5)})
+    out = capsys.readouterr().out.splitlines()
+    assert out == ['read: 1.00 s running, 0.00 s waiting for input files',
+                   'compute: 2.00 s running, 0.50 s waiting for input files',
+                   'Total: 3.00 s running, 0.50 s waiting for input files']
+
+
+def _write_xrfi_run_inputs(dirname):
+    """Write the input files of xrfi_run, with the cal files made consistent with the data."""
+    fake_obs = 'zen.2457698.40355.HH'
+    uv = UVData()
+    uv.read(test_uvh5_file)
+    uvc = UVCal()
+    uvc.read_calfits(test_c_file)
+    # the test cal file has a different telescope location and antennas than the data
+    for param in ['telescope_location', 'antenna_names', 'antenna_numbers',
+                  'antenna_positions', 'Nants_telescope']:
+        setattr(uvc, param, getattr(uv, param))
+    files = [os.path.join(dirname, fake_obs + ext)
+             for ext in ['.omni.calfits', '.abs.calfits', '.omni_vis.uvh5', '.uvh5']]
+    for filename in files[:2]:
+        uvc.write_calfits(filename)
+    for filename in files[2:]:
+        shutil.copyfile(test_uvh5_file, filename)
+    return files
+
+
+def _read_xrfi_run_outputs(dirname):
+    """Read the output files of xrfi_run, keyed by their names."""
+    outdir = os.path.join(dirname, 'zen.2457698.40355.xrfi')
+    return {filename: xrfi.read_flags(os.path.join(outdir, filename), run_check=False)
+            for filename in sorted(os.listdir(outdir))}
+
 
 def test_xrfi_run(tmpdir):
     # The warnings are because we use UVFlag.to_waterfall() on the total chisquareds
@@ -950,10 +1942,112 @@ def test_xrfi_run(tmpdir):
         assert os.path.exists(out)
         uvf = UVFlag(out)
         assert uvf.label == label
+
+    # write the same products to a single container file instead
+    for fname, infile in [(ocal_file, test_c_file), (acal_file, test_c_file),
+                          (model_file, test_uvh5_file), (raw_dfile, test_uvh5_file)]:
+        shutil.copyfile(infile, fname)
+    uvtest.checkWarnings(xrfi.xrfi_run, [ocal_file, acal_file, model_file,
+                                         raw_dfile, 'Just a test'],
+                         {'kt_size': 3, 'ant_str': 'cross', 'container': True,
+                          'n_workers': 2},
+                         nwarnings=len(messages), message=messages, category=categories)
+    container = os.path.join(outdir, fake_obs + '.xrfi.h5')
+    for ext, label in ext_labels.items():
+        uvf = xrfi.read_flags(container, product=ext)
+        assert uvf == UVFlag(os.path.join(outdir, '.'.join([fake_obs, ext, 'h5'])))
+        assert uvf.label == label
+    # the container exists
+    pytest.raises(ValueError, xrfi.xrfi_run, ocal_file, acal_file, model_file, raw_dfile,
+                  'Just a test', container=True)
+    shutil.rmtree(outdir)  # cleanup
+
+
+def test_xrfi_run_validate(tmpdir):
+    # the outputs are the same whichever objects are checked
+    outputs = {}
+    for validate in ['all', 'io', 'none']:
+        dirname = tmpdir.mkdir(validate).strpath
+        files = _write_xrfi_run_inputs(dirname)
+        context = xrfi.PipelineContext(validate=validate, profile=True)
+        xrfi.xrfi_run(*files, 'Just a test', kt_size=3, ant_str='cross', context=context)
+        outputs[validate] = _read_xrfi_run_outputs(dirname)
+        assert 'og1' in context.stats and 'flag' in context.stats
+    assert len(outputs['all']) == 33
+    for validate in ['io', 'none']:
+        assert outputs[validate] == outputs['all']
+    # the input files are read with the checks of the context
+    for validate, run_check in [('all', True), ('io', True), ('none', False)]:
+        stages = xrfi._input_stages(*files, context=xrfi.PipelineContext(validate=validate),
+                                    run_check=False)
+        readers = [stage[1] for stage in stages if stage[0] in ['uvc_a', 'uvc_o', 'uv_v', 'uv_d']]
+        assert len(readers) == 4
+        assert all(reader.keywords['run_check'] == run_check for reader in readers)
+
+
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_xrfi_run_workers(tmpdir, single_pass):
+    # the stages give the same outputs whether run serially, in threads or in processes
+    outputs = {}
+    for label, kwargs in [('serial', {'prefetch': False}),
+                          ('thread', {'n_workers': 3, 'executor': 'thread'}),
+                          ('process', {'n_workers': 2, 'executor': 'process'})]:
+        dirname = tmpdir.mkdir(label).strpath
+        files = _write_xrfi_run_inputs(dirname)
+        xrfi.xrfi_run(*files, 'Just a test', kt_size=3, ant_str='cross', ex_ants='9,10',
+                      single_pass=single_pass, run_check=False, **kwargs)
+        outputs[label] = _read_xrfi_run_outputs(dirname)
+    assert len(outputs['serial']) == (18 if single_pass else 33)
+    assert outputs['thread'] == outputs['serial']
+    assert outputs['process'] == outputs['serial']
+
+
+def test_xrfi_run_single_pass(tmpdir):
+    # The warnings are because we use UVFlag.to_waterfall() on the total chisquareds
+    mess1 = ['This object is already a waterfall']
+    messages = 3 * mess1
+    cat1 = [UserWarning]
+    categories = 3 * cat1
+    tmp_path = tmpdir.strpath
+    fake_obs = 'zen.2457698.40355.HH'
+    ocal_file = os.path.join(tmp_path, fake_obs + '.omni.calfits')
+    shutil.copyfile(test_c_file, ocal_file)
+    acal_file = os.path.join(tmp_path, fake_obs + '.abs.calfits')
+    shutil.copyfile(test_c_file, acal_file)
+    raw_dfile = os.path.join(tmp_path, fake_obs + '.uvh5')
+    shutil.copyfile(test_uvh5_file, raw_dfile)
+    model_file = os.path.join(tmp_path, fake_obs + '.omni_vis.uvh5')
+    shutil.copyfile(test_uvh5_file, model_file)
+    uvtest.checkWarnings(xrfi.xrfi_run, [ocal_file, acal_file, model_file,
+                                         raw_dfile, 'Just a test'],
+                         {'kt_size': 3, 'ant_str': 'cross', 'single_pass': True,
+                          'n_workers': 2, 'data_chunk_size': 50},
+                         nwarnings=len(messages), message=messages, category=categories)
+
+    outdir = os.path.join(tmp_path, 'zen.2457698.40355.xrfi')
+    ext_labels = {'apriori_flags': 'A priori flags.',
+                  'chi_sq_flags2': 'Renormalized chisq, single pass. Flags.',
+                  'chi_sq_renormed2': 'Renormalized chisq, single pass.',
+                  'combined_flags2': 'Flags from combined metrics, single pass.',
+                  'combined_metrics2': 'Combined metrics, single pass.',
+                  'flags2': 'ORd flags, single pass.'}
+    for ext, label in [('og', 'Omnical gains'), ('ox', 'Omnical chisq'),
+                       ('ag', 'Abscal gains'), ('ax', 'Abscal chisq'),
+                       ('v', 'Omnical visibility solutions'), ('data', 'Data')]:
+        ext_labels[ext + '_metrics2'] = label + ', single pass.'
+        ext_labels[ext + '_flags2'] = label + ', single pass. Flags.'
+    for ext, label in ext_labels.items():
+        out = os.path.join(outdir, '.'.join([fake_obs, ext, 'h5']))
+        assert os.path.exists(out)
+        uvf = UVFlag(out)
+        assert uvf.label == label
+    # no first round
+    assert not os.path.exists(os.path.join(outdir, '.'.join([fake_obs, 'flags1', 'h5'])))
     shutil.rmtree(outdir)  # cleanup
 
 
-def test_day_threshold_run(tmpdir):
+@pytest.mark.parametrize('container', [False, True])
+def test_day_threshold_run(tmpdir, container):
     # The warnings are because we use UVFlag.to_waterfall() on the total chisquareds
     # This doesn't hurt anything, and lets us streamline the pipe
     mess1 = ['This object is already a waterfall']
@@ -974,7 +2068,8 @@ def test_day_threshold_run(tmpdir):
     model_file = os.path.join(tmp_path, fake_obses[0] + '.omni_vis.uvh5')
     shutil.copyfile(test_uvh5_file, model_file)
     uvtest.checkWarnings(xrfi.xrfi_run, [ocal_file, acal_file, model_file,
-                                         raw_dfile, 'Just a test'], {'kt_size': 3},
+                                         raw_dfile, 'Just a test'],
+                         {'kt_size': 3, 'container': container},
                          nwarnings=len(messages), message=messages, category=categories)
     # Need to adjust time arrays when duplicating files
     uvd = UVData()
@@ -995,10 +2090,11 @@ def test_day_threshold_run(tmpdir):
     acal_file = os.path.join(tmp_path, fake_obses[1] + '.abs.calfits')
     uvc.write_calfits(acal_file)
     uvtest.checkWarnings(xrfi.xrfi_run, [ocal_file, acal_file, model_file,
-                                         data_files[1], 'Just a test'], {'kt_size': 3},
+                                         data_files[1], 'Just a test'],
+                         {'kt_size': 3, 'container': container},
                          nwarnings=len(messages), message=messages, category=categories)
 
-    xrfi.day_threshold_run(data_files, 'just a test')
+    xrfi.day_threshold_run(data_files, 'just a test', container=container)
     types = ['og', 'ox', 'ag', 'ax', 'v', 'data', 'chi_sq_renormed', 'combined']
     for type in types:
         basename = '.'.join(fake_obses[0].split('.')[0:-2]) + '.' + type + '_threshold_flags.h5'
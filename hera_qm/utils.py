@@ -304,6 +304,38 @@ def get_metrics_ArgumentParser(method_name):
                         'visibilities formed with these antennas will be set to True.')
         ap.add_argument("--clobber", default=False, action="store_true",
                         help='overwrites existing files (default False)')
+        ap.add_argument("--single_pass", default=False, action="store_true",
+                        help='run a single round of the masked median detrender '
+                        'instead of two rounds (default False)')
+        ap.add_argument('--n_threads', default=None, type=int,
+                        help='Number of threads to detrend tiles of each waterfall in. '
+                        'Default is None (serial).')
+        ap.add_argument("--packed_flags", default=False, action="store_true",
+                        help='write the flag files with bit-packed flags (default False)')
+        ap.add_argument('--n_workers', default=None, type=int,
+                        help='Number of workers to run independent stages of the pipeline '
+                        'in concurrently. Default is None (serial).')
+        ap.add_argument('--executor', default='thread', type=str,
+                        choices=['thread', 'process'],
+                        help='Whether the workers are threads or processes. '
+                        'Default is "thread".')
+        ap.add_argument("--no_prefetch", action="store_false", dest="prefetch", default=True,
+                        help='read the input files only when they are needed, '
+                        'instead of in a background thread one stage ahead')
+        ap.add_argument("--verbose", default=False, action="store_true",
+                        help='print how long each stage ran and waited for input files')
+        ap.add_argument('--data_chunk_size', default=None, type=int,
+                        help='Number of baselines of the (uvh5) data file to read and '
+                        'calculate the metric of at a time. Default is None (whole file).')
+        ap.add_argument("--container", default=False, action="store_true",
+                        help='write all metric and flag files to a single "xrfi.h5" '
+                        'container file, as its products (default False)')
+        ap.add_argument('--validate', default='all', type=str,
+                        choices=['all', 'io', 'none'],
+                        help='Which UVFlag objects to check: those of every step, only '
+                        'the written outputs, or none. Default is "all".')
+        ap.add_argument("--profile", default=False, action="store_true",
+                        help='print the wall time and peak memory of each stage (default False)')
     elif method_name == 'day_threshold_run':
         ap.prog = 'xrfi_day_threshold_run.py'
         ap.add_argument('data_files', type=str, nargs='+', help='List of paths to \
@@ -324,6 +356,23 @@ def get_metrics_ArgumentParser(method_name):
         ap.add_argument("--run_if_first", default=None, type=str, help='only run \
                         day_threshold_run if the first item in the sorted data_files \
                         list matches run_if_first (default None means always run)')
+        ap.add_argument('--n_threads', default=None, type=int,
+                        help='Number of threads to find the medians of each waterfall in. '
+                        'Default is None (serial).')
+        ap.add_argument("--no_prefetch", action="store_false", dest="prefetch", default=True,
+                        help='read each input file only when it is needed, instead of '
+                        'in a background thread while the previous one is processed')
+        ap.add_argument("--verbose", default=False, action="store_true",
+                        help='print how long each file took and waited to be read')
+        ap.add_argument("--container", default=False, action="store_true",
+                        help='read the metrics and flags from the "xrfi.h5" container '
+                        'files written by xrfi_run (default False)')
+        ap.add_argument('--validate', default='all', type=str,
+                        choices=['all', 'io', 'none'],
+                        help='Which UVFlag objects to check: those of every step, only '
+                        'the inputs read and the outputs written, or none. Default is "all".')
+        ap.add_argument("--profile", default=False, action="store_true",
+                        help='print the wall time and peak memory of each stage (default False)')
     elif method_name == 'xrfi_apply':
         ap.prog = 'xrfi_apply.py'
         ap.add_argument('--infile_format', default='miriad', type=str,
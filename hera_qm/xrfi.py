@@ -4,8 +4,15 @@
 """Module for performing RFI identification and excision."""
 
 import numpy as np
+import copy
 import os
+import shutil
+import tempfile
+import h5py
 from collections.abc import Iterable
+from contextlib import contextmanager
+from functools import partial
+from functools import wraps
 from pyuvdata import UVData
 from pyuvdata import UVCal
 from pyuvdata import UVFlag
@@ -15,6 +22,9 @@ from .version import hera_qm_version_str
 from .metrics_io import process_ex_ants
 import warnings
 import glob
+import threading
+import time
+import tracemalloc
 
 
 #############################################################################
@@ -82,18 +92,13 @@ def flag_xants(uv, xants, inplace=True, run_check=True,
 
     if not isinstance(xants, Iterable):
         xants = [xants]
+    # np.isin does not match the elements of a set
+    xants = np.asarray(list(xants))
     if issubclass(uvo.__class__, UVData) or (isinstance(uvo, UVFlag) and uvo.type == 'baseline'):
-        all_ants = np.unique(np.append(uvo.ant_1_array, uvo.ant_2_array))
-        for ant in all_ants:
-            for xant in xants:
-                blts = uvo.antpair2ind(ant, xant)
-                uvo.flag_array[blts, :, :, :] = True
-                blts = uvo.antpair2ind(xant, ant)
-                uvo.flag_array[blts, :, :, :] = True
+        blts = np.isin(uvo.ant_1_array, xants) | np.isin(uvo.ant_2_array, xants)
+        uvo.flag_array[blts] = True
     elif issubclass(uvo.__class__, UVCal) or (isinstance(uvo, UVFlag) and uvo.type == 'antenna'):
-        for xant in xants:
-            ai = np.where(uvo.ant_array == xant)[0]
-            uvo.flag_array[ai, :, :, :, :] = True
+        uvo.flag_array[np.isin(uvo.ant_array, xants)] = True
 
     if not inplace:
         return uvo
@@ -132,6 +137,811 @@ def resolve_xrfi_path(xrfi_path, fname, jd_subdir=False):
     return dirname
 
 
+class PackedFlags(object):
+    """Boolean flags stored eight to a byte.
+
+    The flags are packed with np.packbits in C order. This is the form in which
+    write_flags stores flags when packed=True; read_flags unpacks them again.
+
+    Parameters
+    ----------
+    flags : array of bool
+        The flags to pack.
+
+    Attributes
+    ----------
+    shape : tuple of int
+        The shape of the unpacked flags.
+    packed : array of uint8
+        The packed flags, as bytes in the order of np.packbits.
+    """
+
+    def __init__(self, flags):
+        """Pack a boolean array."""
+        flags = np.asarray(flags, dtype=bool)
+        self.shape = flags.shape
+        self.packed = np.packbits(flags.ravel())
+
+    @classmethod
+    def from_packed(cls, packed, shape):
+        """Make a PackedFlags object from bytes packed with np.packbits.
+
+        Parameters
+        ----------
+        packed : array of uint8
+            The packed flags, e.g. the packed attribute of a PackedFlags object.
+        shape : tuple of int
+            The shape of the unpacked flags.
+
+        Returns
+        -------
+        flags : PackedFlags
+            The packed flags.
+        """
+        out = cls.__new__(cls)
+        out.shape = tuple(shape)
+        out.packed = np.asarray(packed, dtype=np.uint8)
+        if out.packed.shape != (-(-out.size // 8),):
+            raise ValueError('packed must have one byte for every eight flags of shape '
+                             + str(out.shape) + ', but has shape ' + str(out.packed.shape))
+        return out
+
+    @property
+    def size(self):
+        """The number of flags."""
+        return int(np.prod(self.shape))
+
+    def unpack(self):
+        """Return the flags as a boolean array.
+
+        Returns
+        -------
+        flags : array of bool
+            The unpacked flags, of shape self.shape.
+        """
+        return np.unpackbits(self.packed, count=self.size).view(bool).reshape(self.shape)
+
+
+def write_flags(uvf, filename, clobber=False, packed=False, data_compression='lzf'):
+    """Write a UVFlag object to an HDF5 file, optionally with bit-packed flags.
+
+    With packed=True, the flags of a "flag" mode object are stored as the bytes
+    of a PackedFlags object in the "Data/packed_flag_array" dataset, with the
+    unpacked shape in its "shape" attribute, taking an eighth of the space of
+    the usual boolean dataset. All other attributes are written by UVFlag.write,
+    and the file is marked with a "flag_format" attribute of "packed".
+    Files with packed flags can only be read with read_flags: their
+    "Data/flag_array" is a one-element placeholder, which UVFlag rejects.
+
+    Parameters
+    ----------
+    uvf : UVFlag
+        The object to write. It is not modified.
+    filename : str
+        The output file.
+    clobber : bool, optional
+        If True, overwrite an existing file. Default is False.
+    packed : bool, optional
+        If True and uvf is in "flag" mode, bit-pack the flags. Default is False,
+        which writes the file with UVFlag.write.
+    data_compression : str, optional
+        HDF5 filter to apply to the data. Default is "lzf".
+    """
+    if not packed or uvf.mode != 'flag':
+        uvf.write(filename, clobber=clobber, data_compression=data_compression)
+        return
+    # Write the metadata from a shallow copy of uvf holding a placeholder with
+    # the dimensions of the flags, so the file reads back with the same array
+    # shapes and the flags of uvf, which other threads may be using, are left alone.
+    # (copy.copy would share the attributes of uvf, as UVBase.__setstate__ does.)
+    header = UVFlag.__new__(UVFlag)
+    header.__dict__.update(uvf.__dict__)
+    header._flag_array = copy.copy(uvf._flag_array)
+    header.flag_array = np.zeros((1,) * uvf.flag_array.ndim, dtype=bool)
+    header.write(filename, clobber=clobber, data_compression=data_compression)
+    with h5py.File(filename, 'a') as f:
+        f.attrs['flag_format'] = 'packed'
+        dset = f['Data'].create_dataset('packed_flag_array', chunks=True,
+                                        data=PackedFlags(uvf.flag_array).packed,
+                                        compression=data_compression)
+        dset.attrs['shape'] = uvf.flag_array.shape
+
+
+def read_flags(filename, product=None, run_check=True, check_extra=True,
+               run_check_acceptability=True):
+    """Read a UVFlag file, or list of files, with either packed or boolean flags.
+
+    Parameters
+    ----------
+    filename : str or list of str
+        The file(s) to read. Multiple files are combined along the time axis,
+        as by UVFlag.
+    product : str, optional
+        The product to read from container files written by FlagsContainerWriter.
+        This must be given for container files, and only for them.
+    run_check : bool
+        Option to check for the existence and proper shapes of parameters
+        on UVFlag Object.
+    check_extra : bool
+        Option to check optional parameters as well as required ones.
+    run_check_acceptability : bool
+        Option to check acceptable range of the values of parameters
+        on UVFlag Object.
+
+    Returns
+    -------
+    uvf : UVFlag
+        The object in the file(s).
+
+    Raises
+    ------
+    ValueError:
+        If product is not given for a container file, given for a file that is
+        not a container, or not in the container, or if a file marked as having
+        packed flags does not have them.
+    """
+    if isinstance(filename, (list, tuple)):
+        uvf = read_flags(filename[0], product=product, run_check=False)
+        for fname in filename[1:]:
+            uvf.__add__(read_flags(fname, product=product, run_check=False), inplace=True,
+                        run_check=False)
+    else:
+        with h5py.File(filename, 'r') as f:
+            is_container = 'Products' in f
+            if is_container:
+                if product is None:
+                    raise ValueError('{} is a container of UVFlag products, so a product '
+                                     'must be given to read.'.format(filename))
+                uvf = _read_container_product(f, product, filename)
+        if not is_container:
+            if product is not None:
+                raise ValueError('{} is not a container of UVFlag products, so it has no '
+                                 'product "{}".'.format(filename, product))
+            uvf = UVFlag(filename, run_check=False)
+            with h5py.File(filename, 'r') as f:
+                if f.attrs.get('flag_format') == 'packed':
+                    if 'packed_flag_array' not in f['Data']:
+                        raise ValueError('{} is marked as having packed flags, but has no '
+                                         'Data/packed_flag_array.'.format(filename))
+                    dset = f['Data/packed_flag_array']
+                    uvf.flag_array = PackedFlags.from_packed(dset[()],
+                                                             dset.attrs['shape']).unpack()
+    if run_check:
+        uvf.check(check_extra=check_extra, run_check_acceptability=run_check_acceptability)
+    return uvf
+
+
+def _history_with_version(history, uvf):
+    """Return history ending with the pyuvdata version string of uvf, as UVFlag.write adds it."""
+    if not uvutils._check_history_version(history, uvf.pyuvdata_version_str):
+        history += uvf.pyuvdata_version_str
+    return history
+
+
+def _same_dataset(dset1, dset2):
+    """Whether two HDF5 datasets hold the same values, with the same attributes."""
+    if not isinstance(dset1, h5py.Dataset) or not isinstance(dset2, h5py.Dataset):
+        return False
+    if dset1.shape != dset2.shape or dset1.dtype != dset2.dtype:
+        return False
+    if sorted(dset1.attrs) != sorted(dset2.attrs) or not all(
+            np.array_equal(dset1.attrs[key], dset2.attrs[key]) for key in dset1.attrs):
+        return False
+    return np.array_equal(dset1[()], dset2[()])
+
+
+def _read_container_product(f, product, filename):
+    """Read a product from an open container file into a new UVFlag object.
+
+    The groups of the product are copied to a temporary file with the name of
+    the container, which is read as a file written by write_flags.
+    """
+    if product not in f['Products']:
+        raise ValueError('{} has no product "{}".'.format(filename, product))
+    group = f['Products'][product]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tmpfile = os.path.join(tmpdir, os.path.basename(filename))
+        with h5py.File(tmpfile, 'w') as out:
+            for key, value in group.attrs.items():
+                out.attrs[key] = value
+            for name in ['Header', 'Data']:
+                f.copy(group[name], out, name=name)
+        return read_flags(tmpfile, run_check=False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class FlagsContainerWriter(object):
+    """Write UVFlag objects as the products of a single HDF5 container file.
+
+    Writing each UVFlag object to its own file repeats all of its metadata, and
+    costs filesystem operations for every file. A container holds each object as
+    a group in "Products", named by its product, with the "Header" and "Data"
+    groups of the file write_flags writes for it. Header datasets that are the
+    same as those of an earlier product are hard links to them, so the metadata
+    the products share are stored once. Products are read back with read_flags.
+
+    Parameters
+    ----------
+    filename : str
+        The container file to write.
+    clobber : bool, optional
+        If True, overwrite an existing file. Default is False.
+    packed : bool, optional
+        If True, bit-pack the flags of objects in "flag" mode, see write_flags.
+        Default is False.
+    data_compression : str, optional
+        HDF5 filter to apply to the data. Default is "lzf".
+    asynchronous : bool, optional
+        If True, products are written in a background thread, in the order
+        they are given, and write returns at once. The objects must then not be
+        modified until close returns. Default is False.
+
+    Raises
+    ------
+    ValueError:
+        If filename exists and clobber is False.
+    """
+
+    def __init__(self, filename, clobber=False, packed=False, data_compression='lzf',
+                 asynchronous=False):
+        """Create the container file."""
+        if os.path.exists(filename) and not clobber:
+            raise ValueError('File ' + filename + ' exists; skipping')
+        self.filename = filename
+        self.packed = packed
+        self.data_compression = data_compression
+        self._file = h5py.File(filename, 'w')
+        self._file.create_group('Products')
+        self._products = []
+        # the distinct header datasets written with each name
+        self._shared = {}
+        self._tmpdir = tempfile.mkdtemp()
+        self._pool = None
+        self._futures = []
+        if asynchronous:
+            # Delay import so concurrent.futures is only needed for asynchronous writes
+            from concurrent import futures
+            self._pool = futures.ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        """Return the writer, to close when the with block ends."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the container file."""
+        self.close()
+
+    def write(self, product, uvf):
+        """Write a UVFlag object to the container as the given product.
+
+        Parameters
+        ----------
+        product : str
+            The name of the product, to read it back by.
+        uvf : UVFlag
+            The object to write.
+
+        Raises
+        ------
+        ValueError:
+            If the product has already been written.
+        """
+        if product in self._products:
+            raise ValueError('Product "{}" is already in {}.'.format(product, self.filename))
+        self._products.append(product)
+        if self._pool is None:
+            self._write(product, uvf)
+        else:
+            self._futures.append(self._pool.submit(self._write, product, uvf))
+
+    def _write(self, product, uvf):
+        tmpfile = os.path.join(self._tmpdir, '{}.h5'.format(self._products.index(product)))
+        write_flags(uvf, tmpfile, clobber=True, packed=self.packed,
+                    data_compression=self.data_compression)
+        group = self._file['Products'].create_group(product)
+        with h5py.File(tmpfile, 'r') as f:
+            for key, value in f.attrs.items():
+                group.attrs[key] = value
+            f.copy(f['Data'], group, name='Data')
+            header = group.create_group('Header')
+            for name, item in f['Header'].items():
+                shared = self._shared.setdefault(name, [])
+                same = [dset for dset in shared if _same_dataset(item, dset)]
+                if same:
+                    header[name] = same[0]
+                else:
+                    f.copy(item, header, name=name)
+                    shared.append(header[name])
+        os.remove(tmpfile)
+
+    def close(self):
+        """Wait for any asynchronous writes to finish, and close the file.
+
+        Raises
+        ------
+        Exception:
+            The first error raised by an asynchronous write, if any.
+        """
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._futures = []
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+            self._file.close()
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+def _broadcast_shape(*shapes):
+    """Return the shape that arrays of the given shapes broadcast to."""
+    # np.broadcast_shapes needs numpy 1.20
+    return np.broadcast(*[np.broadcast_to(False, shape) for shape in shapes]).shape
+
+
+class FlagExpression(object):
+    """A lazy "or" of UVFlag objects in "flag" mode.
+
+    Chaining the "or" operator of UVFlag objects copies, checks and appends to
+    the history of a new object for every operand. A FlagExpression instead
+    collects the operands with the | and |= operators, and evaluate() ORs them
+    all into one copy of the first operand, merges their histories and checks
+    the result once. The result is the same as that of the chained operators.
+
+    Parameters
+    ----------
+    *operands : UVFlag or FlagExpression
+        The objects to OR together.
+
+    Attributes
+    ----------
+    operands : list of UVFlag
+        The objects to OR together, in order.
+    """
+
+    def __init__(self, *operands):
+        """Collect the operands."""
+        self.operands = []
+        for uvf in operands:
+            self._append(uvf)
+
+    def _append(self, other):
+        if isinstance(other, FlagExpression):
+            self.operands.extend(other.operands)
+        elif isinstance(other, UVFlag):
+            self.operands.append(other)
+        else:
+            raise ValueError('Only UVFlag objects can be ORed in a FlagExpression.')
+
+    def __or__(self, other):
+        """Return a new expression with other ORed in."""
+        return FlagExpression(self, other)
+
+    def __ior__(self, other):
+        """OR other into this expression."""
+        self._append(other)
+        return self
+
+    def evaluate(self, run_check=True, check_extra=True, run_check_acceptability=True):
+        """OR the flags of all operands together.
+
+        Parameters
+        ----------
+        run_check : bool
+            Option to check for the existence and proper shapes of parameters
+            on UVFlag Object.
+        check_extra : bool
+            Option to check optional parameters as well as required ones.
+        run_check_acceptability : bool
+            Option to check acceptable range of the values of parameters
+            on UVFlag Object.
+
+        Returns
+        -------
+        uvf : UVFlag
+            A copy of the first operand, with the flags of all operands ORed
+            together and their histories appended to its history.
+
+        Raises
+        ------
+        ValueError:
+            If there are no operands, if any is not in "flag" mode, if the type,
+            times, frequencies, polarizations, baselines or antennas of an operand
+            differ from those of the first operand, or if its flags do not
+            broadcast to the shape of the first operand.
+        """
+        if len(self.operands) == 0:
+            raise ValueError('There are no flags to OR together.')
+        first = self.operands[0]
+        params = ['time_array', 'freq_array', 'polarization_array']
+        if first.type == 'baseline':
+            params.append('baseline_array')
+        elif first.type == 'antenna':
+            params.append('ant_array')
+        for uvf in self.operands:
+            if uvf.mode != 'flag':
+                raise ValueError('UVFlag object must be in "flag" mode to use "or" function.')
+            if uvf.type != first.type:
+                raise ValueError('UVFlag object of type {0} cannot be ORed with an object '
+                                 'of type {1}.'.format(uvf.type, first.type))
+            for param in params:
+                # compare the UVParameters to allow for their tolerances
+                if getattr(uvf, '_' + param) != getattr(first, '_' + param):
+                    raise ValueError('{} is not the same on the UVFlag objects to OR '
+                                     'together.'.format(param))
+            shape = first.flag_array.shape
+            if _broadcast_shape(shape, uvf.flag_array.shape) != shape:
+                raise ValueError('Flag arrays of shape {0} and {1} cannot be ORed '
+                                 'together.'.format(shape, uvf.flag_array.shape))
+        out = first.copy()
+        for uvf in self.operands[1:]:
+            np.logical_or(out.flag_array, uvf.flag_array, out=out.flag_array)
+            if uvf.history not in out.history:
+                out.history += "Flags OR'd with: " + uvf.history
+        out.history = _history_with_version(out.history, out)
+        if run_check:
+            out.check(check_extra=check_extra, run_check_acceptability=run_check_acceptability)
+        return out
+
+
+class PipelineContext(object):
+    """Validation policy and profile of a run of the xrfi pipeline.
+
+    The pipeline functions take run_check, check_extra and run_check_acceptability,
+    and by default check every UVFlag object they make. Within a run, these
+    checks re-scan the same arrays dozens of times. A context passed to the
+    pipeline functions (as their context argument) overrides those arguments
+    with a single policy, and can record the wall time and peak memory of each
+    stage of the run, to find where it spends them.
+
+    Parameters
+    ----------
+    validate : {"all", "io", "none"}, optional
+        "all" checks every object after each step, as run_check=True does.
+        "io" only checks the objects read from files and the final outputs of
+        the run functions, once, before they are written. "none" checks nothing.
+        Default is "all".
+    check_extra : bool, optional
+        Option to check optional parameters as well as required ones.
+        Default is True.
+    run_check_acceptability : bool, optional
+        Option to check acceptable range of the values of parameters.
+        Default is True.
+    profile : bool, optional
+        If True, record the calls, wall time and peak memory of each stage, see
+        stage. The memory is traced with tracemalloc, which slows the run down.
+        Default is False.
+
+    Attributes
+    ----------
+    stats : dict
+        The [number of calls, total wall time in s, peak memory in MB] of each
+        stage, keyed by its name, in the order they were first recorded. Stages
+        can be nested (e.g. the flag calls within a pipe), so the times of
+        different stages overlap.
+
+    Raises
+    ------
+    ValueError:
+        If validate is not recognized.
+    """
+
+    def __init__(self, validate='all', check_extra=True, run_check_acceptability=True,
+                 profile=False):
+        """Set the policy."""
+        if validate not in ['all', 'io', 'none']:
+            raise ValueError('validate must be "all", "io" or "none", not "{}".'.format(validate))
+        self.validate = validate
+        self.check_extra = check_extra
+        self.run_check_acceptability = run_check_acceptability
+        self.profile = profile
+        self.stats = {}
+        self._init_profile()
+
+    def _init_profile(self):
+        # the peak traced memory seen while each running stage has been running
+        self._running = {}
+        self._tracing = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """Pickle the policy and stats, e.g. for stages run in processes."""
+        state = self.__dict__.copy()
+        for attr in ['_running', '_tracing', '_lock']:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        """Unpickle the policy and stats."""
+        self.__dict__.update(state)
+        self._init_profile()
+
+    def step_checks(self):
+        """Return the check arguments for the intermediate steps of the pipeline."""
+        return {'run_check': self.validate == 'all', 'check_extra': self.check_extra,
+                'run_check_acceptability': self.run_check_acceptability}
+
+    def io_checks(self):
+        """Return the check arguments for objects read from files."""
+        return {'run_check': self.validate != 'none', 'check_extra': self.check_extra,
+                'run_check_acceptability': self.run_check_acceptability}
+
+    def check_output(self, uvf):
+        """Check a final output of a run, unless it was checked as it was made.
+
+        Parameters
+        ----------
+        uvf : UVFlag
+            The object to check.
+        """
+        if self.validate == 'io':
+            uvf.check(check_extra=self.check_extra,
+                      run_check_acceptability=self.run_check_acceptability)
+
+    def record(self, name, seconds, peak=None):
+        """Add a call of a stage to its stats.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        seconds : float
+            The wall time of the call.
+        peak : float, optional
+            The peak memory in MB during the call, if it was traced.
+        """
+        stats = self.stats.setdefault(name, [0, 0., None])
+        stats[0] += 1
+        stats[1] += seconds
+        if peak is not None:
+            stats[2] = peak if stats[2] is None else max(stats[2], peak)
+
+    def _update_peaks(self):
+        # fold the peak since the last update into every running stage
+        peak = tracemalloc.get_traced_memory()[1]
+        for key in self._running:
+            self._running[key] = max(self._running[key], peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name):
+        """Record the wall time and peak memory of a block as a call of a stage.
+
+        The peak memory is that traced in the whole process while the block ran,
+        including by other threads. Before Python 3.9, which lacks
+        tracemalloc.reset_peak, it is the peak since the outermost stage began.
+        Nothing is recorded unless profile is True.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        """
+        if not self.profile:
+            yield
+            return
+        key = object()
+        with self._lock:
+            if not self._running and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            self._update_peaks()
+            self._running[key] = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._update_peaks()
+                peak = self._running.pop(key)
+                self.record(name, seconds, peak=peak / 2.**20)
+                if not self._running and self._tracing:
+                    tracemalloc.stop()
+                    self._tracing = False
+
+    def print_stats(self):
+        """Print the stats of each stage."""
+        for name, (calls, seconds, peak) in self.stats.items():
+            line = '{}: {} call{}, {:.2f} s'.format(name, calls, '' if calls == 1 else 's',
+                                                   seconds)
+            if peak is not None:
+                line += ', peak memory {:.1f} MB'.format(peak)
+            print(line)
+
+
+def _context_checks(context, run_check=True, check_extra=True, run_check_acceptability=True):
+    """Return the check arguments of a pipeline step, from its context if it has one."""
+    if context is None:
+        return run_check, check_extra, run_check_acceptability
+    checks = context.step_checks()
+    return checks['run_check'], checks['check_extra'], checks['run_check_acceptability']
+
+
+def _profiled(func):
+    """Record the calls of a pipeline function as a stage of its context argument.
+
+    The context must be passed by keyword.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        context = kwargs.get('context')
+        if context is None:
+            return func(*args, **kwargs)
+        with context.stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _baseline_groups(baseline_array):
+    """Group the baseline-times of each baseline, and the baselines with equal numbers of times.
+
+    The groups are found with a single np.unique of the baselines, rather than
+    searching the baseline array once per baseline.
+
+    Parameters
+    ----------
+    baseline_array : array of int
+        The baseline number of each baseline-time.
+
+    Returns
+    -------
+    groups : list of arrays of int
+        For each number of times Ntimes of any baseline, a (Nbls, Ntimes) array of
+        the baseline-time indices of the baselines with that many times, in the
+        order they appear in baseline_array.
+    """
+    _, bl_inv, bl_counts = np.unique(baseline_array, return_inverse=True, return_counts=True)
+    blt_order = np.argsort(bl_inv, kind='stable')
+    bl_starts = np.cumsum(bl_counts) - bl_counts
+    groups = []
+    for ntimes in np.unique(bl_counts):
+        bls = np.nonzero(bl_counts == ntimes)[0]
+        groups.append(blt_order[bl_starts[bls][:, None] + np.arange(ntimes)])
+    return groups
+
+
+def _collapse_marginals(arr, avg_method, freq_axis, time_axis=0, time_inv=None, ntimes=None,
+                        weights=None, flags=None, chunk_size=None):
+    """Collapse an array to its channel and time marginals in a single pass.
+
+    This gives the same as collapsing arr (as by pyuvdata.utils.collapse) over all
+    axes but freq_axis, and over all axes but time_axis (within the groups of
+    time_inv), but reads arr, weights and flags only once, a chunk of the first
+    axis at a time. Only the chunks are held in memory, so the inputs may also be
+    e.g. memory mapped arrays or HDF5 datasets. Infinite values get zero weight,
+    and channels or times with no weight give inf. Other methods of
+    pyuvdata.utils.collapse, such as "or" and "and", are passed to it instead,
+    on the whole arrays.
+
+    Parameters
+    ----------
+    arr : array
+        Input array.
+    avg_method : str
+        The averaging algorithm, one of those of pyuvdata.utils.collapse. Only
+        "mean", "absmean" and "quadmean" are collapsed in a single pass.
+    freq_axis : int
+        The frequency axis of arr. Must not be the first axis.
+    time_axis : int, optional
+        The time axis of arr. Default is 0.
+    time_inv : array of int, optional
+        The time of each index of time_axis, from 0 to ntimes - 1, e.g. the inverse
+        indices of np.unique on the times of baseline-times. Default is None, in
+        which case each index is its own time.
+    ntimes : int, optional
+        The number of times, required if time_inv is given.
+    weights : array, optional
+        Weights matching arr. Default is None, which weights all finite data equally.
+    flags : array of bool, optional
+        Flags matching arr. If given, also return which times and channels have
+        unflagged data. Default is None.
+    chunk_size : int, optional
+        The number of indices of the first axis to collapse at once. Default is
+        None, which uses chunks of about 4 million elements.
+
+    Returns
+    -------
+    freq_out : array
+        The collapsed value of each channel.
+    time_out : array
+        The collapsed value of each time.
+    unflagged : array of bool
+        If flags are given, whether each (time, channel) has any unflagged data,
+        of shape (ntimes, Nfreqs). Otherwise None.
+
+    Raises
+    ------
+    ValueError:
+        If avg_method is not recognized by pyuvdata.utils.collapse, a ValueError
+        is raised.
+    """
+    ndim = len(arr.shape)
+    freq_axis, time_axis = freq_axis % ndim, time_axis % ndim
+    nfreqs = arr.shape[freq_axis]
+    if time_inv is None:
+        time_inv = np.arange(arr.shape[time_axis])
+        ntimes = time_inv.size
+    if avg_method not in ('mean', 'absmean', 'quadmean'):
+        return _collapse_marginals_uvutils(arr, avg_method, freq_axis, time_axis, time_inv,
+                                           ntimes, weights=weights, flags=flags)
+    if chunk_size is None:
+        chunk_size = max(1, 2**22 * arr.shape[0] // max(np.prod(arr.shape), 1))
+    dtype = np.complex128 if np.iscomplexobj(arr) and avg_method == 'mean' else np.float64
+    fnum, fden = np.zeros(nfreqs, dtype=dtype), np.zeros(nfreqs)
+    tnum, tden = np.zeros(ntimes, dtype=dtype), np.zeros(ntimes)
+    unflagged = None if flags is None else np.zeros((ntimes, nfreqs), dtype=bool)
+
+    def _chunk(a, r0, r1):
+        # (Ntimes, Nfreqs, everything else) of a chunk of the first axis
+        a = np.moveaxis(np.asarray(a[r0:r1]), (time_axis, freq_axis), (0, 1))
+        return a.reshape(a.shape[0], nfreqs, -1)
+
+    for r0 in range(0, arr.shape[0], chunk_size):
+        r1 = min(r0 + chunk_size, arr.shape[0])
+        data = _chunk(arr, r0, r1)
+        if avg_method == 'absmean':
+            data = np.abs(data)
+        elif avg_method == 'quadmean':
+            data = np.square(np.abs(data))
+        isinf = np.isinf(data)
+        wts = ~isinf if weights is None else _chunk(weights, r0, r1) * ~isinf
+        wdata = wts * np.where(isinf, 0, data)
+        fnum += wdata.sum(axis=(0, 2))
+        fden += wts.sum(axis=(0, 2))
+        ids = time_inv[r0:r1] if time_axis == 0 else time_inv
+        tsum = wdata.sum(axis=(1, 2))
+        tnum += np.bincount(ids, weights=tsum.real, minlength=ntimes)
+        if np.iscomplexobj(tnum):
+            tnum += 1j * np.bincount(ids, weights=tsum.imag, minlength=ntimes)
+        tden += np.bincount(ids, weights=wts.sum(axis=(1, 2)), minlength=ntimes)
+        if flags is not None:
+            chunk_unflagged = ~np.all(_chunk(flags, r0, r1), axis=2)
+            # OR the unflagged channels of the indices of each time
+            order = np.argsort(ids, kind='stable')
+            starts = np.nonzero(np.diff(ids[order], prepend=-1))[0]
+            unflagged[ids[order][starts]] |= np.logical_or.reduceat(chunk_unflagged[order],
+                                                                    starts, axis=0)
+    outs = []
+    for num, den in [(fnum, fden), (tnum, tden)]:
+        where = den > 1e-10
+        out = np.where(where, np.true_divide(num, den, where=where), np.inf)
+        outs.append(np.sqrt(out) if avg_method == 'quadmean' else out)
+    return outs[0], outs[1], unflagged
+
+
+def _collapse_marginals_uvutils(arr, avg_method, freq_axis, time_axis, time_inv, ntimes,
+                                weights=None, flags=None):
+    """Collapse an array to its channel and time marginals with pyuvdata.utils.collapse.
+
+    See _collapse_marginals, which calls this for the methods it does not
+    collapse in a single pass.
+    """
+    def _waterfalls(a):
+        # (Ntimes, Nfreqs, everything else)
+        a = np.moveaxis(np.asarray(a), (time_axis, freq_axis), (0, 1))
+        return a.reshape(a.shape[0], a.shape[1], -1)
+
+    arr = _waterfalls(arr)
+    if weights is not None:
+        weights = _waterfalls(weights)
+    freq_out = uvutils.collapse(arr, avg_method, axis=(0, 2), weights=weights)
+    time_out = np.array([uvutils.collapse(arr[time_inv == t], avg_method,
+                                          weights=None if weights is None
+                                          else weights[time_inv == t])
+                         for t in range(ntimes)])
+    unflagged = None
+    if flags is not None:
+        flags = _waterfalls(flags)
+        unflagged = np.array([np.any(~flags[time_inv == t], axis=(0, 2))
+                              for t in range(ntimes)])
+    return freq_out, time_out, unflagged
+
+
 def _check_convolve_dims(data, K1=None, K2=None):
     """Check the kernel sizes to be used in various convolution-like operations.
 
@@ -192,7 +1002,7 @@ def _check_convolve_dims(data, K1=None, K2=None):
         return K1, K2
 
 
-def robust_divide(num, den):
+def robust_divide(num, den, out=None):
     """Prevent division by zero.
 
     This function will compute division between two array-like objects by setting
@@ -206,6 +1016,9 @@ def robust_divide(num, den):
         The numerator.
     den : array
         The denominator.
+    out : array, optional
+        Array to write the result to, with the broadcast shape of num and den.
+        Default is None, which allocates a new array.
 
     Returns
     -------
@@ -215,11 +1028,533 @@ def robust_divide(num, den):
 
     """
     thresh = np.finfo(den.dtype).eps
-    out = np.true_divide(num, den, where=(np.abs(den) > thresh))
-    out = np.where(np.abs(den) > thresh, out, np.inf)
+    if out is None:
+        out = np.true_divide(num, den, where=(np.abs(den) > thresh))
+        out = np.where(np.abs(den) > thresh, out, np.inf)
+        return out
+    valid = np.abs(den) > thresh
+    np.true_divide(num, den, out=out, where=valid)
+    np.copyto(out, np.inf, where=~valid)
     return out
 
 
+def _running_medfilt2d(data, kernel_size, block_rows=None, valid=None):
+    """Median filter a 2D array with a sliding histogram of ranks.
+
+    This is a drop-in replacement for scipy.signal.medfilt2d (including its
+    zero-padded boundary). Rather than re-sorting every window, the data are
+    converted to ranks once and each output row keeps a two-level (coarse/fine)
+    histogram of the ranks inside its window. Moving the window by one channel
+    only removes and adds a single column of 2*Kt+1 values, and the median is
+    found by walking the coarse and then the fine histogram. The cost per pixel
+    therefore grows linearly with the kernel height instead of with the kernel
+    area, which pays off for the large kernels used on waterfalls. A stack of
+    arrays is filtered in the same sweep, with the rows of all of them sharing
+    the histogram updates.
+
+    Parameters
+    ----------
+    data : array
+        2D real array to filter, or a stack of them with the 2D arrays along the
+        last two axes.
+    kernel_size : tuple of int
+        Odd kernel dimensions (2 * Kt + 1, 2 * Kf + 1).
+    block_rows : int, optional
+        Number of output rows that share a rank table. Larger values amortize
+        the per-channel overhead at the cost of memory. Default is
+        max(2 * kernel_size[0], 32).
+    valid : array, optional
+        Boolean array of the samples to use, same shape as data. If given, each
+        output is the median (as in np.median) of the valid samples in its window
+        only, the boundary is padded with invalid samples instead of zeros, and
+        windows without any valid samples are set to nan. Invalid samples are
+        ranked above all valid ones, so they never need to leave the histograms.
+        Default is None (all samples are used).
+
+    Returns
+    -------
+    d_sm : array
+        The median filtered array, same shape and type as data (floating point
+        if valid is given).
+
+    """
+    nt, nf = kernel_size
+    if (nt % 2 == 0) or (nf % 2 == 0):
+        raise ValueError('Each element of kernel_size must be odd.')
+    Kt, Kf = nt // 2, nf // 2
+    shape = data.shape
+    Ntimes, Nfreqs = shape[-2:]
+    if block_rows is None:
+        block_rows = max(2 * nt, 32)
+    pad_width = ((0, 0), (Kt, Kt), (Kf, Kf))
+    data = np.pad(data.reshape((-1,) + shape[-2:]), pad_width, mode='constant')
+    if valid is None:
+        d_sm = np.empty(data.shape[:1] + shape[-2:], dtype=data.dtype)
+    else:
+        valid = np.pad(valid.reshape((-1,) + shape[-2:]), pad_width, mode='constant',
+                       constant_values=False)
+        d_sm = np.empty(data.shape[:1] + shape[-2:],
+                        dtype=np.promote_types(data.dtype, np.float32))
+    for r0 in range(0, Ntimes, block_rows):
+        r1 = min(r0 + block_rows, Ntimes)
+        nrows = r1 - r0
+        bsize = (nrows + 2 * Kt) * data.shape[2]
+        # limit the size of the fine histograms of a batch of arrays to ~32 MB
+        nbatch = max(1, 2**25 // (nrows * bsize))
+        for i0 in range(0, data.shape[0], nbatch):
+            i1 = min(i0 + nbatch, data.shape[0])
+            band = data[i0:i1, r0:r1 + 2 * Kt].reshape(i1 - i0, -1)
+            # Rank all values in the band of each array; ties are broken by
+            # position, so every rank is unique and the median is just a rank lookup.
+            if valid is None:
+                order = np.argsort(band, axis=1, kind='stable')
+                kmed = np.full((i1 - i0) * nrows, nt * nf // 2)
+            else:
+                vband = valid[i0:i1, r0:r1 + 2 * Kt]
+                order = np.lexsort((band, ~vband.reshape(band.shape)), axis=1)
+                # number of valid samples in each window
+                nvalid = _box_sum(vband.astype(np.float64), Kt, Kf)
+                nvalid = np.rint(nvalid).astype(np.intp).reshape(-1, Nfreqs)
+            sorted_vals = np.take_along_axis(band, order, axis=1).ravel()
+            ranks = np.empty(band.shape, dtype=np.intp)
+            np.put_along_axis(ranks, order, np.arange(bsize), axis=1)
+            ranks = ranks.reshape(i1 - i0, nrows + 2 * Kt, -1)
+            nfine = int(np.ceil(np.sqrt(bsize)))
+            ncoarse = -(-bsize // nfine)
+            # one histogram row per output row of each array
+            nhist = (i1 - i0) * nrows
+            hists = np.arange(nhist)
+            items = hists // nrows
+            fine = np.zeros((nhist, ncoarse * nfine), dtype=np.int8)
+            # window rows of each output row, and offsets into the flattened coarse histogram
+            witems = items[:, None]
+            wrows = (hists % nrows)[:, None] + np.arange(nt)
+            offsets = (hists * ncoarse)[:, None]
+            # offsets of each array into sorted_vals
+            vals_offset = items * bsize
+            init = ranks[witems, wrows, :nf].reshape(nhist, -1)
+            fine[hists[:, None], init] = 1
+            coarse = np.bincount((init // nfine + offsets).ravel(), minlength=nhist * ncoarse)
+
+            def _select(k):
+                # value of rank k (per histogram) within each window
+                csum = np.cumsum(coarse.reshape(nhist, ncoarse), axis=1)
+                ibin = np.count_nonzero(csum <= k[:, None], axis=1)
+                below = np.where(ibin > 0, csum[hists, ibin - 1], 0)
+                fsum = np.cumsum(fine.reshape(nhist, ncoarse, nfine)[hists, ibin], axis=1,
+                                 dtype=np.int32)
+                ifine = np.count_nonzero(fsum <= (k - below)[:, None], axis=1)
+                return sorted_vals[vals_offset + ibin * nfine + ifine]
+
+            out = d_sm[i0:i1, r0:r1].reshape(nhist, Nfreqs)
+            for j in range(Nfreqs):
+                if j > 0:
+                    old = ranks[witems, wrows, j - 1]
+                    new = ranks[witems, wrows, j + nf - 1]
+                    fine[hists[:, None], old] = 0
+                    fine[hists[:, None], new] = 1
+                    coarse -= np.bincount((old // nfine + offsets).ravel(),
+                                          minlength=coarse.size)
+                    coarse += np.bincount((new // nfine + offsets).ravel(),
+                                          minlength=coarse.size)
+                if valid is None:
+                    out[:, j] = _select(kmed)
+                else:
+                    n = nvalid[:, j]
+                    lo = _select((n - 1) // 2)
+                    hi = _select(n // 2)
+                    out[:, j] = np.where(n > 0, (lo + hi) / 2, np.nan)
+            d_sm[i0:i1, r0:r1] = out.reshape(i1 - i0, nrows, Nfreqs)
+    return d_sm.reshape(shape)
+
+
+def _check_stack_dims(data, K1=None, K2=None, ndim=2):
+    """Check kernel sizes for a single array or a stack of arrays.
+
+    The algorithms operate on single ndim-dimensional arrays or on stacks of them,
+    with the stack along the first axis. This checks the kernel sizes against
+    the trailing ndim axes with _check_convolve_dims.
+
+    Parameters
+    ----------
+    data : array
+        ndim- or (ndim + 1)-dimensional array that will undergo convolution-like
+        operations.
+    K1 : int, optional
+        Kernel size along the first non-stacked dimension. See _check_convolve_dims.
+    K2 : int, optional
+        Kernel size along the second non-stacked dimension (only for ndim == 2).
+    ndim : {1, 2}, optional
+        The dimensionality of a single array in the stack. Default is 2.
+
+    Returns
+    -------
+    Same as _check_convolve_dims for a single array.
+
+    Raises
+    ------
+    ValueError:
+        If data is not ndim- or (ndim + 1)-dimensional, or if the kernel sizes are
+        invalid, a ValueError is raised.
+    """
+    if data.ndim == ndim + 1:
+        data = data[0]
+    elif data.ndim != ndim:
+        raise ValueError('Input to filter must be a {0:d}-D array or a stack of '
+                         '{0:d}-D arrays.'.format(ndim))
+    if ndim == 1:
+        return _check_convolve_dims(data, K1)
+    return _check_convolve_dims(data, K1, K2)
+
+
+class Workspace(object):
+    """Scratch arrays which are reused across calls of the detrending functions.
+
+    The detrending functions allocate several arrays the size of the (padded)
+    data on every call. When they are called repeatedly on data of the same shape
+    (e.g. the batches of calculate_metric), passing the same Workspace lets them
+    reuse those arrays instead. Each named buffer is only reallocated when the
+    requested shape or type changes, so a workspace holds at most one array per
+    name. The arrays returned by the functions never point into the workspace,
+    unless given as out. A workspace must not be shared between threads.
+
+    Attributes
+    ----------
+    n_requests : int
+        The number of buffers requested from the workspace.
+    n_allocations : int
+        The number of those requests which allocated a new array.
+    """
+
+    def __init__(self):
+        """Initialize an empty workspace."""
+        self._buffers = {}
+        self.n_requests = 0
+        self.n_allocations = 0
+
+    def get(self, name, shape, dtype):
+        """Return an uninitialized array, reusing the last one of the same name if possible.
+
+        Parameters
+        ----------
+        name : str
+            The name of the buffer.
+        shape : tuple of int
+            The shape of the array.
+        dtype : numpy dtype
+            The type of the array.
+
+        Returns
+        -------
+        buf : array
+            The array, whose contents are undefined.
+        """
+        self.n_requests += 1
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+            self.n_allocations += 1
+        return buf
+
+    def clear(self):
+        """Release all of the buffers."""
+        self._buffers = {}
+
+
+def _scratch(workspace, name, shape, dtype):
+    """Return a workspace buffer, or None if there is no workspace."""
+    if workspace is None:
+        return None
+    return workspace.get(name, shape, dtype)
+
+
+def _mirror_pad(data, Kt, Kf, out=None):
+    """Mirror-extend the last two axes of an array by Kt and Kf samples.
+
+    The edge samples are repeated (i.e. "symmetric" padding), matching the
+    extension historically used by the detrending functions. If given, the
+    result is written to out, of shape data.shape[:-2] + (Ntimes + 2 * Kt,
+    Nfreqs + 2 * Kf).
+    """
+    if out is None:
+        data = np.concatenate([data[..., Kt - 1::-1, :], data, data[..., :-Kt - 1:-1, :]],
+                              axis=-2)
+        return np.concatenate([data[..., Kf - 1::-1], data, data[..., :-Kf - 1:-1]], axis=-1)
+    Ntimes, Nfreqs = data.shape[-2:]
+    out[..., Kt:Kt + Ntimes, Kf:Kf + Nfreqs] = data
+    out[..., :Kt, Kf:Kf + Nfreqs] = data[..., Kt - 1::-1, :]
+    out[..., Kt + Ntimes:, Kf:Kf + Nfreqs] = data[..., :-Kt - 1:-1, :]
+    out[..., :Kf] = out[..., 2 * Kf - 1:Kf - 1:-1]
+    out[..., Kf + Nfreqs:] = out[..., Kf + Nfreqs - 1:Nfreqs - 1:-1]
+    return out
+
+
+def _pad_to_workspace(data, Kt, Kf, workspace, name):
+    """Mirror pad data, into a buffer of the workspace if there is one."""
+    shape = data.shape[:-2] + (data.shape[-2] + 2 * Kt, data.shape[-1] + 2 * Kf)
+    return _mirror_pad(data, Kt, Kf, out=_scratch(workspace, name, shape, data.dtype))
+
+
+def _sliding_windows(data, size):
+    """Return a read-only view of all windows of length size along the last axis.
+
+    The view has shape data.shape[:-1] + (data.shape[-1] - size + 1, size).
+    """
+    shape = data.shape[:-1] + (data.shape[-1] - size + 1, size)
+    strides = data.strides + (data.strides[-1],)
+    return np.lib.stride_tricks.as_strided(data, shape=shape, strides=strides,
+                                           writeable=False)
+
+
+def _box_sum(data, Kt, Kf):
+    """Sum an array over all (2Kt+1, 2Kf+1) boxes in its last two axes.
+
+    The sums are computed from cumulative sums along each axis in turn (a
+    separable summed-area table), so the cost does not depend on the box size.
+    Only boxes lying entirely inside the array are returned, so the output has
+    shape data.shape[:-2] + (Ntimes - 2 * Kt, Nfreqs - 2 * Kf).
+
+    Each sum is a difference of cumulative sums, which are accumulated in double
+    precision, so its rounding error is up to about 1e-16 times the sum of the
+    absolute values along the axes up to the box, rather than within it.
+    Non-finite values are left out of the cumulative sums and only make the
+    boxes holding them inf, -inf or nan, as a direct sum would.
+    """
+    def _box_sum_last(arr, K):
+        csum = np.cumsum(arr, axis=-1, dtype=np.promote_types(arr.dtype, np.float64))
+        out = csum[..., 2 * K:].copy()
+        out[..., 1:] -= csum[..., :-2 * K - 1]
+        return out
+
+    def _box_sum_finite(arr):
+        out = np.swapaxes(_box_sum_last(np.swapaxes(arr, -1, -2), Kt), -1, -2)
+        return _box_sum_last(out, Kf)
+
+    finite = np.isfinite(data)
+    if np.all(finite):
+        return _box_sum_finite(data).astype(data.dtype, copy=False)
+    out = _box_sum_finite(np.where(finite, data, 0))
+    # the boxes holding each kind of non-finite value, from exact counts
+    posinf = _box_sum_finite(data == np.inf) > 0
+    neginf = _box_sum_finite(data == -np.inf) > 0
+    out[posinf] = np.inf
+    out[neginf] = -np.inf
+    out[(posinf & neginf) | (_box_sum_finite(np.isnan(data)) > 0)] = np.nan
+    return out.astype(data.dtype, copy=False)
+
+
+def _box_mean(data, valid, Kt, Kf):
+    """Average the valid entries of an array over (2Kt+1, 2Kf+1) boxes.
+
+    Boxes without any valid entries are set to nan. See _box_sum for the shape
+    of the output.
+    """
+    total = _box_sum(np.where(valid, data, 0), Kt, Kf)
+    count = _box_sum(valid.astype(np.float64), Kt, Kf)
+    # rounding in the cumulative sums can leave tiny residuals for empty boxes
+    empty = count < 0.5
+    count[empty] = 1
+    total /= count
+    total[empty] = np.nan
+    return total
+
+
+def _median_filter(data, kernel_size, backend='scipy', out=None, valid=None):
+    """Median filter the trailing axes of an array, or of a stack of arrays.
+
+    Edges are padded with zeros, as in scipy.signal.medfilt and medfilt2d. Leading
+    axes not covered by kernel_size are treated as independent arrays.
+
+    Parameters
+    ----------
+    data : array
+        Real array to filter.
+    kernel_size : tuple of int
+        Odd kernel dimensions for the trailing axes of data.
+    backend : {"scipy", "running"}, optional
+        The median filter implementation. See detrend_medfilt. The "running"
+        backend only applies to 2D kernels; 1D kernels always use scipy.
+        Default is "scipy".
+    out : array, optional
+        Array of the same shape as data to write the result to. It may be a
+        strided view, and must not overlap data.
+    valid : array, optional
+        Boolean array of the same shape as data marking the samples to use. If
+        given, only valid samples enter the medians (see _running_medfilt2d),
+        which requires a 2D kernel and always uses the "running" engine.
+
+    Returns
+    -------
+    d_sm : array
+        The median filtered array, same shape as data.
+
+    Raises
+    ------
+    ValueError:
+        If backend is not a recognized option, a ValueError is raised.
+    """
+    kernel_size = tuple(kernel_size)
+    nstack = data.ndim - len(kernel_size)
+    if valid is not None and len(kernel_size) != 2:
+        raise ValueError('Masked median filtering requires a 2D kernel.')
+    if (backend == 'running' and len(kernel_size) == 2) or valid is not None:
+        d_sm = _running_medfilt2d(data, kernel_size, valid=valid)
+    elif backend not in ('scipy', 'running'):
+        raise ValueError('Unrecognized medfilt backend ' + str(backend))
+    else:
+        # Delay import so scipy is not required for any use of hera_qm
+        from scipy.signal import medfilt, medfilt2d
+        from scipy.ndimage import median_filter
+        if nstack > 0:
+            return median_filter(data, size=(1,) * nstack + kernel_size, mode='constant',
+                                 output=out)
+        elif len(kernel_size) == 2:
+            d_sm = medfilt2d(data, kernel_size=kernel_size)
+        else:
+            d_sm = medfilt(data, kernel_size=kernel_size[0])
+    if out is None or d_sm is out:
+        return d_sm
+    out[...] = d_sm
+    return out
+
+
+def _complex_parts(data):
+    """Return a real view of a complex array, stacked as (real, imag) on a new first axis.
+
+    The last axis of data must be contiguous. No data are copied.
+    """
+    parts = data.view(data.real.dtype).reshape(data.shape + (2,))
+    return np.moveaxis(parts, -1, 0)
+
+
+def _tiled_detrend(func, data, flags, Kt, Kf, n_threads=None, workspace=None, out=None,
+                   **kwargs):
+    """Apply a detrending function to tiles of a padded array in a thread pool.
+
+    func(data, flags, Kt, Kf, **kwargs) must return the metric of the interior
+    of the (padded) array it is given, data[..., Kt:-Kt, Kf:-Kf]. The metric of
+    a pixel depends on the data within twice the kernel half-widths of it (the
+    trend of each residual in its sigma window), so each tile is given a halo
+    of 2 * Kt and 2 * Kf pixels. Within that, the tile boundary only affects
+    pixels that are discarded, and the stitched result is the same as applying
+    func to the whole array. Most of the work is in compiled numpy and scipy
+    routines, so the tiles can run concurrently in threads.
+
+    Parameters
+    ----------
+    func : function
+        The detrending function of a padded array.
+    data : array
+        Padded data, or stack of data with the waterfalls in the last two axes.
+    flags : array or None
+        Padded flags, matching data, passed on to func.
+    Kt : int
+        The kernel half-width in time.
+    Kf : int
+        The kernel half-width in frequency.
+    n_threads : int, optional
+        The number of threads to use. Default is None, which calls func once on
+        the whole array.
+    workspace : Workspace, optional
+        Scratch arrays passed on to func when it is called on the whole array.
+        Tiles do not use it, since it cannot be shared between threads.
+    out : array, optional
+        Array to write the metric to. Default is None, which allocates a new array.
+    **kwargs : dict
+        Keyword arguments passed on to func.
+
+    Returns
+    -------
+    out : array
+        The metric of the interior of data.
+    """
+    if n_threads is None or n_threads <= 1:
+        return func(data, flags, Kt, Kf, workspace=workspace, out=out, **kwargs)
+    # Delay import so concurrent.futures is only needed when threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    Ntimes, Nfreqs = data.shape[-2] - 2 * Kt, data.shape[-1] - 2 * Kf
+    # Split the times first and the frequencies with the remaining threads,
+    # without making tiles narrower than the kernels.
+    ntiles_t = max(1, min(n_threads, Ntimes // (2 * Kt + 1)))
+    ntiles_f = max(1, min(n_threads // ntiles_t, Nfreqs // (2 * Kf + 1)))
+    t_edges = np.linspace(0, Ntimes, ntiles_t + 1).astype(int)
+    f_edges = np.linspace(0, Nfreqs, ntiles_f + 1).astype(int)
+    tiles = [None] * (ntiles_t * ntiles_f)
+
+    def _tile(i, j):
+        # core of the tile in output coordinates, and its padded input with halo
+        t0, t1 = t_edges[i], t_edges[i + 1]
+        f0, f1 = f_edges[j], f_edges[j + 1]
+        r0, r1 = max(t0 - Kt, 0), min(t1 + 3 * Kt, data.shape[-2])
+        c0, c1 = max(f0 - Kf, 0), min(f1 + 3 * Kf, data.shape[-1])
+        tile_flags = None if flags is None else flags[..., r0:r1, c0:c1]
+        metric = func(data[..., r0:r1, c0:c1], tile_flags, Kt, Kf, **kwargs)
+        # metric[..., 0, 0] is output pixel (r0, c0)
+        tiles[i * ntiles_f + j] = metric[..., t0 - r0:t1 - r0, f0 - c0:f1 - c0]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = [executor.submit(_tile, i, j) for i in range(ntiles_t)
+                   for j in range(ntiles_f)]
+        for future in futures:
+            # raise any exception from the threads
+            future.result()
+    rows = [np.concatenate(tiles[i * ntiles_f:(i + 1) * ntiles_f], axis=-1)
+            for i in range(ntiles_t)]
+    if out is None:
+        return np.concatenate(rows, axis=-2)
+    return np.concatenate(rows, axis=-2, out=out)
+
+
+def _median_detrend(data, kernel_size, backend='scipy', workspace=None):
+    """Subtract a running median from data and estimate the local residual scale.
+
+    This is the core of detrend_medfilt and modzscore_1d. For complex data the
+    real and imaginary parts are smoothed in a single pass of the filter over a
+    view of the data, rather than filtering separate copies of each part and
+    recombining them. The imaginary work is skipped entirely for real data.
+    Intermediate results are computed in place where possible.
+
+    Parameters
+    ----------
+    data : array
+        Padded data (or stack of data) to detrend, with a contiguous last axis.
+    kernel_size : tuple of int
+        Odd kernel dimensions for the trailing axes of data.
+    backend : {"scipy", "running"}, optional
+        The median filter implementation, see _median_filter. Default is "scipy".
+    workspace : Workspace, optional
+        Scratch arrays to hold the results in. Default is None, which allocates
+        new arrays.
+
+    Returns
+    -------
+    d_rs : array
+        The residual of data after subtracting the median filtered data.
+    sig : array
+        The median filtered squared residual, scaled to the standard deviation.
+    """
+    d_rs = _scratch(workspace, 'd_rs', data.shape, data.dtype)
+    if np.iscomplexobj(data):
+        d_rs = np.empty_like(data) if d_rs is None else d_rs
+        _median_filter(_complex_parts(data), kernel_size, backend=backend,
+                       out=_complex_parts(d_rs))
+    else:
+        d_rs = _median_filter(data, kernel_size, backend=backend, out=d_rs)
+    np.subtract(data, d_rs, out=d_rs)
+    d_sq = np.abs(d_rs, out=_scratch(workspace, 'd_sq', d_rs.shape, d_rs.real.dtype))
+    np.square(d_sq, out=d_sq)
+    sig_dtype = d_sq.dtype if np.issubdtype(d_sq.dtype, np.floating) else np.float64
+    sig = _median_filter(d_sq, kernel_size, backend=backend,
+                         out=_scratch(workspace, 'sig', d_sq.shape, sig_dtype))
+    # Factor of .456 is to put mod-z scores on same scale as standard deviation.
+    # Filtered integers are promoted to floats.
+    sig = np.divide(sig, .456, out=sig if np.issubdtype(sig.dtype, np.floating) else None)
+    np.sqrt(sig, out=sig)
+    return d_rs, sig
+
+
 #############################################################################
 # Functions for preprocessing data prior to RFI flagging
 #############################################################################
@@ -238,7 +1573,8 @@ def medmin(data, flags=None):
     Parameters
     ----------
     data : array
-        2D data array of the shape (time,frequency).
+        2D data array of the shape (time,frequency), or a 3D stack of such arrays
+        of shape (Nwaterfalls, time, frequency).
     flags : array, optional
         2D flag array to be interpretted as mask for d. NOT USED in this function,
         but kept for symmetry with other preprocessing functions.
@@ -246,21 +1582,33 @@ def medmin(data, flags=None):
     Returns
     -------
     medmin : array
-        The result of the medmin statistic.
+        The result of the medmin statistic. For a stack of arrays, this has shape
+        (Nwaterfalls, 1, 1) so that it broadcasts against the stack.
 
     """
-    _ = _check_convolve_dims(data, 1, 1)  # Just check data dims
-    mn = np.min(data, axis=0)
-    return 2 * np.median(mn) - np.min(mn)
+    _ = _check_stack_dims(data, 1, 1)  # Just check data dims
+    keepdims = (data.ndim == 3)
+    mn = np.min(data, axis=-2, keepdims=keepdims)
+    return (2 * np.median(mn, axis=-1, keepdims=keepdims)
+            - np.min(mn, axis=-1, keepdims=keepdims))
 
 
 def medminfilt(data, flags=None, Kt=8, Kf=8):
     """Filter an array on scales of Kt,Kf indexes with medmin.
 
+    Note
+    ----
+    For each pixel, the medmin statistic is computed on the box spanning
+    [t - Kt, t + Kt) in time and [f - Kf, f + Kf) in frequency, truncated at
+    the edges of the array. Because the statistic first takes the minimum over
+    time, it is computed separably: a sliding minimum along time, followed by a
+    sliding median and minimum along frequency.
+
     Parameters
     ----------
     data : array
-        2D data array of the shape (time, frequency).
+        2D data array of the shape (time, frequency), or a 3D stack of such arrays
+        of shape (Nwaterfalls, time, frequency).
     flags : array, optional
         2D flag array to be interpretted as mask for d. NOT USED in this function,
         but kept for symmetry with other preprocessing functions.
@@ -277,14 +1625,28 @@ def medminfilt(data, flags=None, Kt=8, Kf=8):
         The filtered array with the same shape as input array.
 
     """
-    Kt, Kf = _check_convolve_dims(data, Kt, Kf)
-    d_sm = np.empty_like(data)
-    for ind1 in range(data.shape[0]):
-        for ind2 in range(data.shape[1]):
-            i0, j0 = max(0, ind1 - Kt), max(0, ind2 - Kf)
-            i1, j1 = min(data.shape[0], ind1 + Kt), min(data.shape[1], ind2 + Kf)
-            d_sm[ind1, ind2] = medmin(data[i0:i1, j0:j1])
-    return d_sm
+    # Delay import so scipy is not required for any use of hera_qm
+    from scipy.ndimage import minimum_filter1d
+
+    Kt, Kf = _check_stack_dims(data, Kt, Kf)
+    Ntimes, Nfreqs = data.shape[-2:]
+    # Repeating the edge values does not change a minimum over a truncated window.
+    mn = minimum_filter1d(data, 2 * Kt, axis=-2, mode='nearest')
+    mn_min = minimum_filter1d(mn, 2 * Kf, axis=-1, mode='nearest')
+    # Sliding median along frequency. Full windows are done in blocks of times
+    # to bound the size of the window copy made by np.median, and the truncated
+    # windows at the band edges are done one channel at a time.
+    mn_med = np.empty_like(mn)
+    full = np.arange(Kf, Nfreqs - Kf + 1)
+    if full.size > 0:
+        ntimes = max(1, 2**22 // (full.size * 2 * Kf))
+        for t0 in range(0, Ntimes, ntimes):
+            windows = _sliding_windows(mn[..., t0:t0 + ntimes, :], 2 * Kf)
+            mn_med[..., t0:t0 + ntimes, full] = np.median(windows, axis=-1)
+    for ind2 in np.setdiff1d(np.arange(Nfreqs), full):
+        j0, j1 = max(0, ind2 - Kf), min(Nfreqs, ind2 + Kf)
+        mn_med[..., ind2] = np.median(mn[..., j0:j1], axis=-1)
+    return 2 * mn_med - mn_min
 
 
 def detrend_deriv(data, flags=None, dt=True, df=True):
@@ -298,7 +1660,8 @@ def detrend_deriv(data, flags=None, dt=True, df=True):
     Parameters
     ----------
     data : array
-        2D data array of the shape (time,frequency).
+        2D data array of the shape (time,frequency), or a 3D stack of such arrays
+        of shape (Nwaterfalls, time, frequency).
     flags : array, optional
         2D flag array to be interpretted as mask for d. NOT USED in this function,
         but kept for symmetry with other preprocessing functions.
@@ -313,27 +1676,25 @@ def detrend_deriv(data, flags=None, dt=True, df=True):
         A detrended array with same shape as input array.
 
     """
-    _ = _check_convolve_dims(data, 1, 1)  # Just check data dims
+    _ = _check_stack_dims(data, 1, 1)  # Just check data dims
     if not (dt or df):
         raise ValueError("dt and df cannot both be False when calling detrend_deriv")
     if df:
         # take gradient along frequency
-        d_df = np.gradient(data, axis=1)
+        d_df = np.gradient(data, axis=-1)
     else:
         d_df = data
     if dt:
         # take gradient along time
-        d_dtdf = np.gradient(d_df, axis=0)
+        d_dtdf = np.gradient(d_df, axis=-2)
     else:
         d_dtdf = d_df
 
     d2 = np.abs(d_dtdf)**2
     # model sig as separable function of 2 axes
-    sig_f = np.median(d2, axis=0)
-    sig_f.shape = (1, -1)
-    sig_t = np.median(d2, axis=1)
-    sig_t.shape = (-1, 1)
-    sig = np.sqrt(sig_f * sig_t / np.median(sig_t))
+    sig_f = np.median(d2, axis=-2, keepdims=True)
+    sig_t = np.median(d2, axis=-1, keepdims=True)
+    sig = np.sqrt(sig_f * sig_t / np.median(sig_t, axis=(-2, -1), keepdims=True))
     # don't divide by zero, instead turn those entries into +inf
     out = robust_divide(d_dtdf, sig)
     return out
@@ -345,7 +1706,8 @@ def detrend_medminfilt(data, flags=None, Kt=8, Kf=8):
     Parameters
     ----------
     data : array
-        2D data array of the shape (time, frequency) to detrend.
+        2D data array of the shape (time, frequency) to detrend, or a 3D stack of
+        such arrays of shape (Nwaterfalls, time, frequency).
     flags : array, optional
         2D flag array to be interpretted as mask for d. NOT USED in this function,
         but kept for symmetry with other preprocessing functions.
@@ -362,7 +1724,7 @@ def detrend_medminfilt(data, flags=None, Kt=8, Kf=8):
         An array of outlier significance metric.
 
     """
-    _ = _check_convolve_dims(data, 1, 1)  # Just check data dimensions
+    _ = _check_stack_dims(data, 1, 1)  # Just check data dimensions
     d_sm = medminfilt(np.abs(data), Kt=(2 * Kt + 1), Kf=(2 * Kf + 1))
     d_rs = data - d_sm
     d_sq = np.abs(d_rs)**2
@@ -373,13 +1735,15 @@ def detrend_medminfilt(data, flags=None, Kt=8, Kf=8):
     return out
 
 
-def detrend_medfilt(data, flags=None, Kt=8, Kf=8):
+def detrend_medfilt(data, flags=None, Kt=8, Kf=8, backend='scipy', n_threads=None,
+                    workspace=None, out=None):
     """Detrend array using a median filter.
 
     Parameters
     ----------
     data : array
-        2D data array to detrend.
+        2D data array to detrend, or a 3D stack of waterfalls of shape
+        (Nwaterfalls, Ntimes, Nfreqs) which are detrended independently.
     flags : array, optional
         2D flag array to be interpretted as mask for d. NOT USED in this function,
         but kept for symmetry with other preprocessing functions.
@@ -389,74 +1753,240 @@ def detrend_medfilt(data, flags=None, Kt=8, Kf=8):
     Kf : int, optional
         The box size in frequency (second) dimension to apply medfilt over. Default
         is 8 pixels.
+    backend : {"scipy", "running"}, optional
+        The median filter implementation. "scipy" uses scipy.signal.medfilt2d,
+        which sorts every window and scales with the kernel area. "running" uses
+        a sliding rank histogram which scales with the kernel height, and is
+        faster for large kernels. Both give identical results. Default is "scipy".
+    n_threads : int, optional
+        If greater than one, split the waterfall into tiles (with a halo of twice
+        the kernel half-widths) and detrend them in a pool of this many threads.
+        The output is identical to the serial calculation. Default is None
+        (serial).
+    workspace : Workspace, optional
+        Scratch arrays to reuse for the padded data and intermediate results,
+        e.g. when detrending many waterfalls of the same shape. Default is None,
+        which allocates new arrays.
+    out : array, optional
+        Array of the same shape as data to write the metric to. Default is None,
+        which allocates a new array.
 
     Returns
     -------
     out : array
         An array containing the outlier significance metric. Same type and size as d.
 
+    Raises
+    ------
+    ValueError:
+        If backend is not a recognized option, a ValueError is raised.
+
     """
-    # Delay import so scipy is not required for any use of hera_qm
-    from scipy.signal import medfilt2d
+    if backend not in ('scipy', 'running'):
+        raise ValueError('Unrecognized medfilt backend ' + str(backend))
+
+    Kt, Kf = _check_stack_dims(data, Kt, Kf)
+    data = _pad_to_workspace(data, Kt, Kf, workspace, 'data')
+    return _tiled_detrend(_detrend_medfilt_padded, data, None, Kt, Kf, n_threads=n_threads,
+                          workspace=workspace, out=out, backend=backend)
+
+
+def _detrend_medfilt_padded(data, flags, Kt, Kf, backend='scipy', workspace=None, out=None):
+    """Calculate the detrend_medfilt metric of the interior of a padded array."""
+    d_rs, sig = _median_detrend(data, (2 * Kt + 1, 2 * Kf + 1), backend=backend,
+                                workspace=workspace)
+    # don't divide by zero, instead turn those entries into +inf
+    return robust_divide(d_rs[..., Kt:-Kt, Kf:-Kf], sig[..., Kt:-Kt, Kf:-Kf], out=out)
 
-    Kt, Kf = _check_convolve_dims(data, Kt, Kf)
-    data = np.concatenate([data[Kt - 1::-1], data, data[:-Kt - 1:-1]], axis=0)
-    data = np.concatenate([data[:, Kf - 1::-1], data, data[:, :-Kf - 1:-1]], axis=1)
+
+def detrend_masked_medfilt(data, flags=None, Kt=8, Kf=8, n_threads=None, workspace=None,
+                           out=None):
+    """Detrend array using a median filter which ignores flagged samples.
+
+    This is the same statistic as detrend_medfilt, except that flagged (and nan)
+    samples are excluded from the windows of both the running median and the
+    running sigma, so flagged RFI does not bias the metric of its neighbors.
+    Windows without any valid samples give an infinite metric, as in
+    detrend_meanfilt. The medians are found with the sliding rank histogram of
+    detrend_medfilt's "running" backend.
+
+    Parameters
+    ----------
+    data : array
+        2D data array to detrend, or a 3D stack of waterfalls of shape
+        (Nwaterfalls, Ntimes, Nfreqs) which are detrended independently.
+    flags : array, optional
+        2D (or 3D, matching data) flag array to be interpretted as mask for d.
+    Kt : int, optional
+        The box size in time (first) dimension to apply medfilt over. Default is
+        8 pixels.
+    Kf : int, optional
+        The box size in frequency (second) dimension to apply medfilt over. Default
+        is 8 pixels.
+    n_threads : int, optional
+        The number of threads to detrend tiles of the waterfall in. See
+        detrend_medfilt. Default is None (serial).
+    workspace : Workspace, optional
+        Scratch arrays to reuse, see detrend_medfilt. Default is None.
+    out : array, optional
+        Array of the same shape as data to write the metric to. Default is None,
+        which allocates a new array.
+
+    Returns
+    -------
+    out : array
+        An array containing the outlier significance metric. Same type and size as d.
+    """
+    Kt, Kf = _check_stack_dims(data, Kt, Kf)
+    data = _pad_to_workspace(data, Kt, Kf, workspace, 'data')
+    if flags is not None:
+        flags = _pad_to_workspace(flags, Kt, Kf, workspace, 'flags')
+    return _tiled_detrend(_detrend_masked_medfilt_padded, data, flags, Kt, Kf,
+                          n_threads=n_threads, workspace=workspace, out=out)
+
+
+def _detrend_masked_medfilt_padded(data, flags, Kt, Kf, workspace=None, out=None):
+    """Calculate the detrend_masked_medfilt metric of the interior of a padded array."""
+    valid = ~np.isnan(data)
+    if flags is not None:
+        valid &= ~flags
+    d_rs, sig = _masked_median_detrend(data, (2 * Kt + 1, 2 * Kf + 1), valid,
+                                       workspace=workspace)
+    # don't divide by zero, instead turn those entries into +inf
+    return robust_divide(d_rs[..., Kt:-Kt, Kf:-Kf], sig[..., Kt:-Kt, Kf:-Kf], out=out)
+
+
+def _masked_median_detrend(data, kernel_size, valid, workspace=None):
+    """Subtract a running median of the valid samples and estimate the residual scale.
+
+    This is _median_detrend with only the valid samples in the windows of both
+    the running median and the running sigma.
+
+    Parameters
+    ----------
+    data : array
+        Padded data (or stack of data) to detrend.
+    kernel_size : tuple of int
+        Odd 2D kernel dimensions for the trailing axes of data.
+    valid : array of bool
+        The samples to use, same shape as data.
+    workspace : Workspace, optional
+        Scratch arrays to hold the results in. Default is None, which allocates
+        new arrays.
+
+    Returns
+    -------
+    d_rs : array
+        The residual of data after subtracting the median filtered data.
+    sig : array
+        The median filtered squared residual, scaled to the standard deviation.
+    """
     if np.iscomplexobj(data):
-        d_sm_r = medfilt2d(data.real, kernel_size=(2 * Kt + 1, 2 * Kf + 1))
-        d_sm_i = medfilt2d(data.imag, kernel_size=(2 * Kt + 1, 2 * Kf + 1))
-        d_sm = d_sm_r + 1j * d_sm_i
+        d_sm = np.empty_like(data)
+        _median_filter(_complex_parts(data), kernel_size, out=_complex_parts(d_sm),
+                       valid=np.broadcast_to(valid, (2,) + valid.shape))
     else:
-        d_sm = medfilt2d(data, kernel_size=(2 * Kt + 1, 2 * Kf + 1))
-    d_rs = data - d_sm
-    d_sq = np.abs(d_rs)**2
+        d_sm = _median_filter(data, kernel_size, valid=valid)
+    d_rs = np.subtract(data, d_sm, out=_scratch(workspace, 'd_rs', d_sm.shape,
+                                                np.result_type(data, d_sm)))
+    d_sq = np.abs(d_rs, out=_scratch(workspace, 'd_sq', d_rs.shape, d_rs.real.dtype))
+    np.square(d_sq, out=d_sq)
     # Factor of .456 is to put mod-z scores on same scale as standard deviation.
-    sig = np.sqrt(medfilt2d(d_sq, kernel_size=(2 * Kt + 1, 2 * Kf + 1)) / .456)
-    # don't divide by zero, instead turn those entries into +inf
-    out = robust_divide(d_rs, sig)
-    return out[Kt:-Kt, Kf:-Kf]
+    sig = np.sqrt(_median_filter(d_sq, kernel_size, valid=valid & np.isfinite(d_sq)) / .456)
+    return d_rs, sig
 
 
-def detrend_meanfilt(data, flags=None, Kt=8, Kf=8):
+def detrend_meanfilt(data, flags=None, Kt=8, Kf=8, backend='astropy', n_threads=None,
+                     workspace=None, out=None):
     """Detrend array using a mean filter.
 
     Parameters
     ----------
     data : array
-        2D data array to detrend.
+        2D data array to detrend, or a 3D stack of waterfalls of shape
+        (Nwaterfalls, Ntimes, Nfreqs) which are detrended independently.
     flags : array, optional
-        2D flag array to be interpretted as mask for d.
+        2D (or 3D, matching data) flag array to be interpretted as mask for d.
     Kt : int, optional
         The box size in time (first) dimension to apply medfilt over. Default is
         8 pixels.
     Kf : int, optional
         The box size in frequency (second) dimension to apply medfilt over.
         Default is 8 pixels.
+    backend : {"astropy", "sat"}, optional
+        The implementation of the masked box filter. "astropy" uses
+        astropy.convolution.convolve, whose cost scales with the kernel area.
+        "sat" computes the box sums from summed-area tables, so its cost does not
+        depend on Kt and Kf. The two agree to within floating point precision.
+        Default is "astropy".
+    n_threads : int, optional
+        The number of threads to detrend tiles of the waterfall in. See
+        detrend_medfilt. With the "sat" backend, tiled results agree with the
+        serial ones to within floating point precision rather than exactly.
+        Default is None (serial).
+    workspace : Workspace, optional
+        Scratch arrays to reuse, see detrend_medfilt. Default is None.
+    out : array, optional
+        Array of the same shape as data to write the metric to. Default is None,
+        which allocates a new array.
 
     Returns
     -------
     out : array
         An array containing the outlier significance metric. Same type and size as d.
+
+    Raises
+    ------
+    ValueError:
+        If backend is not a recognized option, a ValueError is raised.
     """
+    if backend not in ('astropy', 'sat'):
+        raise ValueError('Unrecognized meanfilt backend ' + str(backend))
+    Kt, Kf = _check_stack_dims(data, Kt, Kf)
+    # do a mirror extend, like in scipy's convolve, which astropy doesn't support
+    data = _pad_to_workspace(data, Kt, Kf, workspace, 'data')
+    if flags is not None:
+        flags = _pad_to_workspace(flags, Kt, Kf, workspace, 'flags')
+    return _tiled_detrend(_detrend_meanfilt_padded, data, flags, Kt, Kf, n_threads=n_threads,
+                          workspace=workspace, out=out, backend=backend)
+
+
+def _detrend_meanfilt_padded(data, flags, Kt, Kf, backend='astropy', workspace=None, out=None):
+    """Calculate the detrend_meanfilt metric of the interior of a padded array."""
+    if backend == 'sat':
+        valid = ~np.isnan(data)
+        if flags is not None:
+            valid &= ~flags
+        # astropy's "extend" boundary repeats the edge pixels of the padded array.
+        # astropy also casts complex input to real, so only the real part is smoothed.
+        pad_width = [(0, 0)] * (data.ndim - 2) + [(Kt, Kt), (Kf, Kf)]
+        d_sm = _box_mean(np.pad(data.real, pad_width, mode='edge'),
+                         np.pad(valid, pad_width, mode='edge'), Kt, Kf)
+        d_rs, d_sq = _mean_residual(data, d_sm, workspace)
+        # only the unpadded region is returned, and its boxes lie within the
+        # padded array, so no boundary treatment is needed for the variance
+        sig = np.sqrt(_box_mean(d_sq, valid & ~np.isnan(d_sq), Kt, Kf))
+        return robust_divide(d_rs[..., Kt:-Kt, Kf:-Kf], sig, out=out)
     # Delay import so astropy is not required for any use of hera_qm
     # Using astropy instead of scipy for treatement of Nan: http://docs.astropy.org/en/stable/convolution/
     from astropy.convolution import convolve
 
-    Kt, Kf = _check_convolve_dims(data, Kt, Kf)
-    kernel = np.ones((2 * Kt + 1, 2 * Kf + 1))
-    # do a mirror extend, like in scipy's convolve, which astropy doesn't support
-    data = np.concatenate([data[Kt - 1::-1], data, data[:-Kt - 1:-1]], axis=0)
-    data = np.concatenate([data[:, Kf - 1::-1], data, data[:, :-Kf - 1:-1]], axis=1)
-    if flags is not None:
-        flags = np.concatenate([flags[Kt - 1::-1], flags, flags[:-Kt - 1:-1]], axis=0)
-        flags = np.concatenate([flags[:, Kf - 1::-1], flags, flags[:, :-Kf - 1:-1]], axis=1)
+    # waterfalls in a stack are not mixed by the kernel
+    kernel = np.ones((1,) * (data.ndim - 2) + (2 * Kt + 1, 2 * Kf + 1))
     d_sm = convolve(data, kernel, mask=flags, boundary='extend')
-    d_rs = data - d_sm
-    d_sq = np.abs(d_rs)**2
+    d_rs, d_sq = _mean_residual(data, d_sm, workspace)
     sig = np.sqrt(convolve(d_sq, kernel, mask=flags))
     # don't divide by zero, instead turn those entries into +inf
-    out = robust_divide(d_rs, sig)
-    return out[Kt:-Kt, Kf:-Kf]
+    return robust_divide(d_rs[..., Kt:-Kt, Kf:-Kf], sig[..., Kt:-Kt, Kf:-Kf], out=out)
+
+
+def _mean_residual(data, d_sm, workspace=None):
+    """Return the residual of data from its smoothed version, and its square modulus."""
+    d_rs = np.subtract(data, d_sm, out=_scratch(workspace, 'd_rs', data.shape,
+                                                np.result_type(data, d_sm)))
+    d_sq = np.abs(d_rs, out=_scratch(workspace, 'd_sq', d_rs.shape, d_rs.real.dtype))
+    np.square(d_sq, out=d_sq)
+    return d_rs, d_sq
 
 
 def zscore_full_array(data, flags=None, modified=False):
@@ -471,10 +2001,12 @@ def zscore_full_array(data, flags=None, modified=False):
     Parameters
     ----------
     data : array
-        2D data array to process.
+        2D data array to process, or a 3D stack of waterfalls of shape
+        (Nwaterfalls, Ntimes, Nfreqs). The statistics are computed separately for
+        each waterfall in a stack.
     flags : array, optional
-        2D flag array to be interpretted as mask for d. ONLY used for the regular
-        zscore (not modified).
+        2D (or 3D, matching data) flag array to be interpretted as mask for d.
+        ONLY used for the regular zscore (not modified).
     modified : bool, optional
         Whether to calculate the modified z-scores. Default is False.
 
@@ -485,25 +2017,28 @@ def zscore_full_array(data, flags=None, modified=False):
 
     """
     data = np.array(data)  # makes a copy of the data
+    # reduce over each waterfall of a stack, or over everything for a single one
+    axis = (-2, -1) if data.ndim == 3 else None
+    keepdims = (data.ndim == 3)
     if flags is not None:
         data[flags] = np.nan
     if modified:
         if np.any(np.iscomplex(data)):
-            med_r = np.nanmedian(data).real
-            med_i = np.nanmedian(data).imag
-            mad_r = np.nanmedian(np.abs(data.real - med_r))
-            mad_i = np.nanmedian(np.abs(data.imag - med_i))
+            med_r = np.nanmedian(data, axis=axis, keepdims=keepdims).real
+            med_i = np.nanmedian(data, axis=axis, keepdims=keepdims).imag
+            mad_r = np.nanmedian(np.abs(data.real - med_r), axis=axis, keepdims=keepdims)
+            mad_i = np.nanmedian(np.abs(data.imag - med_i), axis=axis, keepdims=keepdims)
             mad = np.sqrt(mad_r**2 + mad_i**2)
             d_rs = data - med_r - 1j * med_i
         else:
-            med = np.nanmedian(data)
-            mad = np.nanmedian(np.abs(data - med))
+            med = np.nanmedian(data, axis=axis, keepdims=keepdims)
+            mad = np.nanmedian(np.abs(data - med), axis=axis, keepdims=keepdims)
             d_rs = data - med
         # don't divide by zero, instead turn those entries into +inf
-        out = robust_divide(d_rs, np.array([1.486 * mad]))
+        out = robust_divide(d_rs, np.atleast_1d(1.486 * mad))
     else:
-        d_rs = data - np.nanmean(data)
-        out = robust_divide(d_rs, np.array([np.nanstd(data)]))
+        d_rs = data - np.nanmean(data, axis=axis, keepdims=keepdims)
+        out = robust_divide(d_rs, np.atleast_1d(np.nanstd(data, axis=axis, keepdims=keepdims)))
     out[np.isnan(out)] = np.inf  # turn all nans into infs
     return out
 
@@ -514,10 +2049,12 @@ def modzscore_1d(data, flags=None, kern=8, detrend=True):
     Parameters
     ----------
     data : array
-        1D data array to detrend.
+        1D data array to detrend, or a 2D stack of 1D arrays of shape
+        (Narrays, Npixels) which are treated independently.
     flags : array, optional
-        1D flag array to be interpretted as mask for d. NOT USED in this function,
-        but kept for symmetry with other preprocessing functions.
+        1D (or 2D, matching data) flag array to be interpretted as mask for d.
+        Flagged samples are excluded from the medians, as are nan samples if
+        flags are given, but are still assigned zscores.
     kern : int, optional
         The box size to apply medfilt over. Default is 8 pixels.
     detrend : bool, optional
@@ -531,43 +2068,60 @@ def modzscore_1d(data, flags=None, kern=8, detrend=True):
         An array containing the outlier significance metric. Same type and size as data.
     """
     if detrend:
-        # Delay import so scipy is not required for use of hera_qm
-        from scipy.signal import medfilt
-
-        kern = _check_convolve_dims(data, kern)
-        data = np.concatenate([data[kern - 1::-1], data, data[:-kern - 1:-1]])
-        # detrend in 1D. Do real/imag regardless of whether data are complex because it's cheap.
-        d_sm_r = medfilt(data.real, kernel_size=2 * kern + 1)
-        d_sm_i = medfilt(data.imag, kernel_size=2 * kern + 1)
-        d_sm = d_sm_r + 1j * d_sm_i
-        d_rs = data - d_sm
-        d_sq = np.abs(d_rs)**2
-        # Factor of .456 is to put mod-z scores on same scale as standard deviation.
-        sig = np.sqrt(medfilt(d_sq, kernel_size=2 * kern + 1) / .456)
-        zscore = robust_divide(d_rs, sig)[kern:-kern]
+        kern = _check_stack_dims(data, kern, ndim=1)
+        data = np.concatenate([data[..., kern - 1::-1], data, data[..., :-kern - 1:-1]], axis=-1)
+        if flags is None or not np.any(flags):
+            # detrend in 1D, skipping the imaginary part for real data.
+            d_rs, sig = _median_detrend(data, (2 * kern + 1,))
+            zscore = robust_divide(d_rs, sig)[..., kern:-kern]
+        else:
+            flags = np.concatenate([flags[..., kern - 1::-1], flags,
+                                    flags[..., :-kern - 1:-1]], axis=-1)
+            # as a stack of single row waterfalls, for the masked median filter
+            valid = ~(flags | np.isnan(data))[..., np.newaxis, :]
+            d_rs, sig = _masked_median_detrend(data[..., np.newaxis, :], (1, 2 * kern + 1),
+                                               valid)
+            zscore = robust_divide(d_rs, sig)[..., 0, kern:-kern]
     else:
-        d_rs = data - np.nanmedian(data.real) - 1j * np.nanmedian(data.imag)
+        # reduce over each array of a stack, or over everything for a single one
+        axis = -1 if data.ndim == 2 else None
+        keepdims = (data.ndim == 2)
+        d_real, d_imag = data.real, data.imag
+        if flags is not None:
+            d_real = np.where(flags, np.nan, d_real)
+            d_imag = np.where(flags, np.nan, d_imag)
+        d_rs = (data - np.nanmedian(d_real, axis=axis, keepdims=keepdims)
+                - 1j * np.nanmedian(d_imag, axis=axis, keepdims=keepdims))
         d_sq = np.abs(d_rs)**2
         # Factor of .456 is to put mod-z scores on same scale as standard deviation.
-        sig = np.sqrt(np.nanmedian(d_sq) / .456)
-        zscore = robust_divide(d_rs, np.array([sig]))
+        sig = np.sqrt(np.nanmedian(d_sq if flags is None else np.where(flags, np.nan, d_sq),
+                                   axis=axis, keepdims=keepdims) / .456)
+        zscore = robust_divide(d_rs, np.atleast_1d(sig))
     return zscore.astype(data.dtype)
 
 
 # Update algorithm_dict whenever new metric algorithm is created.
 algorithm_dict = {'medmin': medmin, 'medminfilt': medminfilt, 'detrend_deriv': detrend_deriv,
                   'detrend_medminfilt': detrend_medminfilt, 'detrend_medfilt': detrend_medfilt,
+                  'detrend_masked_medfilt': detrend_masked_medfilt,
                   'detrend_meanfilt': detrend_meanfilt, 'zscore_full_array': zscore_full_array,
                   'modzscore_1d': modzscore_1d}
 
+# Detrenders which can be evaluated on pieces of a padded waterfall (see _tiled_detrend),
+# mapped to their cores which take the padded data.
+_padded_detrenders = {'detrend_medfilt': _detrend_medfilt_padded,
+                      'detrend_masked_medfilt': _detrend_masked_medfilt_padded,
+                      'detrend_meanfilt': _detrend_meanfilt_padded}
+
 #############################################################################
 # RFI flagging algorithms
 #############################################################################
 
 
+@_profiled
 def watershed_flag(uvf_m, uvf_f, nsig_p=2., nsig_f=None, nsig_t=None, avg_method='quadmean',
                    inplace=True, run_check=True, check_extra=True,
-                   run_check_acceptability=True):
+                   run_check_acceptability=True, context=None):
     """Expand a set of flags using a watershed algorithm.
 
     This function uses a UVFlag object in 'metric' mode (i.e. how many sigma the data
@@ -602,6 +2156,10 @@ def watershed_flag(uvf_m, uvf_f, nsig_p=2., nsig_f=None, nsig_t=None, avg_method
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    context : PipelineContext, optional
+        If given, its validation policy overrides run_check, check_extra and
+        run_check_acceptability, and the call is recorded as a stage of it.
+        Default is None.
 
     Returns
     -------
@@ -616,6 +2174,8 @@ def watershed_flag(uvf_m, uvf_f, nsig_p=2., nsig_f=None, nsig_t=None, avg_method
         type, then a ValueError is raised.
 
     """
+    run_check, check_extra, run_check_acceptability = _context_checks(
+        context, run_check, check_extra, run_check_acceptability)
     # Check inputs
     if (not isinstance(uvf_m, UVFlag)) or (uvf_m.mode != 'metric'):
         raise ValueError('uvf_m must be UVFlag instance with mode == "metric."')
@@ -637,60 +2197,57 @@ def watershed_flag(uvf_m, uvf_f, nsig_p=2., nsig_f=None, nsig_t=None, avg_method
     warr = uvf_m.weights_array
 
     if uvf_m.type == 'baseline':
-        # Pixel watershed
+        # Pixel watershed, on all baselines with the same number of times at once
         # TODO: bypass pixel-based if none
-        for bl in np.unique(uvf.baseline_array):
-            ind = np.where(uvf.baseline_array == bl)[0]
-            for pi in range(uvf.polarization_array.size):
-                farr[ind, 0, :, pi] += _ws_flag_waterfall(marr[ind, 0, :, pi],
-                                                          farr[ind, 0, :, pi], nsig_p)
+        for blt_inds in _baseline_groups(uvf.baseline_array):
+            # (Nbls, Ntimes, Nfreqs, Npols) waterfalls
+            farr[blt_inds, 0] = _ws_flag_stack(marr[blt_inds, 0], farr[blt_inds, 0], nsig_p,
+                                               axes=(1, 2))
+        if nsig_f is not None or nsig_t is not None:
+            ts, t_inv = np.unique(uvf.time_array, return_inverse=True)
+            fdata, tdata, unflagged = _collapse_marginals(marr, avg_method, 2, time_inv=t_inv,
+                                                          ntimes=ts.size, weights=warr,
+                                                          flags=farr)
         if nsig_f is not None:
             # Channel watershed
-            tempd = uvutils.collapse(marr, avg_method, axis=(0, 1, 3), weights=warr)
-            tempf = np.all(farr, axis=(0, 1, 3))
-            farr[:, :, :, :] += _ws_flag_waterfall(tempd, tempf, nsig_f).reshape(1, 1, -1, 1)
+            tempf = _ws_flag_waterfall(fdata, ~np.any(unflagged, axis=0), nsig_f)
+            farr[:, :, :, :] += tempf.reshape(1, 1, -1, 1)
+            unflagged[:, tempf] = False
         if nsig_t is not None:
             # Time watershed
-            ts = np.unique(uvf.time_array)
-            tempd = np.zeros(ts.size)
-            tempf = np.zeros(ts.size, dtype=np.bool)
-            for ti, time in enumerate(ts):
-                tempd[ti] = uvutils.collapse(marr[uvf.time_array == time, 0, :, :], avg_method,
-                                             weights=warr[uvf.time_array == time, 0, :, :])
-                tempf[ti] = np.all(farr[uvf.time_array == time, 0, :, :])
-            tempf = _ws_flag_waterfall(tempd, tempf, nsig_t)
-            for ti, time in enumerate(ts):
-                farr[uvf.time_array == time, :, :, :] += tempf[ti]
+            tempf = _ws_flag_waterfall(tdata, ~np.any(unflagged, axis=1), nsig_t)
+            farr[tempf[t_inv]] = True
     elif uvf_m.type == 'antenna':
-        # Pixel watershed
-        for ai in range(uvf.ant_array.size):
-            for pi in range(uvf.polarization_array.size):
-                farr[ai, 0, :, :, pi] += _ws_flag_waterfall(marr[ai, 0, :, :, pi].T,
-                                                            farr[ai, 0, :, :, pi].T, nsig_p).T
+        # Pixel watershed, on all antennas and polarizations at once
+        # in their (Nants, Nfreqs, Ntimes, Npols) layout
+        farr[:, 0] = _ws_flag_stack(marr[:, 0], farr[:, 0], nsig_p, axes=(1, 2))
+        if nsig_f is not None or nsig_t is not None:
+            fdata, tdata, unflagged = _collapse_marginals(marr, avg_method, 2, time_axis=3,
+                                                          weights=warr, flags=farr)
         if nsig_f is not None:
             # Channel watershed
-            tempd = uvutils.collapse(marr, avg_method, axis=(0, 1, 3, 4), weights=warr)
-            tempf = np.all(farr, axis=(0, 1, 3, 4))
-            farr[:, :, :, :, :] += _ws_flag_waterfall(tempd, tempf, nsig_f).reshape(1, 1, -1, 1, 1)
+            tempf = _ws_flag_waterfall(fdata, ~np.any(unflagged, axis=0), nsig_f)
+            farr[:, :, :, :, :] += tempf.reshape(1, 1, -1, 1, 1)
+            unflagged[:, tempf] = False
         if nsig_t is not None:
             # Time watershed
-            tempd = uvutils.collapse(marr, avg_method, axis=(0, 1, 2, 4), weights=warr)
-            tempf = np.all(farr, axis=(0, 1, 2, 4))
-            farr[:, :, :, :, :] += _ws_flag_waterfall(tempd, tempf, nsig_t).reshape(1, 1, 1, -1, 1)
+            tempf = _ws_flag_waterfall(tdata, ~np.any(unflagged, axis=1), nsig_t)
+            farr[:, :, :, :, :] += tempf.reshape(1, 1, 1, -1, 1)
     elif uvf_m.type == 'waterfall':
-        # Pixel watershed
-        for pi in range(uvf.polarization_array.size):
-            farr[:, :, pi] += _ws_flag_waterfall(marr[:, :, pi], farr[:, :, pi], nsig_p)
+        # Pixel watershed, on all polarizations at once
+        farr[:, :, :] = _ws_flag_stack(marr, farr, nsig_p, axes=(0, 1))
+        if nsig_f is not None or nsig_t is not None:
+            fdata, tdata, unflagged = _collapse_marginals(marr, avg_method, 1, weights=warr,
+                                                          flags=farr)
         if nsig_f is not None:
             # Channel watershed
-            tempd = uvutils.collapse(marr, avg_method, axis=(0, 2), weights=warr)
-            tempf = np.all(farr, axis=(0, 2))
-            farr[:, :, :] += _ws_flag_waterfall(tempd, tempf, nsig_f).reshape(1, -1, 1)
+            tempf = _ws_flag_waterfall(fdata, ~np.any(unflagged, axis=0), nsig_f)
+            farr[:, :, :] += tempf.reshape(1, -1, 1)
+            unflagged[:, tempf] = False
         if nsig_t is not None:
             # Time watershed
-            tempd = uvutils.collapse(marr, avg_method, axis=(1, 2), weights=warr)
-            tempf = np.all(farr, axis=(1, 2))
-            farr[:, :, :] += _ws_flag_waterfall(tempd, tempf, nsig_t).reshape(-1, 1, 1)
+            tempf = _ws_flag_waterfall(tdata, ~np.any(unflagged, axis=1), nsig_t)
+            farr[:, :, :] += tempf.reshape(-1, 1, 1)
     else:
         raise ValueError('Unknown UVFlag type: ' + uvf_m.type)
 
@@ -704,7 +2261,10 @@ def _ws_flag_waterfall(metric, fin, nsig=2.):
     """Perform the watershed algorithm on 1D or 2D arrays of metric and input flags.
 
     This is a helper function for watershed_flag, but not usually called
-    by end users.
+    by end users. Rather than growing the flags one neighbor at a time until
+    they converge, the flags are found in a single pass: all pixels connected to
+    an input flag through other flagged pixels or pixels with metric >= nsig
+    are flagged (see _ws_regions).
 
     Parameters
     ----------
@@ -727,25 +2287,90 @@ def _ws_flag_waterfall(metric, fin, nsig=2.):
         equal to 1 or 2, a ValueError is raised.
 
     """
-    # Delay import so scipy is not required for use of hera_qm
-    from scipy.signal import convolve
     if metric.shape != fin.shape:
         raise ValueError('metric and fin must match in shape. Shapes are: ' + str(metric.shape)
                          + ' and ' + str(fin.shape))
+    if metric.ndim not in (1, 2):
+        raise ValueError('Data must be 1D or 2D.')
+    labels, seeded = _ws_regions(metric, fin, nsig)
     fout = fin.copy()
-    while True:
-        nflags = np.sum(fout)
-        try:
-            kernel = {1: [1, 0, 1], 2: [[0, 1, 0], [1, 0, 1], [0, 1, 0]]}[metric.ndim]
-        except KeyError:
-            raise ValueError('Data must be 1D or 2D.')
-        is_neighbor_flagged = convolve(fout, kernel, mode='same').astype(bool)
-        fout |= (is_neighbor_flagged & (metric >= nsig))
-        if np.sum(fout) == nflags:
-            break
+    fout |= seeded[labels]
     return fout
 
 
+def _ws_flag_stack(metric, fin, nsig=2., axes=None):
+    """Perform the watershed algorithm on a stack of waterfalls.
+
+    Parameters
+    ----------
+    metric : array
+        Metric waterfalls with the times and frequencies in the last two axes
+        (or in axes). Should be in units of standard deviations.
+    fin : array
+        The input (boolean) flags, same shape as metric.
+    nsig : float, optional
+        The number of sigma to flag above for points near flagged points. Default is 2.
+    axes : tuple of int, optional
+        The two axes of each waterfall, in either order. All other axes index
+        the waterfalls of the stack. Default is None, the last two axes.
+
+    Returns
+    -------
+    fout : array
+        Boolean array matching metric, with each waterfall watershedded
+        independently as by _ws_flag_waterfall.
+    """
+    labels, seeded = _ws_regions(metric, fin, nsig, axes=axes)
+    return fin | seeded[labels]
+
+
+def _ws_regions(metric, fin, nsig=2., axes=None):
+    """Find the regions the watershed can spread flags through.
+
+    A flag spreads to any neighbor (along the last two axes, or the only axis of
+    a 1D array) with metric >= nsig, so the watershed flags exactly the regions
+    of connected pixels which are flagged or above nsig and contain an input
+    flag. The regions are labelled in one pass with scipy.ndimage.label.
+
+    Parameters
+    ----------
+    metric : array
+        A 1D or 2D array, or a stack of 2D arrays, in units of standard deviations.
+    fin : array
+        The input (boolean) flags, same shape as metric.
+    nsig : float, optional
+        The number of sigma to flag above for points near flagged points. Default is 2.
+    axes : tuple of int, optional
+        The axes along which flags spread. Default is None, the last two axes
+        (or the only axis of a 1D array).
+
+    Returns
+    -------
+    labels : array of int
+        The region of each pixel, same shape as metric. Pixels which cannot be
+        flagged are in region 0.
+    seeded : array of bool
+        Whether each region contains an input flag, indexed by label.
+    """
+    # Delay import so scipy is not required for any use of hera_qm
+    from scipy.ndimage import label, generate_binary_structure
+    fin = fin.astype(bool, copy=False)
+    passable = fin | (metric >= nsig)
+    if axes is None:
+        axes = tuple(range(metric.ndim))[-2:]
+    # nearest neighbors only, and waterfalls in a stack are not connected
+    structure = np.zeros((3,) * metric.ndim, dtype=bool)
+    center = [1] * metric.ndim
+    for ax in axes:
+        center[ax] = slice(None)
+    structure[tuple(center)] = generate_binary_structure(len(axes), 1)
+    labels, nlabels = label(passable, structure=structure)
+    seeded = np.zeros(nlabels + 1, dtype=bool)
+    seeded[labels[fin]] = True
+    seeded[0] = False
+    return labels, seeded
+
+
 def xrfi_waterfall(data, flags=None, Kt=8, Kf=8, nsig_init=6., nsig_adj=2.,
                    algorithm='detrend_medfilt'):
     """Compute metrics, flag, and then watershed on a single waterfall.
@@ -788,8 +2413,244 @@ def xrfi_waterfall(data, flags=None, Kt=8, Kf=8, nsig_init=6., nsig_adj=2.,
     return new_flags
 
 
+class StreamingDetrender(object):
+    """Detrend and flag a waterfall one integration at a time.
+
+    This is a streaming version of xrfi_waterfall for time-ordered data arriving
+    in real time. Integrations are added with add_integrations, which returns
+    the rows of the metric and of the watershed flags that are final so far.
+    Once the last integration of a file has been added, finalize returns the
+    remaining rows and resets the object for the next file. The concatenated
+    outputs are the same as running the algorithm and xrfi_waterfall on the
+    whole file.
+
+    The metric of an integration depends on the data up to 2 * Kt integrations
+    on either side of it (see _tiled_detrend), so metric rows are returned with
+    a latency of 2 * Kt integrations, and only the last 4 * Kt + 1 integrations
+    are kept in memory. The watershed can propagate flags arbitrarily far back in
+    time, so a flag row is only returned once none of its pixels can be reached
+    by flags in later integrations: i.e. once each of them is unflaggable, in a
+    region connected to an initial flag, or in a closed region without one. For
+    long-lived features (such as a persistent RFI channel above nsig_adj but not
+    nsig_init) this can take many integrations; max_flag_lag bounds the number
+    of pending flag rows at the cost of exactness.
+
+    Parameters
+    ----------
+    Kt : int, optional
+        The box size in time (first) dimension of the detrending. Default is 8.
+    Kf : int, optional
+        The box size in frequency (second) dimension of the detrending. Default is 8.
+    nsig_init : float, optional
+        The number of sigma in the metric above which to flag pixels. Default is 6.
+    nsig_adj : float, optional
+        The number of sigma to flag above for points near flagged points. Default is 2.
+    algorithm : str, optional
+        The metric algorithm name. Must be one of "detrend_medfilt",
+        "detrend_masked_medfilt" or "detrend_meanfilt". Default is "detrend_medfilt".
+    max_flag_lag : int, optional
+        The maximum number of flag rows waiting for the watershed to be decided.
+        When exceeded, the oldest rows are returned with the flags found so far,
+        which may miss flags propagated from later integrations. Default is None,
+        which always returns exact flags.
+    **kwargs : dict
+        Keyword arguments passed on to the algorithm, e.g. backend.
+
+    Raises
+    ------
+    ValueError:
+        If the algorithm cannot be streamed, a ValueError is raised.
+    """
+
+    def __init__(self, Kt=8, Kf=8, nsig_init=6., nsig_adj=2., algorithm='detrend_medfilt',
+                 max_flag_lag=None, **kwargs):
+        """Initialize the detrender with no integrations."""
+        if algorithm not in _padded_detrenders:
+            raise ValueError('Algorithm {0} cannot be streamed. Options are: {1}'.format(
+                algorithm, ', '.join(_padded_detrenders.keys())))
+        if Kt < 1 or Kf < 1:
+            raise ValueError('Kt and Kf must be greater than or equal to 1.')
+        self.Kt = Kt
+        self.Kf = Kf
+        self.nsig_init = nsig_init
+        self.nsig_adj = nsig_adj
+        self.algorithm = algorithm
+        self.max_flag_lag = max_flag_lag
+        self.kwargs = kwargs
+        self.reset()
+
+    def reset(self):
+        """Discard all integrations, e.g. to start a new file."""
+        self.Nfreqs = None
+        # total numbers of integrations added, and of metric and flag rows returned
+        self.n_in = 0
+        self.n_metric = 0
+        self.n_flags = 0
+        # raw data and input flags of the integrations from index _data_start on
+        self._data_start = 0
+        self._data = None
+        self._flags = None
+        self._has_flags = False
+        # metric and initial flags of the rows waiting for the watershed, and the
+        # final flags of the last flag row returned
+        self._metric = None
+        self._seeds = None
+        self._context = None
+
+    def add_integrations(self, data, flags=None):
+        """Add one or more integrations, and return any rows which are now final.
+
+        Parameters
+        ----------
+        data : array
+            The data of one integration, shape (Nfreqs,), or of several
+            consecutive integrations, shape (Nints, Nfreqs).
+        flags : array, optional
+            Input flags matching data, used as in xrfi_waterfall.
+
+        Returns
+        -------
+        metric : array
+            The metric rows which are final, shape (Nrows, Nfreqs). The first row
+            is integration n_metric (before the call) of the file.
+        new_flags : array
+            The flag rows which are final, shape (Nrows, Nfreqs). The first row is
+            integration n_flags (before the call) of the file.
+
+        Raises
+        ------
+        ValueError:
+            If the number of frequencies differs from previous integrations, a
+            ValueError is raised.
+        """
+        data = np.atleast_2d(data)
+        if flags is None:
+            flags = np.zeros(data.shape, dtype=bool)
+        else:
+            flags = np.atleast_2d(flags).astype(bool)
+            self._has_flags = True
+        if data.ndim != 2 or flags.shape != data.shape:
+            raise ValueError('data must have shape (Nfreqs,) or (Nints, Nfreqs), and flags '
+                             'must match it.')
+        if self.Nfreqs is None:
+            self.Nfreqs = data.shape[1]
+            self._Kf = _check_convolve_dims(data[:1], 1, self.Kf)[1]
+            self._data = data[:0]
+            self._flags = flags[:0]
+        elif data.shape[1] != self.Nfreqs:
+            raise ValueError('Expected {0:d} frequencies, but got {1:d}.'.format(
+                self.Nfreqs, data.shape[1]))
+        self._data = np.concatenate([self._data, data])
+        self._flags = np.concatenate([self._flags, flags])
+        self.n_in += data.shape[0]
+        # the metric of integration t needs the data up to t + 2 * Kt
+        metric = self._detrend(self.n_in - 2 * self.Kt)
+        new_flags = self._watershed(metric)
+        # later metric rows need the data from n_metric - 2 * Kt on
+        drop = max(self.n_metric - 2 * self.Kt - self._data_start, 0)
+        if drop > 0:
+            self._data = self._data[drop:]
+            self._flags = self._flags[drop:]
+            self._data_start += drop
+        return metric, new_flags
+
+    def finalize(self):
+        """Return the remaining rows at the end of a file, and reset the detrender.
+
+        Returns
+        -------
+        metric : array
+            The remaining metric rows, see add_integrations.
+        new_flags : array
+            The remaining flag rows, see add_integrations.
+        """
+        if self.n_in == 0:
+            metric, new_flags = np.zeros((0, 0)), np.zeros((0, 0), dtype=bool)
+        elif self.n_metric == 0:
+            # the whole file is buffered; this also handles files shorter than Kt
+            flags = self._flags if self._has_flags else None
+            metric = algorithm_dict[self.algorithm](self._data, flags=flags, Kt=self.Kt,
+                                                    Kf=self.Kf, **self.kwargs)
+            self.n_metric = self.n_in
+            new_flags = self._watershed(metric, final=True)
+        else:
+            metric = self._detrend(self.n_in, final=True)
+            new_flags = self._watershed(metric, final=True)
+        self.reset()
+        return metric, new_flags
+
+    def _detrend(self, stop, final=False):
+        """Calculate the metric of integrations n_metric to stop."""
+        Kt, Kf = self.Kt, self._Kf
+        start = self.n_metric
+        if stop <= start:
+            return np.zeros((0, self.Nfreqs), dtype=self._data.dtype)
+        # The padded rows needed for the metric of rows start to stop, as in
+        # _tiled_detrend. Their data indices are mirrored at the start of the file,
+        # and at its end if it is final.
+        Npadded = self.n_in + 2 * Kt if final else np.inf
+        rows = np.arange(max(start - Kt, 0), min(stop + 3 * Kt, Npadded)) - Kt
+        rows = np.where(rows < 0, -rows - 1, rows)
+        rows = np.where(rows >= self.n_in, 2 * self.n_in - rows - 1, rows) - self._data_start
+
+        def _pad(arr):
+            arr = arr[rows]
+            return np.concatenate([arr[:, Kf - 1::-1], arr, arr[:, :-Kf - 1:-1]], axis=1)
+
+        flags = _pad(self._flags) if self._has_flags else None
+        metric = _padded_detrenders[self.algorithm](_pad(self._data), flags, Kt, Kf,
+                                                    **self.kwargs)
+        r0 = max(start - Kt, 0)
+        self.n_metric = stop
+        return metric[start - r0:stop - r0]
+
+    def _watershed(self, metric, final=False):
+        """Watershed the new metric rows and return the flag rows which are final."""
+        t0 = self.n_metric - metric.shape[0]
+        seeds = metric >= self.nsig_init
+        if self._has_flags:
+            seeds |= self._flags[t0 - self._data_start:self.n_metric - self._data_start]
+        if self._metric is None:
+            self._metric, self._seeds = metric, seeds
+        else:
+            self._metric = np.concatenate([self._metric, metric])
+            self._seeds = np.concatenate([self._seeds, seeds])
+        if self._metric.shape[0] == 0:
+            return np.zeros((0, self.Nfreqs), dtype=bool)
+        # Flagged pixels in the last returned row stand in for all of the earlier
+        # connections to initial flags.
+        metric, seeds = self._metric, self._seeds
+        if self._context is not None:
+            metric = np.concatenate([np.full((1, self.Nfreqs), -np.inf), metric])
+            seeds = np.concatenate([self._context[np.newaxis], seeds])
+        labels, seeded = _ws_regions(metric, seeds, self.nsig_adj)
+        new_flags = seeded[labels]
+        if self._context is not None:
+            new_flags = new_flags[1:]
+            labels = labels[1:]
+        ndone = new_flags.shape[0]
+        if not final:
+            # regions without an initial flag which reach the latest row may still
+            # be connected to one in later integrations
+            pending = np.zeros_like(seeded)
+            pending[labels[-1]] = True
+            pending[0] = False
+            pending &= ~seeded
+            undecided = np.any(pending[labels], axis=1)
+            ndone = np.argmax(undecided) if np.any(undecided) else ndone
+            if self.max_flag_lag is not None:
+                ndone = max(ndone, new_flags.shape[0] - self.max_flag_lag)
+        if ndone > 0:
+            self._context = new_flags[ndone - 1]
+        self._metric = self._metric[ndone:]
+        self._seeds = self._seeds[ndone:]
+        self.n_flags += ndone
+        return new_flags[:ndone]
+
+
+@_profiled
 def flag(uvf_m, nsig_p=6., nsig_f=None, nsig_t=None, avg_method='quadmean',
-         run_check=True, check_extra=True, run_check_acceptability=True):
+         run_check=True, check_extra=True, run_check_acceptability=True, context=None):
     """Create a set of flags based on a "metric" type UVFlag object.
 
     Parameters
@@ -814,6 +2675,10 @@ def flag(uvf_m, nsig_p=6., nsig_f=None, nsig_t=None, avg_method='quadmean',
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    context : PipelineContext, optional
+        If given, its validation policy overrides run_check, check_extra and
+        run_check_acceptability, and the call is recorded as a stage of it.
+        Default is None.
 
     Returns
     -------
@@ -828,6 +2693,8 @@ def flag(uvf_m, nsig_p=6., nsig_f=None, nsig_t=None, avg_method='quadmean',
         is not recognized, a ValueError is raised.
 
     """
+    run_check, check_extra, run_check_acceptability = _context_checks(
+        context, run_check, check_extra, run_check_acceptability)
     # Check input
     if (not isinstance(uvf_m, UVFlag)) or (uvf_m.mode != 'metric'):
         raise ValueError('uvf_m must be UVFlag instance with mode == "metric."')
@@ -841,58 +2708,105 @@ def flag(uvf_m, nsig_p=6., nsig_f=None, nsig_t=None, avg_method='quadmean',
     if nsig_p is not None:
         uvf_f.flag_array[np.abs(uvf_m.metric_array) >= nsig_p] = True
 
+    if uvf_m.type not in ('baseline', 'antenna', 'waterfall'):
+        raise ValueError('Unknown UVFlag type: ' + uvf_m.type)
+    if nsig_f is None and nsig_t is None:
+        return uvf_f
+    # Channel and time collapses, in one pass over the metrics
+    t_inv, ntimes = None, None
+    if uvf_m.type == 'baseline':
+        ts, t_inv = np.unique(uvf_m.time_array, return_inverse=True)
+        ntimes = ts.size
+    freq_axis, time_axis = {'baseline': (2, 0), 'antenna': (2, 3),
+                            'waterfall': (1, 0)}[uvf_m.type]
+    fdata, tdata, _ = _collapse_marginals(uvf_m.metric_array, avg_method, freq_axis,
+                                          time_axis=time_axis, time_inv=t_inv, ntimes=ntimes,
+                                          weights=uvf_m.weights_array)
+
     if uvf_m.type == 'baseline':
         if nsig_f is not None:
             # Channel flagging
-            data = uvutils.collapse(uvf_m.metric_array, avg_method, axis=(0, 1, 3),
-                                    weights=uvf_m.weights_array)
-            indf = np.where(np.abs(data) >= nsig_f)[0]
+            indf = np.where(np.abs(fdata) >= nsig_f)[0]
             uvf_f.flag_array[:, :, indf, :] = True
         if nsig_t is not None:
             # Time flagging
-            ts = np.unique(uvf_m.time_array)
-            data = np.zeros(ts.size)
-            for ti, time in enumerate(ts):
-                data[ti] = uvutils.collapse(uvf_m.metric_array[uvf_m.time_array == time, 0, :, :],
-                                            avg_method,
-                                            weights=uvf_m.weights_array[uvf_m.time_array == time, 0, :, :])
-            indf = np.where(np.abs(data) >= nsig_t)[0]
-            for time in ts[indf]:
-                uvf_f.flag_array[uvf_f.time_array == time, :, :, :] = True
+            uvf_f.flag_array[(np.abs(tdata) >= nsig_t)[t_inv]] = True
     elif uvf_m.type == 'antenna':
         if nsig_f is not None:
             # Channel flag
-            data = uvutils.collapse(uvf_m.metric_array, avg_method, axis=(0, 1, 3, 4),
-                                    weights=uvf_m.weights_array)
-            indf = np.where(np.abs(data) >= nsig_f)[0]
+            indf = np.where(np.abs(fdata) >= nsig_f)[0]
             uvf_f.flag_array[:, :, indf, :, :] = True
         if nsig_t is not None:
             # Time watershed
-            data = uvutils.collapse(uvf_m.metric_array, avg_method, axis=(0, 1, 2, 4),
-                                    weights=uvf_m.weights_array)
-            indt = np.where(np.abs(data) >= nsig_t)[0]
+            indt = np.where(np.abs(tdata) >= nsig_t)[0]
             uvf_f.flag_array[:, :, :, indt, :] = True
     elif uvf_m.type == 'waterfall':
         if nsig_f is not None:
             # Channel flag
-            data = uvutils.collapse(uvf_m.metric_array, avg_method, axis=(0, 2),
-                                    weights=uvf_m.weights_array)
-            indf = np.where(np.abs(data) >= nsig_f)[0]
+            indf = np.where(np.abs(fdata) >= nsig_f)[0]
             uvf_f.flag_array[:, indf, :] = True
         if nsig_t is not None:
             # Time watershed
-            data = uvutils.collapse(uvf_m.metric_array, avg_method, axis=(1, 2),
-                                    weights=uvf_m.weights_array)
-            indt = np.where(np.abs(data) >= nsig_t)[0]
+            indt = np.where(np.abs(tdata) >= nsig_t)[0]
             uvf_f.flag_array[indt, :, :] = True
-    else:
-        raise ValueError('Unknown UVFlag type: ' + uvf_m.type)
     return uvf_f
 
 
+# the most middle positions _nanmedian partitions around at once; beyond this
+# np.nanmedian's loop over the rows is faster
+_NANMEDIAN_MAX_KTH = 32
+
+
+def _nanmedian(data, n_threads=None):
+    """Find the median of each row of a 2D array, ignoring nans.
+
+    This is np.nanmedian(data, axis=1). When the rows have few distinct numbers
+    of nans (e.g. nans only in flagged channels), all rows are partitioned in one
+    call (with the nans at their ends) around the middle positions of every row's
+    valid samples, instead of np.nanmedian's loop over the rows. A partition around
+    many positions is slower than the loop, so otherwise np.nanmedian is used.
+    Rows without any nans are reduced with np.median.
+
+    Parameters
+    ----------
+    data : array
+        2D real array.
+    n_threads : int, optional
+        The number of threads to reduce chunks of rows in. Default is None (serial).
+
+    Returns
+    -------
+    med : array
+        The median of each row, nan for rows without valid samples.
+    """
+    if n_threads is not None and n_threads > 1 and data.shape[0] > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        chunks = np.array_split(data, min(n_threads, data.shape[0]))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            return np.concatenate(list(executor.map(_nanmedian, chunks)))
+    nans = np.isnan(data)
+    if not nans.any():
+        return np.median(data, axis=1)
+    nvalid = data.shape[1] - np.sum(nans, axis=1)
+    lo = np.maximum((nvalid - 1) // 2, 0)
+    hi = np.minimum(nvalid // 2, data.shape[1] - 1)
+    kth = np.unique(np.concatenate([lo, hi]))
+    if len(kth) > _NANMEDIAN_MAX_KTH:
+        with warnings.catch_warnings():
+            # rows without valid samples are nan, as below
+            warnings.filterwarnings('ignore', message='All-NaN slice encountered')
+            return np.nanmedian(data, axis=1)
+    srt = np.partition(data, kth, axis=1)
+    lo = np.take_along_axis(srt, lo[:, None], axis=1)[:, 0]
+    hi = np.take_along_axis(srt, hi[:, None], axis=1)[:, 0]
+    med = np.mean([lo, hi], axis=0)
+    med[nvalid == 0] = np.nan
+    return med
+
+
 def threshold_wf(uvf_m, nsig_f=7., nsig_t=7., nsig_f_adj=3., nsig_t_adj=3.,
                  detrend=False, run_check=True, check_extra=True,
-                 run_check_acceptability=True):
+                 run_check_acceptability=True, n_threads=None):
     """Flag on a "waterfall" type UVFlag in "metric" mode.
 
     Use median to collapses to one dimension, thresholds, then broadcasts back to waterfall.
@@ -923,6 +2837,9 @@ def threshold_wf(uvf_m, nsig_f=7., nsig_t=7., nsig_f_adj=3., nsig_t_adj=3.,
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    n_threads : int, optional
+        The number of threads to find the medians of chunks of the waterfall in.
+        Default is None (serial).
 
     Returns
     -------
@@ -944,26 +2861,94 @@ def threshold_wf(uvf_m, nsig_f=7., nsig_t=7., nsig_f_adj=3., nsig_t_adj=3.,
     uvf_f = uvf_m.copy()
     uvf_f.to_flag(run_check=run_check, check_extra=check_extra,
                   run_check_acceptability=run_check_acceptability)
-    # Mask invalid values. Masked medians are slow, but these are done only on waterfalls.
-    data = np.ma.masked_array(uvf_m.metric_array, ~np.isfinite(uvf_m.metric_array))
-    # Collapse to 1D and calculate z scores
-    spec = np.ma.median(data, axis=(0, 2))
-    # NB: The zscore calculation does not recognize the masked above.
-    zspec = modzscore_1d(spec, detrend=detrend)
-    tseries = np.ma.median(data, axis=(1, 2))
-    ztseries = modzscore_1d(tseries, detrend=detrend)
+    # Ignore invalid values, and collapse to 1D
+    data = np.where(np.isfinite(uvf_m.metric_array), uvf_m.metric_array, np.nan)
+    spec = _nanmedian(np.moveaxis(data, 1, 0).reshape(data.shape[1], -1), n_threads=n_threads)
+    tseries = _nanmedian(data.reshape(data.shape[0], -1), n_threads=n_threads)
+    # Calculate z scores, ignoring fully flagged channels and integrations
+    zspec = modzscore_1d(spec, flags=np.isnan(spec), detrend=detrend)
+    ztseries = modzscore_1d(tseries, flags=np.isnan(tseries), detrend=detrend)
     # Flag based on zscores and thresholds
     f_flags = _ws_flag_waterfall(np.abs(zspec), np.abs(zspec) >= nsig_f, nsig=nsig_f_adj)
     uvf_f.flag_array[:, f_flags, :] = True
     t_flags = _ws_flag_waterfall(np.abs(ztseries), np.abs(ztseries) >= nsig_t, nsig=nsig_t_adj)
     uvf_f.flag_array[t_flags, :, :] = True
 
-    return uvf_f
+    return uvf_f
+
+
+def _waterfall_probe(uv):
+    """Return a metadata-only copy of uv with the samples of a single waterfall.
+
+    A UVData object keeps one baseline-time for each time (with a flag_array for
+    them), and a UVCal object keeps one antenna, so that UVFlag.to_baseline and
+    UVFlag.to_antenna can match a waterfall UVFlag object to the probe without
+    broadcasting it to every baseline or antenna of uv.
+
+    Parameters
+    ----------
+    uv : UVData or UVCal
+        The object the flags are being applied to.
+
+    Returns
+    -------
+    probe : UVData or UVCal
+        The reduced, metadata-only copy of uv.
+    """
+    probe = uv.copy(metadata_only=True)
+    if issubclass(uv.__class__, UVData):
+        probe.select(blt_inds=np.unique(uv.time_array, return_index=True)[1], run_check=False)
+        probe.flag_array = np.zeros((probe.Nblts,) + uv.flag_array.shape[1:], dtype=bool)
+    else:
+        probe.select(antenna_nums=uv.ant_array[:1], run_check=False)
+    return probe
+
 
+def _or_waterfall_flags(wf_flags, uvf, probe, uv_times, force_pol=False):
+    """OR the flags of a waterfall UVFlag into flags on the times of a UVData or UVCal.
+
+    The flags are matched to the data by UVFlag.to_baseline or UVFlag.to_antenna
+    on a copy of uvf and the probe of the data, so pyuvdata checks that they are
+    compatible. They are ORed in without broadcasting them to baselines or antennas.
+
+    Parameters
+    ----------
+    wf_flags : array of bool
+        The (Ntimes, Nfreqs, Npols) flags on the times of uv, ORed into in place.
+    uvf : UVFlag
+        A waterfall UVFlag object in "flag" mode.
+    probe : UVData or UVCal
+        The probe of the object the flags are being applied to, from _waterfall_probe.
+    uv_times : array of float
+        The unique times of a UVData object, or the times of a UVCal object.
+    force_pol : bool, optional
+        If True, will use 1 pol to broadcast to any other pol. If False, will
+        require polarizations to match. Default is False.
 
+    Raises
+    ------
+    ValueError:
+        If UVFlag.to_baseline or UVFlag.to_antenna find that uvf does not match
+        the data, if uvf has times that a UVData object does not, or if uvf does
+        not have the times of a UVCal object.
+    """
+    uvf = uvf.copy()
+    if issubclass(probe.__class__, UVData):
+        probe = probe.select(times=np.unique(uvf.time_array), inplace=False, run_check=False)
+        uvf.to_baseline(probe, force_pol=force_pol, run_check=False)
+        flags = uvf.flag_array.reshape((probe.Nblts,) + uvf.flag_array.shape[-2:])
+        wf_flags[np.searchsorted(uv_times, probe.time_array)] |= flags
+        return
+    if uvf._time_array != probe._time_array:
+        raise ValueError('The UVFlag object does not have the times of uv.')
+    uvf.to_antenna(probe, force_pol=force_pol, run_check=False)
+    wf_flags |= np.swapaxes(uvf.flag_array.reshape(uvf.flag_array.shape[-3:]), 0, 1)
+
+
+@_profiled
 def flag_apply(uvf, uv, keep_existing=True, force_pol=False, history='',
                return_net_flags=False, run_check=True,
-               check_extra=True, run_check_acceptability=True):
+               check_extra=True, run_check_acceptability=True, product=None, context=None):
     """Apply flags from UVFlag or list of UVFlag objects to UVData or UVCal.
 
     Parameters
@@ -993,6 +2978,13 @@ def flag_apply(uvf, uv, keep_existing=True, force_pol=False, history='',
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    product : str, optional
+        The product to read from the paths in uvf, if they are container files
+        written by FlagsContainerWriter. Default is None.
+    context : PipelineContext, optional
+        If given, its validation policy overrides run_check, check_extra and
+        run_check_acceptability, and the call is recorded as a stage of it.
+        Default is None.
 
     Returns
     -------
@@ -1007,6 +2999,8 @@ def flag_apply(uvf, uv, keep_existing=True, force_pol=False, history='',
         a ValueError is raised.
 
     """
+    run_check, check_extra, run_check_acceptability = _context_checks(
+        context, run_check, check_extra, run_check_acceptability)
     if issubclass(uv.__class__, UVData):
         expected_type = 'baseline'
     elif issubclass(uv.__class__, UVCal):
@@ -1015,30 +3009,57 @@ def flag_apply(uvf, uv, keep_existing=True, force_pol=False, history='',
         raise ValueError('Flags can only be applied to UVData or UVCal objects.')
     if not isinstance(uvf, (list, tuple, np.ndarray)):
         uvf = [uvf]
-    net_flags = UVFlag(uv, mode='flag', copy_flags=keep_existing, history=history)
+    if return_net_flags:
+        net_flags = UVFlag(uv, mode='flag', copy_flags=keep_existing, history=history)
+    if keep_existing:
+        net = uv.flag_array.copy()
+    else:
+        net = np.zeros(uv.flag_array.shape, dtype=bool)
+    # Waterfalls are ORed together at waterfall resolution, on the unique
+    # times of uv, and broadcast to the baselines or antennas only once.
+    if expected_type == 'baseline':
+        uv_times, t_inv = np.unique(uv.time_array, return_inverse=True)
+        npols = uv.Npols
+    else:
+        uv_times = uv.time_array
+        npols = uv.Njones
+    wf_net = None
     for uvf_i in uvf:
         if isinstance(uvf_i, str):
-            uvf_i = UVFlag(uvf_i)  # Read file
+            uvf_i = read_flags(uvf_i, product=product)  # Read file
         elif not isinstance(uvf_i, UVFlag):
             raise ValueError('Input to apply_flag must be UVFlag or path to UVFlag file.')
         if uvf_i.mode != 'flag':
             raise ValueError('UVFlag objects must be in mode "flag" to apply to data.')
+        uvf_history = uvf_i.history
         if uvf_i.type == 'waterfall':
-            uvf_i = uvf_i.copy()  # don't change the input object
-            if expected_type == 'baseline':
-                uvf_i.to_baseline(uv, force_pol=force_pol, run_check=run_check,
-                                  check_extra=check_extra,
-                                  run_check_acceptability=run_check_acceptability)
-            else:
-                uvf_i.to_antenna(uv, force_pol=force_pol, run_check=run_check,
-                                 check_extra=check_extra,
-                                 run_check_acceptability=run_check_acceptability)
-        # Use built-in or function
-        net_flags |= uvf_i
-    uv.flag_array += net_flags.flag_array
+            if wf_net is None:
+                wf_net = np.zeros((uv_times.size, uv.Nfreqs, npols), dtype=bool)
+                probe = _waterfall_probe(uv)
+            _or_waterfall_flags(wf_net, uvf_i, probe, uv_times, force_pol=force_pol)
+            # as the UVFlag to_baseline and to_antenna methods do
+            uvf_history += 'Broadcast to type "{}". '.format(expected_type)
+            uvf_history = _history_with_version(uvf_history, uvf_i)
+        else:
+            net |= uvf_i.flag_array
+        if return_net_flags and uvf_history not in net_flags.history:
+            # as the UVFlag "or" operator does
+            net_flags.history += "Flags OR'd with: " + uvf_history
+    if wf_net is not None:
+        if expected_type == 'baseline':
+            wf_net = wf_net[t_inv].reshape(uv.flag_array.shape)
+        else:
+            wf_net = np.broadcast_to(np.swapaxes(wf_net, 0, 1), uv.flag_array.shape)
+        net |= wf_net
+    uv.flag_array += net
     uv.history += 'FLAGGING HISTORY: ' + history + ' END OF FLAGGING HISTORY.'
 
     if return_net_flags:
+        net_flags.flag_array = net
+        net_flags.history = _history_with_version(net_flags.history, net_flags)
+        if run_check:
+            net_flags.check(check_extra=check_extra,
+                            run_check_acceptability=run_check_acceptability)
         return net_flags
 
 
@@ -1047,9 +3068,13 @@ def flag_apply(uvf, uv, keep_existing=True, force_pol=False, history='',
 #############################################################################
 
 def calculate_metric(uv, algorithm, cal_mode='gain', run_check=True,
-                     check_extra=True, run_check_acceptability=True, **kwargs):
+                     check_extra=True, run_check_acceptability=True, batch_size=None, dtype=None,
+                     **kwargs):
     """Make a UVFlag object of mode 'metric' from a UVData or UVCal object.
 
+    The waterfalls of all baselines (or antennas) and polarizations are stacked
+    and passed to the algorithm together, rather than one at a time.
+
     Parameters
     ----------
     uv : UVData or UVCal
@@ -1068,8 +3093,23 @@ def calculate_metric(uv, algorithm, cal_mode='gain', run_check=True,
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    batch_size : int, optional
+        The maximum number of (Ntimes, Nfreqs) waterfalls passed to the algorithm
+        in a single call. Baselines or antennas are never split across calls, so a
+        batch holds at least all polarizations of one of them. Smaller values
+        reduce the memory overhead. Default is None, which processes the whole
+        object at once.
+    dtype : numpy floating point type, optional
+        The precision of the metric and weights arrays, and of the data passed to
+        the algorithm (which computes in the precision of its input). For
+        example, np.float32 halves the memory and bandwidth of the metric
+        calculation. Default is None, which passes the data in their native
+        precision and uses float64 metrics and weights.
     **kwargs : dict
-        A dictionary of Keyword arguments that are passed to algorithm.
+        A dictionary of Keyword arguments that are passed to algorithm. For the
+        algorithms which take a workspace (detrend_medfilt, detrend_masked_medfilt
+        and detrend_meanfilt), one is created and reused for all batches unless
+        given here.
 
     Returns
     -------
@@ -1093,42 +3133,92 @@ def calculate_metric(uv, algorithm, cal_mode='gain', run_check=True,
         alg_func = algorithm_dict[algorithm]
     except KeyError:
         raise KeyError('Algorithm not found in list of available functions.')
+    workspace = None
+    if algorithm in _padded_detrenders:
+        # reuse the scratch arrays of the algorithm across batches
+        workspace = kwargs.pop('workspace', None)
+        workspace = Workspace() if workspace is None else workspace
+
+    def _alg_func(data, flags, alg_kwargs=kwargs):
+        if workspace is None:
+            return alg_func(data, flags=flags, **alg_kwargs)
+        out = None
+        if np.issubdtype(data.dtype, np.floating):
+            out = workspace.get('metric', data.shape, data.dtype)
+        return alg_func(data, flags=flags, workspace=workspace, out=out, **alg_kwargs)
+
     uvf = UVFlag(uv)
+    uvf.weights_array = np.logical_not(uv.flag_array).astype(np.float if dtype is None else dtype)
     if issubclass(uv.__class__, UVData):
-        uvf.weights_array = uv.nsample_array * np.logical_not(uv.flag_array).astype(np.float)
-    else:
-        uvf.weights_array = np.logical_not(uv.flag_array).astype(np.float)
+        uvf.weights_array *= uv.nsample_array
+    if dtype is not None:
+        uvf.metric_array = uvf.metric_array.astype(dtype)
     if issubclass(uv.__class__, UVData):
-        for key, data in uv.antpairpol_iter():
-            ind1, ind2, pol = uv._key2inds(key)
-            for ind, ipol in zip((ind1, ind2), pol):
-                if len(ind) == 0:
-                    continue
-                flags = uv.flag_array[ind, 0, :, ipol]
-                uvf.metric_array[ind, 0, :, ipol] = alg_func(np.abs(data), flags=flags, **kwargs)
+        # Stack the baselines which have the same number of times.
+        for blt_inds in _baseline_groups(uv.baseline_array):
+            ntimes = blt_inds.shape[1]
+            nbls = len(blt_inds) if batch_size is None else max(1, batch_size // uv.Npols)
+            for b0 in range(0, len(blt_inds), nbls):
+                inds = blt_inds[b0:b0 + nbls]
+                # (Nbls, Ntimes, Nfreqs, Npols) -> (Nbls * Npols, Ntimes, Nfreqs)
+                shape = (-1, ntimes, uv.Nfreqs)
+                data = np.abs(uv.data_array[inds, 0]).transpose(0, 3, 1, 2).reshape(shape)
+                data = data.astype(dtype, copy=False) if dtype is not None else data
+                flags = uv.flag_array[inds, 0].transpose(0, 3, 1, 2).reshape(shape)
+                metric = np.broadcast_to(_alg_func(data, flags), data.shape)
+                metric = metric.reshape(len(inds), uv.Npols, ntimes, uv.Nfreqs)
+                uvf.metric_array[inds, 0] = metric.transpose(0, 2, 3, 1)
     elif issubclass(uv.__class__, UVCal):
+        # Note transposes are due to freq, time dimensions rather than the
+        # expected time, freq
         if cal_mode == 'tot_chisq':
             uvf.to_waterfall(run_check=run_check,
                              check_extra=check_extra,
                              run_check_acceptability=run_check_acceptability)
-            for pi in range(uv.Njones):
-                data = np.abs(uv.total_quality_array[0, :, :, pi].T)
-                flags = np.all(uv.flag_array[:, 0, :, :, pi], axis=0).T
-                uvf.metric_array[:, :, pi] = alg_func(data, flags=flags, **kwargs)
+            # (Nfreqs, Ntimes, Njones) -> (Njones, Ntimes, Nfreqs)
+            data = np.abs(uv.total_quality_array[0]).transpose(2, 1, 0)
+            data = data.astype(dtype, copy=False) if dtype is not None else data
+            flags = np.all(uv.flag_array[:, 0], axis=0).transpose(2, 1, 0)
+            metric = np.broadcast_to(_alg_func(data, flags), data.shape)
+            uvf.metric_array[:, :, :] = metric.transpose(1, 2, 0)
         else:
-            for ai in range(uv.Nants_data):
-                for pi in range(uv.Njones):
-                    # Note transposes are due to freq, time dimensions rather than the
-                    # expected time, freq
-                    flags = uv.flag_array[ai, 0, :, :, pi].T
-                    if cal_mode == 'gain':
-                        data = np.abs(uv.gain_array[ai, 0, :, :, pi].T)
-                    elif cal_mode == 'chisq':
-                        data = np.abs(uv.quality_array[ai, 0, :, :, pi].T)
-                    else:
-                        raise ValueError('When calculating metric for UVCal object, '
-                                         'cal_mode must be "gain", "chisq", or "tot_chisq".')
-                    uvf.metric_array[ai, 0, :, :, pi] = alg_func(data, flags=flags, **kwargs).T
+            if cal_mode == 'gain':
+                arr = uv.gain_array
+            elif cal_mode == 'chisq':
+                arr = uv.quality_array
+            else:
+                raise ValueError('When calculating metric for UVCal object, '
+                                 'cal_mode must be "gain", "chisq", or "tot_chisq".')
+            # The median detrenders treat both axes of a waterfall alike, so they
+            # can detrend the (Nfreqs, Ntimes) waterfalls of the native layout with
+            # their kernel sizes swapped, instead of transposed copies of them.
+            # (Mean filters round differently along the two axes.)
+            native = (algorithm in _padded_detrenders and algorithm != 'detrend_meanfilt'
+                      and kwargs.get('backend') != 'sat')
+            if native:
+                alg_kwargs = dict(kwargs, Kt=kwargs.get('Kf', 8), Kf=kwargs.get('Kt', 8))
+            nants = uv.Nants_data if batch_size is None else max(1, batch_size // uv.Njones)
+            for a0 in range(0, uv.Nants_data, nants):
+                a1 = min(a0 + nants, uv.Nants_data)
+                if native:
+                    # (Nants, Nfreqs, Ntimes, Njones) -> (Nants * Njones, Nfreqs, Ntimes)
+                    shape = (-1, uv.Nfreqs, uv.Ntimes)
+                    block = np.moveaxis(arr[a0:a1, 0], -1, 1)
+                    data = np.empty(block.shape, dtype=arr.real.dtype if dtype is None else dtype)
+                    data = np.abs(block, out=data).reshape(shape)
+                    flags = np.moveaxis(uv.flag_array[a0:a1, 0], -1, 1).reshape(shape)
+                    metric = np.broadcast_to(_alg_func(data, flags, alg_kwargs), data.shape)
+                    metric = metric.reshape(a1 - a0, uv.Njones, uv.Nfreqs, uv.Ntimes)
+                    uvf.metric_array[a0:a1, 0] = np.moveaxis(metric, 1, -1)
+                    continue
+                # (Nants, Nfreqs, Ntimes, Njones) -> (Nants * Njones, Ntimes, Nfreqs)
+                shape = (-1, uv.Ntimes, uv.Nfreqs)
+                data = np.abs(arr[a0:a1, 0]).transpose(0, 3, 2, 1).reshape(shape)
+                data = data.astype(dtype, copy=False) if dtype is not None else data
+                flags = uv.flag_array[a0:a1, 0].transpose(0, 3, 2, 1).reshape(shape)
+                metric = np.broadcast_to(_alg_func(data, flags), data.shape)
+                metric = metric.reshape(a1 - a0, uv.Njones, uv.Ntimes, uv.Nfreqs)
+                uvf.metric_array[a0:a1, 0] = metric.transpose(0, 3, 2, 1)
     if run_check:
         uvf.check(check_extra=check_extra,
                   run_check_acceptability=run_check_acceptability)
@@ -1141,10 +3231,22 @@ def calculate_metric(uv, algorithm, cal_mode='gain', run_check=True,
 #         they should stick around with more descriptive names.
 #############################################################################
 
+def _reset_weights(uvf_m, dtype=None):
+    """Set the weights of a waterfall metric to 1 (with data) or 0 (no data).
+
+    The weights array, and the metric array if dtype is given, are also set to
+    the requested precision, since collapsing to a waterfall can promote them.
+    """
+    wdtype = np.float if dtype is None else dtype
+    uvf_m.weights_array = uvf_m.weights_array.astype(np.bool).astype(wdtype)
+    if dtype is not None:
+        uvf_m.metric_array = uvf_m.metric_array.astype(dtype, copy=False)
+
+
 def xrfi_h1c_pipe(uv, Kt=8, Kf=8, sig_init=6., sig_adj=2., px_threshold=0.2,
                   freq_threshold=0.5, time_threshold=0.05, return_summary=False,
                   cal_mode='gain', run_check=True, check_extra=True,
-                  run_check_acceptability=True):
+                  run_check_acceptability=True, dtype=None):
     """Run the xrfi excision pipeline we used for H1C.
 
     This pipeline uses the detrending and watershed algorithms above.
@@ -1186,6 +3288,9 @@ def xrfi_h1c_pipe(uv, Kt=8, Kf=8, sig_init=6., sig_adj=2., px_threshold=0.2,
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    dtype : numpy floating point type, optional
+        The precision of the metric calculation, see calculate_metric. Default
+        is None (float64 metrics).
 
     Returns
     -------
@@ -1198,7 +3303,7 @@ def xrfi_h1c_pipe(uv, Kt=8, Kf=8, sig_init=6., sig_adj=2., px_threshold=0.2,
 
     """
     uvf = calculate_metric(uv, 'detrend_medfilt', Kt=Kt, Kf=Kf, cal_mode=cal_mode,
-                           run_check=run_check, check_extra=check_extra,
+                           dtype=dtype, run_check=run_check, check_extra=check_extra,
                            run_check_acceptability=run_check_acceptability)
     uvf_f = flag(uvf, nsig_p=sig_init, nsig_f=None, nsig_t=None,
                  run_check=run_check, check_extra=check_extra,
@@ -1222,9 +3327,11 @@ def xrfi_h1c_pipe(uv, Kt=8, Kf=8, sig_init=6., sig_adj=2., px_threshold=0.2,
         return uvf_f, uvf_wf
 
 
+@_profiled
 def xrfi_pipe(uv, alg='detrend_medfilt', Kt=8, Kf=8, xants=[], cal_mode='gain',
               wf_method='quadmean', sig_init=6.0, sig_adj=2.0, label='',
-              run_check=True, check_extra=True, run_check_acceptability=True):
+              run_check=True, check_extra=True, run_check_acceptability=True, dtype=None,
+              n_threads=None, context=None):
     """Run the xrfi excision pipeline used for H1C IDR2.2.
 
     This pipeline uses the detrending and watershed algorithms above.
@@ -1263,6 +3370,18 @@ def xrfi_pipe(uv, alg='detrend_medfilt', Kt=8, Kf=8, xants=[], cal_mode='gain',
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    dtype : numpy floating point type, optional
+        The precision of the metric and weights arrays, see calculate_metric.
+        Default is None (float64).
+    n_threads : int, optional
+        The number of threads the detrending algorithm uses for tiles of each
+        waterfall (see detrend_medfilt). Only supported by the detrend_medfilt,
+        detrend_masked_medfilt and detrend_meanfilt algorithms. Default is None
+        (serial).
+    context : PipelineContext, optional
+        If given, its validation policy overrides run_check, check_extra and
+        run_check_acceptability, and the call is recorded as a stage of it.
+        Default is None.
 
     Returns
     -------
@@ -1273,40 +3392,58 @@ def xrfi_pipe(uv, alg='detrend_medfilt', Kt=8, Kf=8, xants=[], cal_mode='gain',
         A UVFlag object with flags after watershed.
 
     """
+    run_check, check_extra, run_check_acceptability = _context_checks(
+        context, run_check, check_extra, run_check_acceptability)
     flag_xants(uv, xants, run_check=run_check,
                check_extra=check_extra,
                run_check_acceptability=run_check_acceptability)
-    uvf_m = calculate_metric(uv, alg, Kt=Kt, Kf=Kf, cal_mode=cal_mode,
+    # only pass n_threads on if requested, so other algorithms can still be used
+    alg_kwargs = {} if n_threads is None else {'n_threads': n_threads}
+    uvf_m = calculate_metric(uv, alg, Kt=Kt, Kf=Kf, cal_mode=cal_mode, dtype=dtype,
                              run_check=run_check, check_extra=check_extra,
-                             run_check_acceptability=run_check_acceptability)
+                             run_check_acceptability=run_check_acceptability,
+                             **alg_kwargs)
     uvf_m.label = label
     uvf_m.to_waterfall(method=wf_method, keep_pol=False,
                        run_check=run_check, check_extra=check_extra,
                        run_check_acceptability=run_check_acceptability)
+    uvf_fws = _flag_metric_waterfall(uvf_m, alg=alg, Kt=Kt, Kf=Kf, sig_init=sig_init,
+                                     sig_adj=sig_adj, dtype=dtype, alg_kwargs=alg_kwargs,
+                                     context=context, run_check=run_check,
+                                     check_extra=check_extra,
+                                     run_check_acceptability=run_check_acceptability)
+    return uvf_m, uvf_fws
+
+
+def _flag_metric_waterfall(uvf_m, alg='detrend_medfilt', Kt=8, Kf=8, sig_init=6.0,
+                           sig_adj=2.0, dtype=None, alg_kwargs={}, context=None,
+                           run_check=True, check_extra=True, run_check_acceptability=True):
+    """Detrend the waterfall metric of xrfi_pipe in place, and flag and watershed it."""
     # This next line resets the weights to 1 (with data) or 0 (no data) to equally
     # combine with the other metrics.
-    uvf_m.weights_array = uvf_m.weights_array.astype(np.bool).astype(np.float)
+    _reset_weights(uvf_m, dtype=dtype)
     alg_func = algorithm_dict[alg]
     # Pass the z-scores through the filter again to get a zero-centered, width-of-one distribution.
     uvf_m.metric_array[:, :, 0] = alg_func(uvf_m.metric_array[:, :, 0],
                                            flags=~(uvf_m.weights_array[:, :, 0].astype(np.bool)),
-                                           Kt=Kt, Kf=Kf)
+                                           Kt=Kt, Kf=Kf, **alg_kwargs)
     # Flag and watershed on each data product individually.
     # That is, on each complete file (e.g. calibration gains), not on individual
     # antennas/baselines. We don't broadcast until the very end.
-    uvf_f = flag(uvf_m, nsig_p=sig_init, run_check=run_check,
+    uvf_f = flag(uvf_m, nsig_p=sig_init, context=context, run_check=run_check,
                  check_extra=check_extra,
                  run_check_acceptability=run_check_acceptability)
-    uvf_fws = watershed_flag(uvf_m, uvf_f, nsig_p=sig_adj, inplace=False,
+    uvf_fws = watershed_flag(uvf_m, uvf_f, nsig_p=sig_adj, inplace=False, context=context,
                              run_check=run_check, check_extra=check_extra,
                              run_check_acceptability=run_check_acceptability)
     uvf_fws.label += ' Flags.'
-    return uvf_m, uvf_fws
+    return uvf_fws
 
 
+@_profiled
 def chi_sq_pipe(uv, alg='zscore_full_array', modified=False, sig_init=6.0,
                 sig_adj=2.0, label='', run_check=True,
-                check_extra=True, run_check_acceptability=True):
+                check_extra=True, run_check_acceptability=True, dtype=None, context=None):
     """Zero-center and normalize the full total chi squared array, flag, and watershed.
 
     Parameters
@@ -1331,6 +3468,13 @@ def chi_sq_pipe(uv, alg='zscore_full_array', modified=False, sig_init=6.0,
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    dtype : numpy floating point type, optional
+        The precision of the metric and weights arrays, see calculate_metric.
+        Default is None (float64).
+    context : PipelineContext, optional
+        If given, its validation policy overrides run_check, check_extra and
+        run_check_acceptability, and the call is recorded as a stage of it.
+        Default is None.
 
     Returns
     -------
@@ -1341,7 +3485,9 @@ def chi_sq_pipe(uv, alg='zscore_full_array', modified=False, sig_init=6.0,
         A UVFlag object with flags after watershed.
 
     """
-    uvf_m = calculate_metric(uv, alg, cal_mode='tot_chisq', modified=modified,
+    run_check, check_extra, run_check_acceptability = _context_checks(
+        context, run_check, check_extra, run_check_acceptability)
+    uvf_m = calculate_metric(uv, alg, cal_mode='tot_chisq', modified=modified, dtype=dtype,
                              run_check=run_check, check_extra=check_extra,
                              run_check_acceptability=run_check_acceptability)
     uvf_m.label = label
@@ -1350,21 +3496,241 @@ def chi_sq_pipe(uv, alg='zscore_full_array', modified=False, sig_init=6.0,
                        run_check_acceptability=run_check_acceptability)
     # This next line resets the weights to 1 (with data) or 0 (no data) to equally
     # combine with the other metrics.
-    uvf_m.weights_array = uvf_m.weights_array.astype(np.bool).astype(np.float)
+    _reset_weights(uvf_m, dtype=dtype)
     alg_func = algorithm_dict[alg]
     # Pass the z-scores through the filter again to get a zero-centered, width-of-one distribution.
     uvf_m.metric_array[:, :, 0] = alg_func(uvf_m.metric_array[:, :, 0], modified=modified,
                                            flags=~(uvf_m.weights_array[:, :, 0].astype(np.bool)))
     # Flag and watershed on waterfall
-    uvf_f = flag(uvf_m, nsig_p=sig_init, run_check=run_check,
+    uvf_f = flag(uvf_m, nsig_p=sig_init, context=context, run_check=run_check,
                  check_extra=check_extra,
                  run_check_acceptability=run_check_acceptability)
-    uvf_fws = watershed_flag(uvf_m, uvf_f, nsig_p=sig_adj, inplace=False,
+    uvf_fws = watershed_flag(uvf_m, uvf_f, nsig_p=sig_adj, inplace=False, context=context,
                              run_check=run_check, check_extra=check_extra,
                              run_check_acceptability=run_check_acceptability)
     uvf_fws.label += ' Flags.'
     return uvf_m, uvf_fws
 
+
+def _check_uvh5(filename):
+    """Raise a ValueError if filename exists but is not an HDF5 (uvh5) file.
+
+    Files are only read in chunks of baselines from uvh5 files.
+    """
+    if os.path.exists(filename) and not h5py.is_hdf5(filename):
+        raise ValueError('{} is not a uvh5 file, which reading it in chunks of baselines '
+                         'requires.'.format(filename))
+
+
+def _metric_waterfall_chunked(filename, algorithm, chunk_size, uvf_flags=None, ant_str=None,
+                              wf_method='quadmean', dtype=None, read_check=True, run_check=True,
+                              check_extra=True, run_check_acceptability=True, **kwargs):
+    """Calculate the single pol waterfall metric of a visibility file, chunk by chunk.
+
+    This reads chunk_size baselines of the file at a time, applies uvf_flags to
+    them and calculates their metric. The collapse to a waterfall is accumulated
+    over the chunks, so the result matches reading the whole file, applying the
+    flags, calculate_metric and to_waterfall(method=wf_method, keep_pol=False)
+    up to the rounding of the sums, while only one chunk is held in memory.
+
+    Parameters
+    ----------
+    filename : str
+        The uvh5 file to read, which is read partially for each chunk.
+    algorithm : str
+        The metric algorithm name, see calculate_metric.
+    chunk_size : int
+        The number of baselines to read at a time.
+    uvf_flags : UVFlag, optional
+        Flags to apply to each chunk with force_pol, see flag_apply.
+        Default is None (only the flags in the file).
+    ant_str : str, optional
+        ant_str to select the baselines and polarizations to use, see UVData.select.
+        Default is None (all baselines).
+    wf_method : {"quadmean", "absmean", "mean"}, optional
+        How to collapse the baselines and polarizations to a waterfall.
+        Default is "quadmean".
+    dtype : numpy floating point type, optional
+        The precision of the metric calculation, see calculate_metric.
+        Default is None (float64).
+    read_check : bool, optional
+        Option to check the UVData object of each chunk as it is read.
+        Default is True.
+    run_check : bool
+        Option to check for the existence and proper shapes of parameters
+        on UVFlag Object.
+    check_extra : bool
+        Option to check optional parameters as well as required ones.
+    run_check_acceptability : bool
+        Option to check acceptable range of the values of parameters
+        on UVFlag Object.
+    **kwargs : dict
+        Keyword arguments passed to calculate_metric and the algorithm.
+
+    Returns
+    -------
+    uvf_m : UVFlag object
+        A waterfall UVFlag of mode 'metric' with a single (collapsed) pol.
+
+    Raises
+    ------
+    ValueError:
+        If wf_method is not one of the methods above, chunk_size is not positive
+        or filename is not a uvh5 file.
+
+    """
+    transforms = {'mean': lambda d: d, 'absmean': np.abs, 'quadmean': lambda d: np.abs(d) ** 2}
+    if wf_method not in transforms:
+        raise ValueError('wf_method must be one of {}.'.format(', '.join(transforms)))
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be a positive number of baselines.')
+    _check_uvh5(filename)
+    checks = {'run_check': run_check, 'check_extra': check_extra,
+              'run_check_acceptability': run_check_acceptability}
+    reads = {'run_check': read_check, 'check_extra': check_extra,
+             'run_check_acceptability': run_check_acceptability}
+    meta = UVData()
+    meta.read(filename, read_data=False, **reads)
+    if ant_str is not None:
+        meta.select(ant_str=ant_str)
+    antpairs = meta.get_antpairs()
+    pols = meta.get_pols() if ant_str is not None else None
+    times, ri = np.unique(meta.time_array, return_index=True)
+    lsts = meta.lst_array[ri]
+    nfreqs = meta.Nfreqs
+    del meta
+
+    sums = np.zeros((times.size, nfreqs))
+    wsums = np.zeros((times.size, nfreqs))
+    uvf_m = None
+    for b0 in range(0, len(antpairs), chunk_size):
+        uv = UVData()
+        uv.read(filename, bls=antpairs[b0:b0 + chunk_size], polarizations=pols, **reads)
+        if uvf_flags is not None:
+            flag_apply(uvf_flags, uv, keep_existing=True, force_pol=True, **checks)
+        uvf = calculate_metric(uv, algorithm, dtype=dtype, **checks, **kwargs)
+        del uv
+        if uvf.Npols > 1:
+            uvf.collapse_pol(method=wf_method, **checks)
+        # As in uvutils.mean_collapse, infs get zero weight.
+        metric = uvf.metric_array[:, 0, :, 0]
+        weights = uvf.weights_array[:, 0, :, 0] * ~np.isinf(metric)
+        metric = np.where(np.isinf(metric), 0, transforms[wf_method](metric))
+        # sum over the baselines of each time
+        t_inds = np.searchsorted(times, uvf.time_array)
+        order = np.argsort(t_inds, kind='stable')
+        starts = np.flatnonzero(np.diff(t_inds[order], prepend=-1))
+        sums[t_inds[order][starts]] += np.add.reduceat((weights * metric)[order], starts, axis=0)
+        wsums[t_inds[order][starts]] += np.add.reduceat(weights[order], starts, axis=0)
+        if uvf_m is None:
+            # The first chunk provides the metadata (and history) of the waterfall.
+            uvf.to_waterfall(method=wf_method, keep_pol=False, **checks)
+            uvf_m = uvf
+        del uvf
+
+    uvf_m.time_array = times
+    uvf_m.lst_array = lsts
+    uvf_m.Ntimes = times.size
+    where = wsums > 1e-10
+    metric = np.true_divide(sums, wsums, where=where, out=np.zeros_like(sums))
+    if wf_method == 'quadmean':
+        metric = np.sqrt(metric)
+    uvf_m.metric_array = np.where(where, metric, np.inf)[:, :, np.newaxis]
+    uvf_m.weights_array = wsums[:, :, np.newaxis]
+    if run_check:
+        uvf_m.check(check_extra=check_extra, run_check_acceptability=run_check_acceptability)
+    return uvf_m
+
+
+@_profiled
+def xrfi_pipe_chunked(filename, uvf_flags=None, chunk_size=100, ant_str=None,
+                      alg='detrend_meanfilt', Kt=8, Kf=8, wf_method='quadmean', sig_init=6.0,
+                      sig_adj=2.0, label='', dtype=None, n_threads=None, context=None,
+                      run_check=True, check_extra=True, run_check_acceptability=True):
+    """Run xrfi_pipe on a visibility file, reading a chunk of baselines at a time.
+
+    The metric is calculated on chunk_size baselines at a time and accumulated
+    into the waterfall, so the peak memory is set by the chunk size rather than
+    the size of the file. The results match reading the file, applying
+    uvf_flags and running xrfi_pipe on it, up to rounding.
+
+    Parameters
+    ----------
+    filename : str
+        The uvh5 file to flag.
+    uvf_flags : UVFlag, optional
+        Flags to apply to the data before calculating the metric, with force_pol.
+        Default is None (only the flags in the file).
+    chunk_size : int, optional
+        The number of baselines to read at a time. Default is 100.
+    ant_str : str, optional
+        ant_str to select the baselines and polarizations to use, see UVData.select.
+        Default is None (all baselines).
+    alg : str, optional
+        The algorithm for calculating the metric. Default is "detrend_meanfilt".
+    Kt : int, optional
+        The size of kernel in time dimension for detrending in the xrfi algorithm.
+        Default is 8.
+    Kf : int, optional
+        The size of kernel in frequency dimension for detrending in the xrfi
+        algorithm. Default is 8.
+    wf_method :  str, {"quadmean", "absmean", "mean"}
+        How to collapse the dimension(s) to form a single waterfall.
+    sig_init : float, optional
+        The starting number of sigmas to flag on. Default is 6.0.
+    sig_adj : float, optional
+        The number of sigmas to flag on for data adjacent to a flag. Default is 2.0.
+    label: str, optional
+        Label to be added to UVFlag objects.
+    dtype : numpy floating point type, optional
+        The precision of the metric and weights arrays, see calculate_metric.
+        Default is None (float64).
+    n_threads : int, optional
+        The number of threads the detrending algorithm uses, see xrfi_pipe.
+        Default is None (serial).
+    context : PipelineContext, optional
+        If given, its validation policy overrides run_check, check_extra and
+        run_check_acceptability (the chunks read from the file are checked as
+        its io_checks say), and the call is recorded as a stage of it.
+        Default is None.
+    run_check : bool
+        Option to check for the existence and proper shapes of parameters
+        on UVFlag Object.
+    check_extra : bool
+        Option to check optional parameters as well as required ones.
+    run_check_acceptability : bool
+        Option to check acceptable range of the values of parameters
+        on UVFlag Object.
+
+    Returns
+    -------
+    uvf_m : UVFlag object
+        A UVFlag object with metric after collapsing to waterfall and to single pol.
+        The weights array is set to ones.
+    uvf_fws : UVFlag object
+        A UVFlag object with flags after watershed.
+
+    """
+    read_check = run_check if context is None else context.io_checks()['run_check']
+    run_check, check_extra, run_check_acceptability = _context_checks(
+        context, run_check, check_extra, run_check_acceptability)
+    # only pass n_threads on if requested, so other algorithms can still be used
+    alg_kwargs = {} if n_threads is None else {'n_threads': n_threads}
+    uvf_m = _metric_waterfall_chunked(filename, alg, chunk_size, uvf_flags=uvf_flags,
+                                      ant_str=ant_str, wf_method=wf_method, dtype=dtype,
+                                      Kt=Kt, Kf=Kf, read_check=read_check,
+                                      run_check=run_check,
+                                      check_extra=check_extra,
+                                      run_check_acceptability=run_check_acceptability,
+                                      **alg_kwargs)
+    uvf_m.label = label
+    uvf_fws = _flag_metric_waterfall(uvf_m, alg=alg, Kt=Kt, Kf=Kf, sig_init=sig_init,
+                                     sig_adj=sig_adj, dtype=dtype, alg_kwargs=alg_kwargs,
+                                     context=context, run_check=run_check,
+                                     check_extra=check_extra,
+                                     run_check_acceptability=run_check_acceptability)
+    return uvf_m, uvf_fws
+
 #############################################################################
 # Wrappers -- Interact with input and output files
 #   Note: "current" wrappers should have simple names, but when replaced,
@@ -1372,10 +3738,347 @@ def chi_sq_pipe(uv, alg='zscore_full_array', modified=False, sig_init=6.0,
 #############################################################################
 
 
+def _timed_call(func, *args):
+    """Call func with args, and return its result and when it started and ended."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, start, time.perf_counter()
+
+
+def _context_call(context, name, func, *args):
+    """Call func with args as a stage of a PipelineContext."""
+    with context.stage(name):
+        return func(*args)
+
+
+def _run_stages(stages, n_workers=None, executor='thread', prefetch=False, timings=None,
+                on_result=None, context=None):
+    """Run a dependency graph of pipeline stages.
+
+    Parameters
+    ----------
+    stages : list of tuples
+        The stages as (name, func, deps) or (name, func, deps, after) tuples.
+        func is called with the results of the stages named in deps, in order,
+        and must only run once the stages named in after have also finished.
+        Every stage must be listed after the stages it depends on.
+    n_workers : int, optional
+        The number of workers to run independent stages concurrently in.
+        Default is None, which runs the stages serially in the order given.
+    executor : {"thread", "process"}, optional
+        Whether to run the stages in a pool of threads or processes. Stages run
+        in processes work on copies of their inputs, so their funcs must be
+        picklable and return any objects they modify. Default is "thread".
+    prefetch : bool, optional
+        If True, the stages without any dependencies (such as reading the input
+        files) are run in a background thread, one stage ahead: each is started
+        as the stage listed before the first stage that needs it starts, so it
+        is read while that stage computes but is not held in memory any sooner.
+        It is also started once a stage that needs it has nothing else left to
+        wait for. Default is False.
+    timings : dict, optional
+        If given, this is filled with a (run time, wait) tuple of seconds for
+        each stage, keyed by its name. The wait is how long the stage was held
+        up by prefetched stages after the rest of its dependencies had finished.
+    on_result : callable, optional
+        If given, this is called with the name and result of each stage as soon
+        as the stage finishes, in the calling thread, e.g. to write it out.
+    context : PipelineContext, optional
+        If given, each stage is recorded as a stage of it, by its name. Stages
+        run in processes only have their wall times recorded.
+
+    Returns
+    -------
+    results : dict
+        The result of each stage, keyed by its name.
+
+    Raises
+    ------
+    ValueError:
+        If executor is not recognized, a stage name is repeated, or a stage
+        depends on a stage that is not listed before it.
+
+    """
+    if executor not in ['thread', 'process']:
+        raise ValueError('executor must be "thread" or "process", not "{}".'.format(executor))
+    graph = []
+    for stage in stages:
+        name, func, deps = stage[:3]
+        after = stage[3] if len(stage) > 3 else []
+        for dep in list(deps) + list(after):
+            if dep not in [s[0] for s in graph]:
+                raise ValueError('Stage "{}" depends on "{}", which is not an earlier '
+                                 'stage.'.format(name, dep))
+        if name in [s[0] for s in graph]:
+            raise ValueError('Stage "{}" is listed more than once.'.format(name))
+        graph.append((name, func, list(deps), list(deps) + list(after)))
+    in_processes = executor == 'process' and n_workers is not None and n_workers > 1
+    if context is not None and not in_processes:
+        graph = [(name, partial(_context_call, context, name, func), deps, waits)
+                 for name, func, deps, waits in graph]
+    if timings is None:
+        timings = {}
+    results = {}
+    # when each stage finished, on the clock of this process
+    finished = {}
+
+    def collect(name, outcome, wait=0.):
+        results[name], started, ended = outcome
+        timings[name] = (ended - started, wait)
+        finished[name] = ended if name in fetched else time.perf_counter()
+        if context is not None and in_processes:
+            context.record(name, ended - started)
+        if on_result is not None:
+            on_result(name, results[name])
+
+    def wait_time(waits, ready):
+        ready = max([ready] + [finished[dep] for dep in waits if dep not in fetched])
+        return max([0.] + [finished[dep] - ready for dep in waits if dep in fetched])
+
+    # Delay import so concurrent.futures is only needed when running stages
+    from concurrent import futures
+    fetched = {}
+    sources = {}
+    io_pool = None
+    if prefetch:
+        io_pool = futures.ThreadPoolExecutor(max_workers=1)
+        sources = {name: func for name, func, deps, waits in graph if not waits}
+        graph = [stage for stage in graph if stage[0] not in sources]
+    order = [stage[0] for stage in graph]
+
+    def fetch(*names):
+        # start the prefetched stages that the named stages wait for, if not yet started
+        started = []
+        for name in names:
+            for dep in graph[order.index(name)][3] if name in order else []:
+                if dep in sources and dep not in fetched:
+                    fetched[dep] = io_pool.submit(_timed_call, sources[dep])
+                    started.append(dep)
+        return started
+
+    def fetch_ahead(name):
+        # the inputs of a stage and of the one after it
+        i = order.index(name)
+        return fetch(*order[i:i + 2])
+
+    try:
+        if n_workers is None or n_workers <= 1:
+            for name, func, deps, waits in graph:
+                ready = time.perf_counter()
+                fetch_ahead(name)
+                for dep in waits:
+                    if dep in fetched and dep not in results:
+                        collect(dep, fetched[dep].result())
+                collect(name, _timed_call(func, *[results[dep] for dep in deps]),
+                        wait=wait_time(waits, ready))
+        else:
+            pool_class = {'thread': futures.ThreadPoolExecutor,
+                          'process': futures.ProcessPoolExecutor}[executor]
+            start = time.perf_counter()
+            running = {}
+            pending = list(graph)
+            with pool_class(max_workers=n_workers) as pool:
+                while pending or running:
+                    # the stages that only wait for their prefetched inputs need them now
+                    started = fetch(*[s[0] for s in pending
+                                      if all(dep in results or dep in sources for dep in s[3])])
+                    for stage in [s for s in pending if all(dep in results for dep in s[3])]:
+                        name, func, deps, waits = stage
+                        future = pool.submit(_timed_call, func, *[results[dep] for dep in deps])
+                        running[future] = (name, wait_time(waits, start))
+                        pending.remove(stage)
+                        started += fetch_ahead(name)
+                    for name in started:
+                        running[fetched[name]] = (name, 0.)
+                    done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        name, wait = running.pop(future)
+                        collect(name, future.result(), wait=wait)
+        # run any prefetched stages that nothing depended on
+        for name in sources:
+            if name not in fetched:
+                fetched[name] = io_pool.submit(_timed_call, sources[name])
+            if name not in results:
+                collect(name, fetched[name].result())
+    finally:
+        if io_pool is not None:
+            for future in fetched.values():
+                future.cancel()
+            io_pool.shutdown()
+    return results
+
+
+def _prefetch(func, args, prefetch=True, waits=None):
+    """Yield func(*arg) for each arg in args, calling it ahead in a background thread.
+
+    Parameters
+    ----------
+    func : callable
+        The function to call, e.g. to read an input file.
+    args : list of tuples
+        The arguments to call func with, in the order to yield the results in.
+    prefetch : bool, optional
+        If True, func is called for the next arguments in a background thread
+        while the caller works on the current result. Default is True.
+    waits : list, optional
+        If given, the seconds spent waiting for each result are appended to it.
+
+    """
+    if waits is None:
+        waits = []
+    if not prefetch:
+        for arg in args:
+            start = time.perf_counter()
+            result = func(*arg)
+            waits.append(time.perf_counter() - start)
+            yield result
+        return
+    # Delay import so concurrent.futures is only needed when prefetching
+    from concurrent import futures
+    args = list(args)
+    with futures.ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(func, *args[0]) if args else None
+        for i in range(len(args)):
+            start = time.perf_counter()
+            result = future.result()
+            waits.append(time.perf_counter() - start)
+            if i + 1 < len(args):
+                future = pool.submit(func, *args[i + 1])
+            yield result
+
+
+def _print_timings(timings):
+    """Print the (run time, wait) seconds of each stage, see _run_stages."""
+    for name, (run_time, wait) in timings.items():
+        print('{}: {:.2f} s running, {:.2f} s waiting for input files'.format(name, run_time,
+                                                                              wait))
+    print('Total: {:.2f} s running, {:.2f} s waiting for input files'.format(
+        sum(timing[0] for timing in timings.values()),
+        sum(timing[1] for timing in timings.values())))
+
+
+def _read_calfits(filename, run_check=True, check_extra=True, run_check_acceptability=True):
+    """Read a calfits file into a new UVCal object."""
+    uvc = UVCal()
+    uvc.read_calfits(filename, run_check=run_check, check_extra=check_extra,
+                     run_check_acceptability=run_check_acceptability)
+    return uvc
+
+
+def _read_uvdata(filename, ant_str=None, run_check=True, check_extra=True,
+                 run_check_acceptability=True):
+    """Read a visibility file into a new UVData object."""
+    uv = UVData()
+    uv.read(filename, ant_str=ant_str, run_check=run_check, check_extra=check_extra,
+            run_check_acceptability=run_check_acceptability)
+    return uv
+
+
+def _prepare_flags(uv, uvf=None, xants=[], force_pol=False, context=None, run_check=True,
+                   check_extra=True, run_check_acceptability=True):
+    """Apply the flags of uvf and of the excluded antennas to uv and return it."""
+    if uvf is not None:
+        flag_apply(uvf, uv, keep_existing=True, force_pol=force_pol, context=context,
+                   run_check=run_check, check_extra=check_extra,
+                   run_check_acceptability=run_check_acceptability)
+    flag_xants(uv, xants, run_check=run_check, check_extra=check_extra,
+               run_check_acceptability=run_check_acceptability)
+    return uv
+
+
+def _apriori_waterfall(uvf_apriori, run_check=True, check_extra=True,
+                       run_check_acceptability=True):
+    """Collapse a copy of the a priori flags to a single pol waterfall."""
+    uvf_apriori = uvf_apriori.copy()
+    uvf_apriori.to_waterfall(method='and', keep_pol=False, run_check=run_check,
+                             check_extra=check_extra,
+                             run_check_acceptability=run_check_acceptability)
+    return uvf_apriori
+
+
+def _combine_pipe_metrics(*pipes, alg='detrend_medfilt', Kt=8, Kf=8, label='',
+                          mask_with_last=False, n_threads=None):
+    """Combine the metrics of xrfi_pipe and chi_sq_pipe results and detrend them.
+
+    The metric of the first pipe is combined with the metrics of the rest. If
+    mask_with_last, the last operand is instead a UVFlag waterfall whose flags
+    are masked by the detrending, otherwise the pixels without data are masked.
+    """
+    uvf_mask = None
+    if mask_with_last:
+        pipes, uvf_mask = pipes[:-1], pipes[-1]
+    uvf_metrics = pipes[0][0].combine_metrics([pipe[0] for pipe in pipes[1:]],
+                                              method='quadmean', inplace=False)
+    uvf_metrics.label = label
+    if uvf_mask is None:
+        flags = ~uvf_metrics.weights_array[:, :, 0].astype(np.bool)
+    else:
+        flags = uvf_mask.flag_array[:, :, 0]
+    alg_func = algorithm_dict[alg]
+    uvf_metrics.metric_array[:, :, 0] = alg_func(uvf_metrics.metric_array[:, :, 0],
+                                                 flags=flags, Kt=Kt, Kf=Kf,
+                                                 n_threads=n_threads)
+    return uvf_metrics
+
+
+def _flag_combined_metrics(uvf_metrics, sig_init=5.0, sig_adj=2.0, label='', context=None,
+                           run_check=True, check_extra=True, run_check_acceptability=True):
+    """Flag and watershed the combined metrics of a round of xrfi_run."""
+    uvf_f = flag(uvf_metrics, nsig_p=sig_init, context=context, run_check=run_check,
+                 check_extra=check_extra,
+                 run_check_acceptability=run_check_acceptability)
+    uvf_fws = watershed_flag(uvf_metrics, uvf_f, nsig_p=sig_adj, inplace=False,
+                             context=context, run_check=run_check, check_extra=check_extra,
+                             run_check_acceptability=run_check_acceptability)
+    uvf_fws.label = label
+    return uvf_fws
+
+
+def _or_pipe_flags(*operands, label='', run_check=True, check_extra=True,
+                   run_check_acceptability=True):
+    """OR together UVFlag objects and the flags of xrfi_pipe/chi_sq_pipe results."""
+    uvfs = [op[1] if isinstance(op, tuple) else op for op in operands]
+    uvf = FlagExpression(*uvfs).evaluate(run_check=run_check, check_extra=check_extra,
+                                         run_check_acceptability=run_check_acceptability)
+    uvf.label = label
+    return uvf
+
+
+def _input_stages(ocalfits_file, acalfits_file, model_file, data_file, xants=[],
+                  ant_str=None, data_chunk_size=None, context=None, run_check=True,
+                  check_extra=True, run_check_acceptability=True):
+    """Build the stages of xrfi_run that read its inputs and apply the a priori flags.
+
+    The excluded antennas are flagged on the cal objects once up front, so that
+    the pipes which share an object only read it and can run concurrently.
+    The data file is not read if it is to be read in chunks by xrfi_pipe_chunked.
+    See _run_stages for the format of the stages.
+    """
+    checks = {'run_check': run_check, 'check_extra': check_extra,
+              'run_check_acceptability': run_check_acceptability}
+    reads = checks if context is None else context.io_checks()
+    stages = [('uvc_a', partial(_read_calfits, acalfits_file, **reads), []),
+              ('uvc_o', partial(_read_calfits, ocalfits_file, **reads), []),
+              ('uv_v', partial(_read_uvdata, model_file, **reads), []),
+              ('uv_d', partial(_read_uvdata, data_file, ant_str=ant_str, **reads), []),
+              ('apriori', partial(UVFlag, mode='flag', copy_flags=True,
+                                  label='A priori flags.'), ['uvc_a']),
+              ('uvc_a1', partial(_prepare_flags, xants=xants, context=context, **checks),
+               ['uvc_a'], ['apriori']),
+              ('uvc_o1', partial(_prepare_flags, xants=xants, context=context, **checks),
+               ['uvc_o', 'apriori']),
+              ('apriori_wf', partial(_apriori_waterfall, **checks), ['apriori'])]
+    if data_chunk_size is not None:
+        stages = [stage for stage in stages if stage[0] != 'uv_d']
+    return stages
+
+
 def xrfi_run(ocalfits_file, acalfits_file, model_file, data_file, history,
              xrfi_path='', kt_size=8, kf_size=8, sig_init=5.0, sig_adj=2.0,
              ex_ants=None, ant_str=None, metrics_file=None, clobber=False,
-             run_check=True, check_extra=True, run_check_acceptability=True):
+             run_check=True, check_extra=True, run_check_acceptability=True, single_pass=False,
+             n_threads=None, packed_flags=False, n_workers=None, executor='thread', prefetch=True,
+             verbose=False, data_chunk_size=None, container=False, context=None):
     """Run the xrfi excision pipeline used for H1C IDR2.2.
 
     This pipeline uses the detrending and watershed algorithms above.
@@ -1435,214 +4138,349 @@ def xrfi_run(ocalfits_file, acalfits_file, model_file, data_file, history,
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    single_pass : bool, optional
+        If True, run every data product (including the raw data) through a single
+        round of the detrend_masked_medfilt algorithm, which excludes the a priori
+        flags from its windows, instead of the two rounds of detrend_medfilt and
+        detrend_meanfilt. The outputs are written with the round 2 file names so
+        they can be used by day_threshold_run, and no round 1 files are written.
+        Default is False.
+    n_threads : int, optional
+        The number of threads to detrend tiles of each waterfall in, see
+        detrend_medfilt. Default is None (serial).
+    packed_flags : bool, optional
+        If True, write the flag files with bit-packed flags, see write_flags.
+        These can be read with read_flags. Default is False.
+    n_workers : int, optional
+        The number of workers to run independent stages of the pipeline in
+        concurrently, such as reading the input files and the pipes on each data
+        product within a round. Default is None (serial).
+    executor : {"thread", "process"}, optional
+        Whether the n_workers are threads or processes. Default is "thread".
+    prefetch : bool, optional
+        If True, read each input file in a background thread while the stage
+        before the first one that needs it computes. Default is True.
+    verbose : bool, optional
+        If True, print how long each stage ran and waited for the input files.
+        Default is False.
+    data_chunk_size : int, optional
+        If given, the data_file (which must be uvh5) is never read whole. Instead
+        its metric is calculated data_chunk_size baselines at a time with
+        xrfi_pipe_chunked, so the memory this needs is set by the chunk size
+        rather than the size of the file. Default is None (read the whole file).
+    container : bool, optional
+        If True, write all of the metrics and flags as the products of a single
+        "{basename}.xrfi.h5" container file in the xrfi_path, see
+        FlagsContainerWriter, instead of a file each. The products are named by
+        the file extensions they would otherwise have, less ".h5" (e.g. "flags2"),
+        and are written in a background thread as soon as they are computed.
+        Default is False.
+    context : PipelineContext, optional
+        The validation policy and profile of the run, which overrides run_check,
+        check_extra and run_check_acceptability. Each stage of the run (e.g.
+        "og1" for the omnical gains of round 1) and each call of the pipeline
+        functions is recorded in its stats. Default is None, which checks
+        every step as set by run_check.
 
     Returns
     -------
     None
 
+    Raises
+    ------
+    ValueError:
+        If data_chunk_size is given and data_file is not a uvh5 file.
+
     """
+    if data_chunk_size is not None:
+        _check_uvh5(data_file)
     history = 'Flagging command: "' + history + '", Using ' + hera_qm_version_str
     dirname = resolve_xrfi_path(xrfi_path, data_file, jd_subdir=True)
     xants = process_ex_ants(ex_ants=ex_ants, metrics_file=metrics_file)
-
-    # Initial run on cal data products
-    # Calculate metric on abscal data
-    uvc_a = UVCal()
-    uvc_a.read_calfits(acalfits_file)
-    uvf_apriori = UVFlag(uvc_a, mode='flag', copy_flags=True, label='A priori flags.')
-    uvf_ag, uvf_agf = xrfi_pipe(uvc_a, alg='detrend_medfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                cal_mode='gain', sig_init=sig_init, sig_adj=sig_adj,
-                                label='Abscal gains, round 1.',
-                                run_check=run_check,
-                                check_extra=check_extra,
-                                run_check_acceptability=run_check_acceptability)
-    uvf_ax, uvf_axf = xrfi_pipe(uvc_a, alg='detrend_medfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                cal_mode='tot_chisq', sig_init=sig_init, sig_adj=sig_adj,
-                                label='Abscal chisq, round 1.',
-                                run_check=run_check,
-                                check_extra=check_extra,
-                                run_check_acceptability=run_check_acceptability)
-
-    # Calculate metric on omnical data
-    uvc_o = UVCal()
-    uvc_o.read_calfits(ocalfits_file)
-    flag_apply(uvf_apriori, uvc_o, keep_existing=True, run_check=run_check,
-               check_extra=check_extra,
-               run_check_acceptability=run_check_acceptability)
-    uvf_og, uvf_ogf = xrfi_pipe(uvc_o, alg='detrend_medfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                cal_mode='gain', sig_init=sig_init, sig_adj=sig_adj,
-                                label='Omnical gains, round 1.',
-                                run_check=run_check,
-                                check_extra=check_extra,
-                                run_check_acceptability=run_check_acceptability)
-    uvf_ox, uvf_oxf = xrfi_pipe(uvc_o, alg='detrend_medfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                cal_mode='tot_chisq', sig_init=sig_init, sig_adj=sig_adj,
-                                label='Omnical chisq, round 1.',
-                                run_check=run_check,
-                                check_extra=check_extra,
-                                run_check_acceptability=run_check_acceptability)
-
-    # Calculate metric on model vis
-    uv_v = UVData()
-    uv_v.read(model_file)
-    uvf_v, uvf_vf = xrfi_pipe(uv_v, alg='detrend_medfilt', xants=[], Kt=kt_size, Kf=kf_size,
-                              sig_init=sig_init, sig_adj=sig_adj,
-                              label='Omnical visibility solutions, round 1.',
-                              run_check=run_check,
-                              check_extra=check_extra,
-                              run_check_acceptability=run_check_acceptability)
-
-    # Get the absolute chi-squared values
-    uvf_chisq, uvf_chisq_f = chi_sq_pipe(uvc_o, alg='zscore_full_array', modified=True,
-                                         sig_init=sig_init, sig_adj=sig_adj,
-                                         label='Renormalized chisq, round 1.',
-                                         run_check=run_check,
-                                         check_extra=check_extra,
-                                         run_check_acceptability=run_check_acceptability)
-
-    # Combine the metrics together
-    uvf_metrics = uvf_v.combine_metrics([uvf_og, uvf_ox, uvf_ag, uvf_ax, uvf_chisq],
-                                        method='quadmean', inplace=False)
-    uvf_metrics.label = 'Combined metrics, round 1.'
-    alg_func = algorithm_dict['detrend_medfilt']
-    uvf_metrics.metric_array[:, :, 0] = alg_func(uvf_metrics.metric_array[:, :, 0],
-                                                 flags=~uvf_metrics.weights_array[:, :, 0].astype(np.bool),
-                                                 Kt=kt_size, Kf=kf_size)
-
-    # Flag on combined metrics
-    uvf_f = flag(uvf_metrics, nsig_p=sig_init, run_check=run_check,
-                 check_extra=check_extra,
-                 run_check_acceptability=run_check_acceptability)
-    uvf_fws = watershed_flag(uvf_metrics, uvf_f, nsig_p=sig_adj, inplace=False,
-                             run_check=run_check, check_extra=check_extra,
-                             run_check_acceptability=run_check_acceptability)
-    uvf_fws.label = 'Flags from combined metrics, round 1.'
-
-    # OR everything together for initial flags
-    uvf_apriori.to_waterfall(method='and', keep_pol=False, run_check=run_check,
-                             check_extra=check_extra,
-                             run_check_acceptability=run_check_acceptability)
-    uvf_init = (uvf_fws | uvf_ogf | uvf_oxf | uvf_agf | uvf_axf | uvf_vf
-                | uvf_chisq_f | uvf_apriori)
-    uvf_init.label = 'ORd flags, round 1.'
+    if context is None:
+        context = PipelineContext(validate='all' if run_check else 'none',
+                                  check_extra=check_extra,
+                                  run_check_acceptability=run_check_acceptability)
+    if single_pass:
+        uvf_dict = _xrfi_run_single_pass(ocalfits_file, acalfits_file, model_file, data_file,
+                                         xants=xants, ant_str=ant_str, kt_size=kt_size,
+                                         kf_size=kf_size, sig_init=sig_init, sig_adj=sig_adj,
+                                         n_threads=n_threads, n_workers=n_workers,
+                                         executor=executor, prefetch=prefetch,
+                                         verbose=verbose, data_chunk_size=data_chunk_size,
+                                         context=context)
+        _write_uvf_dict(uvf_dict, data_file, dirname, clobber=clobber,
+                        packed_flags=packed_flags, container=container, context=context)
+        return
+
+    checks = context.step_checks()
+    pipe_kwargs = dict(Kt=kt_size, Kf=kf_size, sig_init=sig_init, sig_adj=sig_adj,
+                       n_threads=n_threads, context=context)
+    chisq_kwargs = dict(alg='zscore_full_array', sig_init=sig_init, sig_adj=sig_adj,
+                        context=context)
+    stages = _input_stages(ocalfits_file, acalfits_file, model_file, data_file, xants=xants,
+                           ant_str=ant_str, data_chunk_size=data_chunk_size, context=context,
+                           **checks)
+
+    # Initial run on cal data products and model vis
+    alg = 'detrend_medfilt'
+    stages += [('ag1', partial(xrfi_pipe, alg=alg, cal_mode='gain',
+                               label='Abscal gains, round 1.', **pipe_kwargs), ['uvc_a1']),
+               ('ax1', partial(xrfi_pipe, alg=alg, cal_mode='tot_chisq',
+                               label='Abscal chisq, round 1.', **pipe_kwargs), ['uvc_a1']),
+               ('og1', partial(xrfi_pipe, alg=alg, cal_mode='gain',
+                               label='Omnical gains, round 1.', **pipe_kwargs), ['uvc_o1']),
+               ('ox1', partial(xrfi_pipe, alg=alg, cal_mode='tot_chisq',
+                               label='Omnical chisq, round 1.', **pipe_kwargs), ['uvc_o1']),
+               ('v1', partial(xrfi_pipe, alg=alg,
+                              label='Omnical visibility solutions, round 1.', **pipe_kwargs),
+                ['uv_v']),
+               # Get the absolute chi-squared values
+               ('chisq1', partial(chi_sq_pipe, modified=True,
+                                  label='Renormalized chisq, round 1.', **chisq_kwargs),
+                ['uvc_o1'])]
+
+    # Combine the metrics together, flag on them and OR everything together
+    stages += [('metrics1', partial(_combine_pipe_metrics, alg=alg, Kt=kt_size, Kf=kf_size,
+                                    label='Combined metrics, round 1.', n_threads=n_threads),
+                ['v1', 'og1', 'ox1', 'ag1', 'ax1', 'chisq1']),
+               ('fws1', partial(_flag_combined_metrics, sig_init=sig_init, sig_adj=sig_adj,
+                                label='Flags from combined metrics, round 1.',
+                                context=context, **checks),
+                ['metrics1']),
+               ('init', partial(_or_pipe_flags, label='ORd flags, round 1.', **checks),
+                ['fws1', 'og1', 'ox1', 'ag1', 'ax1', 'v1', 'chisq1', 'apriori_wf'])]
 
     # Second round -- use init flags to mask and recalculate everything
-    # Read in data file
-    uv_d = UVData()
-    uv_d.read(data_file, ant_str=ant_str)
-    for uv in [uvc_o, uvc_a, uv_v, uv_d]:
-        flag_apply(uvf_init, uv, keep_existing=True, force_pol=True,
-                   run_check=run_check, check_extra=check_extra,
-                   run_check_acceptability=run_check_acceptability)
+    for name, uv in [('uvc_a', 'uvc_a1'), ('uvc_o', 'uvc_o1'), ('uv_v', 'uv_v'),
+                     ('uv_d', 'uv_d')]:
+        if name == 'uv_d' and data_chunk_size is not None:
+            # xrfi_pipe_chunked applies the flags to each chunk it reads
+            continue
+        stages.append((name + '2', partial(_prepare_flags, force_pol=True, context=context,
+                                           **checks), [uv, 'init']))
 
-    # Do next round of metrics
     # Change to meanfilt because it can mask flagged pixels
-    # Calculate metric on abscal data
-    uvf_ag2, uvf_agf2 = xrfi_pipe(uvc_a, alg='detrend_meanfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                  cal_mode='gain', sig_init=sig_init, sig_adj=sig_adj,
-                                  label='Abscal gains, round 2.',
-                                  run_check=run_check,
-                                  check_extra=check_extra,
-                                  run_check_acceptability=run_check_acceptability)
-    uvf_ax2, uvf_axf2 = xrfi_pipe(uvc_a, alg='detrend_meanfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                  cal_mode='tot_chisq', sig_init=sig_init, sig_adj=sig_adj,
-                                  label='Abscal chisq, round 2.',
-                                  run_check=run_check,
-                                  check_extra=check_extra,
-                                  run_check_acceptability=run_check_acceptability)
+    alg = 'detrend_meanfilt'
+    stages += [('ag2', partial(xrfi_pipe, alg=alg, cal_mode='gain',
+                               label='Abscal gains, round 2.', **pipe_kwargs), ['uvc_a2']),
+               ('ax2', partial(xrfi_pipe, alg=alg, cal_mode='tot_chisq',
+                               label='Abscal chisq, round 2.', **pipe_kwargs), ['uvc_a2']),
+               ('og2', partial(xrfi_pipe, alg=alg, cal_mode='gain',
+                               label='Omnical gains, round 2.', **pipe_kwargs), ['uvc_o2']),
+               ('ox2', partial(xrfi_pipe, alg=alg, cal_mode='tot_chisq',
+                               label='Omnical chisq, round 2.', **pipe_kwargs), ['uvc_o2']),
+               ('v2', partial(xrfi_pipe, alg=alg,
+                              label='Omnical visibility solutions, round 2.', **pipe_kwargs),
+                ['uv_v2']),
+               ('chisq2', partial(chi_sq_pipe, modified=False,
+                                  label='Renormalized chisq, round 2.', **chisq_kwargs),
+                ['uvc_o2'])]
+    if data_chunk_size is None:
+        stages.append(('d2', partial(xrfi_pipe, alg=alg, label='Data, round 2.',
+                                     **pipe_kwargs), ['uv_d2']))
+    else:
+        stages.append(('d2', partial(xrfi_pipe_chunked, data_file, chunk_size=data_chunk_size,
+                                     ant_str=ant_str, alg=alg, label='Data, round 2.',
+                                     **pipe_kwargs), ['init']))
+    stages += [('metrics2', partial(_combine_pipe_metrics, alg=alg, Kt=kt_size, Kf=kf_size,
+                                    label='Combined metrics, round 2.', mask_with_last=True,
+                                    n_threads=n_threads),
+                ['d2', 'og2', 'ox2', 'ag2', 'ax2', 'v2', 'd2', 'chisq2', 'init']),
+               ('fws2', partial(_flag_combined_metrics, sig_init=sig_init, sig_adj=sig_adj,
+                                label='Flags from combined metrics, round 2.',
+                                context=context, **checks),
+                ['metrics2']),
+               ('flags2', partial(_or_pipe_flags, label='ORd flags, round 2.', **checks),
+                ['fws2', 'og2', 'ox2', 'ag2', 'ax2', 'v2', 'd2', 'chisq2', 'init'])]
+    # The file extensions of the products of each stage
+    stage_exts = {'apriori_wf': ['apriori_flags.h5'], 'metrics1': ['combined_metrics1.h5'],
+                  'fws1': ['combined_flags1.h5'], 'init': ['flags1.h5'],
+                  'metrics2': ['combined_metrics2.h5'], 'fws2': ['combined_flags2.h5'],
+                  'flags2': ['flags2.h5']}
+    for name, ext in [('v', 'v'), ('og', 'og'), ('ox', 'ox'), ('ag', 'ag'), ('ax', 'ax'),
+                      ('d', 'data'), ('chisq', 'chi_sq')]:
+        for rnd in ['1', '2']:
+            metric_ext = 'chi_sq_renormed' if name == 'chisq' else ext + '_metrics'
+            stage_exts[name + rnd] = [metric_ext + rnd + '.h5', ext + '_flags' + rnd + '.h5']
+    writer = None
+    on_result = None
+    if container:
+        # Write each product to the container as soon as its stage finishes
+        writer = FlagsContainerWriter(_container_path(data_file, dirname), clobber=clobber,
+                                      packed=packed_flags, asynchronous=True)
+
+        def on_result(name, result):
+            for ext, uvf in _stage_products(stage_exts.get(name, []), result):
+                context.check_output(uvf)
+                writer.write(os.path.splitext(ext)[0], uvf)
+    timings = {}
+    try:
+        results = _run_stages(stages, n_workers=n_workers, executor=executor,
+                              prefetch=prefetch, timings=timings, on_result=on_result,
+                              context=context)
+    finally:
+        if writer is not None:
+            writer.close()
+    if verbose:
+        _print_timings(timings)
 
-    # Calculate metric on omnical data
-    uvf_og2, uvf_ogf2 = xrfi_pipe(uvc_o, alg='detrend_meanfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                  cal_mode='gain', sig_init=sig_init, sig_adj=sig_adj,
-                                  label='Omnical gains, round 2.',
-                                  run_check=run_check,
-                                  check_extra=check_extra,
-                                  run_check_acceptability=run_check_acceptability)
-    uvf_ox2, uvf_oxf2 = xrfi_pipe(uvc_o, alg='detrend_meanfilt', Kt=kt_size, Kf=kf_size, xants=xants,
-                                  cal_mode='tot_chisq', sig_init=sig_init, sig_adj=sig_adj,
-                                  label='Omnical chisq, round 2.',
-                                  run_check=run_check,
-                                  check_extra=check_extra,
-                                  run_check_acceptability=run_check_acceptability)
+    # Write everything out
+    if not container:
+        uvf_dict = {}
+        for name, exts in stage_exts.items():
+            if name in results:
+                uvf_dict.update(_stage_products(exts, results[name]))
+        _write_uvf_dict(uvf_dict, data_file, dirname, clobber=clobber,
+                        packed_flags=packed_flags, context=context)
 
-    # Calculate metric on model vis
-    uvf_v2, uvf_vf2 = xrfi_pipe(uv_v, alg='detrend_meanfilt', xants=[], Kt=kt_size, Kf=kf_size,
-                                sig_init=sig_init, sig_adj=sig_adj,
-                                label='Omnical visibility solutions, round 2.',
-                                run_check=run_check,
-                                check_extra=check_extra,
-                                run_check_acceptability=run_check_acceptability)
-
-    # Calculate metric on data file
-    uvf_d2, uvf_df2 = xrfi_pipe(uv_d, alg='detrend_meanfilt', xants=[], Kt=kt_size, Kf=kf_size,
-                                sig_init=sig_init, sig_adj=sig_adj,
-                                label='Data, round 2.',
-                                run_check=run_check,
-                                check_extra=check_extra,
-                                run_check_acceptability=run_check_acceptability)
 
-    # Get the absolute chi-squared values
-    uvf_chisq2, uvf_chisq_f2 = chi_sq_pipe(uvc_o, alg='zscore_full_array', modified=False,
-                                           sig_init=sig_init, sig_adj=sig_adj,
-                                           label='Renormalized chisq, round 2.',
-                                           run_check=run_check,
-                                           check_extra=check_extra,
-                                           run_check_acceptability=run_check_acceptability)
+def _stage_products(exts, result):
+    """Pair the file extensions of a stage of xrfi_run with the UVFlag objects it returned."""
+    return list(zip(exts, result if isinstance(result, tuple) else (result,)))
 
-    # Combine the metrics together
-    uvf_metrics2 = uvf_d2.combine_metrics([uvf_og2, uvf_ox2, uvf_ag2, uvf_ax2,
-                                           uvf_v2, uvf_d2, uvf_chisq2],
-                                          method='quadmean', inplace=False)
-    uvf_metrics2.label = 'Combined metrics, round 2.'
-    alg_func = algorithm_dict['detrend_meanfilt']
-    uvf_metrics2.metric_array[:, :, 0] = alg_func(uvf_metrics2.metric_array[:, :, 0],
-                                                  flags=uvf_init.flag_array[:, :, 0],
-                                                  Kt=kt_size, Kf=kf_size)
 
-    # Flag on combined metrics
-    uvf_f2 = flag(uvf_metrics2, nsig_p=sig_init, run_check=run_check,
-                  check_extra=check_extra,
-                  run_check_acceptability=run_check_acceptability)
-    uvf_fws2 = watershed_flag(uvf_metrics2, uvf_f2, nsig_p=sig_adj,
-                              inplace=False, run_check=run_check,
-                              check_extra=check_extra,
-                              run_check_acceptability=run_check_acceptability)
-    uvf_fws2.label = 'Flags from combined metrics, round 2.'
-    uvf_combined2 = (uvf_fws2 | uvf_ogf2 | uvf_oxf2 | uvf_agf2 | uvf_axf2
-                     | uvf_vf2 | uvf_df2 | uvf_chisq_f2 | uvf_init)
-    uvf_combined2.label = 'ORd flags, round 2.'
+def _container_path(data_file, dirname):
+    """Return the path of the container file xrfi_run writes for data_file."""
+    basename = qm_utils.strip_extension(os.path.basename(data_file))
+    return os.path.join(dirname, '.'.join([basename, 'xrfi.h5']))
 
-    # Write everything out
-    uvf_dict = {'apriori_flags.h5': uvf_apriori,
-                'v_metrics1.h5': uvf_v, 'v_flags1.h5': uvf_vf,
-                'og_metrics1.h5': uvf_og, 'og_flags1.h5': uvf_ogf,
-                'ox_metrics1.h5': uvf_ox, 'ox_flags1.h5': uvf_oxf,
-                'ag_metrics1.h5': uvf_ag, 'ag_flags1.h5': uvf_agf,
-                'ax_metrics1.h5': uvf_ax, 'ax_flags1.h5': uvf_axf,
-                'chi_sq_renormed1.h5': uvf_chisq, 'chi_sq_flags1.h5': uvf_chisq_f,
-                'combined_metrics1.h5': uvf_metrics, 'combined_flags1.h5': uvf_fws,
-                'flags1.h5': uvf_init,
-                'v_metrics2.h5': uvf_v2, 'v_flags2.h5': uvf_vf2,
-                'og_metrics2.h5': uvf_og2, 'og_flags2.h5': uvf_ogf2,
-                'ox_metrics2.h5': uvf_ox2, 'ox_flags2.h5': uvf_oxf2,
-                'ag_metrics2.h5': uvf_ag2, 'ag_flags2.h5': uvf_agf2,
-                'ax_metrics2.h5': uvf_ax2, 'ax_flags2.h5': uvf_axf2,
-                'data_metrics2.h5': uvf_d2, 'data_flags2.h5': uvf_df2,
-                'chi_sq_renormed2.h5': uvf_chisq2, 'chi_sq_flags2.h5': uvf_chisq_f2,
-                'combined_metrics2.h5': uvf_metrics2, 'combined_flags2.h5': uvf_fws2,
-                'flags2.h5': uvf_combined2}
 
+def _write_uvf_dict(uvf_dict, data_file, dirname, clobber=False, packed_flags=False,
+                    container=False, context=None):
+    """Write the UVFlag objects of xrfi_run, keyed by their file extensions.
+
+    If container, they are written as the products of one container file instead,
+    named by their extensions less ".h5". Each is checked first as the policy
+    of the context has it.
+    """
+    if context is not None:
+        for uvf in uvf_dict.values():
+            context.check_output(uvf)
+    if container:
+        with FlagsContainerWriter(_container_path(data_file, dirname), clobber=clobber,
+                                  packed=packed_flags) as writer:
+            for ext, uvf in uvf_dict.items():
+                writer.write(os.path.splitext(ext)[0], uvf)
+        return
     basename = qm_utils.strip_extension(os.path.basename(data_file))
     for ext, uvf in uvf_dict.items():
         outfile = '.'.join([basename, ext])
         outpath = os.path.join(dirname, outfile)
-        uvf.write(outpath, clobber=clobber)
+        write_flags(uvf, outpath, clobber=clobber, packed=packed_flags)
+
+
+def _xrfi_run_single_pass(ocalfits_file, acalfits_file, model_file, data_file, xants=[],
+                          ant_str=None, kt_size=8, kf_size=8, sig_init=5.0, sig_adj=2.0,
+                          n_threads=None, n_workers=None, executor='thread', prefetch=True,
+                          verbose=False, data_chunk_size=None, context=None):
+    """Run the data products of xrfi_run through a single masked median round.
+
+    See xrfi_run for a description of the parameters.
+
+    Returns
+    -------
+    uvf_dict : dict
+        The metric and flag UVFlag objects, keyed by their output file extension.
+    """
+    if context is None:
+        context = PipelineContext()
+    checks = context.step_checks()
+    stages = _input_stages(ocalfits_file, acalfits_file, model_file, data_file, xants=xants,
+                           ant_str=ant_str, data_chunk_size=data_chunk_size, context=context,
+                           **checks)
+    stages.append(('uv_v1', partial(_prepare_flags, force_pol=True, context=context, **checks),
+                   ['uv_v', 'apriori_wf']))
+    if data_chunk_size is None:
+        stages.append(('uv_d1', partial(_prepare_flags, force_pol=True, context=context,
+                                        **checks), ['uv_d', 'apriori_wf']))
+
+    # The masked median keeps the a priori flags out of the detrending windows,
+    # which the two round pipeline otherwise needs a second (meanfilt) round for.
+    products = [('og', 'uvc_o1', 'gain', 'Omnical gains'),
+                ('ox', 'uvc_o1', 'tot_chisq', 'Omnical chisq'),
+                ('ag', 'uvc_a1', 'gain', 'Abscal gains'),
+                ('ax', 'uvc_a1', 'tot_chisq', 'Abscal chisq'),
+                ('v', 'uv_v1', 'gain', 'Omnical visibility solutions'),
+                ('data', 'uv_d1', 'gain', 'Data')]
+    pipe_kwargs = dict(alg='detrend_masked_medfilt', Kt=kt_size, Kf=kf_size, sig_init=sig_init,
+                       sig_adj=sig_adj, n_threads=n_threads, context=context)
+    for ext, uv, cal_mode, label in products:
+        if ext == 'data' and data_chunk_size is not None:
+            stages.append((ext, partial(xrfi_pipe_chunked, data_file, chunk_size=data_chunk_size,
+                                        ant_str=ant_str, label=label + ', single pass.',
+                                        **pipe_kwargs), ['apriori_wf']))
+        else:
+            stages.append((ext, partial(xrfi_pipe, cal_mode=cal_mode,
+                                        label=label + ', single pass.', **pipe_kwargs), [uv]))
+    # Get the absolute chi-squared values
+    stages.append(('chi_sq', partial(chi_sq_pipe, alg='zscore_full_array', modified=True,
+                                     sig_init=sig_init, sig_adj=sig_adj,
+                                     label='Renormalized chisq, single pass.',
+                                     context=context), ['uvc_o1']))
+    timings = {}
+    results = _run_stages(stages, n_workers=n_workers, executor=executor, prefetch=prefetch,
+                          timings=timings, context=context)
+    if verbose:
+        _print_timings(timings)
+
+    uvf_apriori = results['apriori_wf']
+    uvf_dict = {'apriori_flags.h5': uvf_apriori}
+    flags = [uvf_apriori]
+    for ext, _, _, _ in products:
+        uvf_dict[ext + '_metrics2.h5'], uvf_dict[ext + '_flags2.h5'] = results[ext]
+        flags.append(results[ext][1])
+    uvf_chisq, uvf_chisq_f = results['chi_sq']
+    uvf_dict['chi_sq_renormed2.h5'] = uvf_chisq
+    uvf_dict['chi_sq_flags2.h5'] = uvf_chisq_f
+    flags.append(uvf_chisq_f)
+
+    # Combine the metrics together
+    others = [uvf_dict[ext + '_metrics2.h5'] for ext in ['og', 'ox', 'ag', 'ax', 'v']]
+    uvf_metrics = uvf_dict['data_metrics2.h5'].combine_metrics(others + [uvf_chisq],
+                                                               method='quadmean',
+                                                               inplace=False)
+    uvf_metrics.label = 'Combined metrics, single pass.'
+    uvf_metrics.metric_array[:, :, 0] = detrend_masked_medfilt(
+        uvf_metrics.metric_array[:, :, 0],
+        flags=(~uvf_metrics.weights_array[:, :, 0].astype(np.bool)
+               | uvf_apriori.flag_array[:, :, 0]),
+        Kt=kt_size, Kf=kf_size, n_threads=n_threads)
+
+    # Flag on combined metrics
+    uvf_fws = _flag_combined_metrics(uvf_metrics, sig_init=sig_init, sig_adj=sig_adj,
+                                     label='Flags from combined metrics, single pass.',
+                                     context=context, **checks)
+    uvf_combined = FlagExpression(uvf_fws, *flags).evaluate(**checks)
+    uvf_combined.label = 'ORd flags, single pass.'
+    uvf_dict['combined_metrics2.h5'] = uvf_metrics
+    uvf_dict['combined_flags2.h5'] = uvf_fws
+    uvf_dict['flags2.h5'] = uvf_combined
+    return uvf_dict
+
+
+def _read_filled_metrics(files2, files1=None, product2=None, product1=None, run_check=True,
+                         check_extra=True, run_check_acceptability=True):
+    """Read the round 2 metrics of xrfi_run, filled in with round 1 where missing.
+
+    The products are given if the files are the container files of xrfi_run.
+    """
+    checks = {'run_check': run_check, 'check_extra': check_extra,
+              'run_check_acceptability': run_check_acceptability}
+    uvf2 = read_flags(files2, product=product2, **checks)
+    if files1 is not None:
+        # Fill in 2nd metrics with 1st metrics where 2nd are not available.
+        uvf1 = read_flags(files1, product=product1, **checks)
+        uvf2.metric_array = np.where(np.isinf(uvf2.metric_array), uvf1.metric_array,
+                                     uvf2.metric_array)
+    return uvf2
 
 
 def day_threshold_run(data_files, history, nsig_f=7., nsig_t=7.,
                       nsig_f_adj=3., nsig_t_adj=3., clobber=False,
                       run_check=True, check_extra=True,
-                      run_check_acceptability=True):
+                      run_check_acceptability=True, n_threads=None, prefetch=True, verbose=False,
+                      container=False, context=None):
     """Apply thresholding across all times/frequencies, using a full day of data.
 
     This function will write UVFlag files for each data input (omnical gains,
@@ -1681,12 +4519,36 @@ def day_threshold_run(data_files, history, nsig_f=7., nsig_t=7.,
     run_check_acceptability : bool
         Option to check acceptable range of the values of parameters
         on UVFlag Object.
+    n_threads : int, optional
+        The number of threads to find the medians of threshold_wf in.
+        Default is None (serial).
+    prefetch : bool, optional
+        If True, read the next metrics and abscal files in a background thread
+        while the current ones are thresholded and flagged. Default is True.
+    verbose : bool, optional
+        If True, print how long each metric and abscal file took to process and
+        how long was spent waiting to read it. Default is False.
+    container : bool, optional
+        If True, read the metrics and flags of xrfi_run from the products of its
+        container files, see the container option of xrfi_run. Default is False.
+    context : PipelineContext, optional
+        The validation policy and profile of the run, which overrides run_check,
+        check_extra and run_check_acceptability. The thresholding of each metric
+        (e.g. "og") and the flagging of each abscal file (by its output name) are
+        recorded in its stats. Default is None, which checks every step as set
+        by run_check.
 
     Returns
     -------
     None
 
     """
+    if context is None:
+        context = PipelineContext(validate='all' if run_check else 'none',
+                                  check_extra=check_extra,
+                                  run_check_acceptability=run_check_acceptability)
+    checks = context.step_checks()
+    io_checks = context.io_checks()
     history = 'Flagging command: "' + history + '", Using ' + hera_qm_version_str
     data_files = sorted(data_files)
     xrfi_dirs = [resolve_xrfi_path('', dfile, jd_subdir=True) for dfile in data_files]
@@ -1696,59 +4558,79 @@ def day_threshold_run(data_files, history, nsig_f=7., nsig_t=7.,
     types = ['og', 'ox', 'ag', 'ax', 'v', 'data', 'chi_sq_renormed', 'combined']
     mexts = ['og_metrics', 'ox_metrics', 'ag_metrics', 'ax_metrics',
              'v_metrics', 'data_metrics', 'chi_sq_renormed', 'combined_metrics']
-    # Read in the metrics objects
-    filled_metrics = []
+    # Read in the metrics objects, the next while thresholding the current one
+    metric_files = []
+    if container:
+        containers = [glob.glob(d + '/*.xrfi.h5')[0] for d in xrfi_dirs]
+        products = []
+        for filename in containers:
+            with h5py.File(filename, 'r') as f:
+                products.append(list(f['Products']))
     for ext in mexts:
-        if ext != 'data_metrics':
-            # Fill in 2nd metrics with 1st metrics where 2nd are not available.
-            files1 = [glob.glob(d + '/*' + ext + '1.h5')[0] for d in xrfi_dirs]
+        if container:
+            files1 = [[c] if ext + '1' in prods else [] for c, prods in zip(containers, products)]
+            files2 = containers
+            names = (ext + '2', ext + '1')
+        else:
+            files1 = [glob.glob(d + '/*' + ext + '1.h5') for d in xrfi_dirs]
             files2 = [glob.glob(d + '/*' + ext + '2.h5')[0] for d in xrfi_dirs]
-            uvf1 = UVFlag(files1)
-            uvf2 = UVFlag(files2)
-            uvf2.metric_array = np.where(np.isinf(uvf2.metric_array), uvf1.metric_array,
-                                         uvf2.metric_array)
-            filled_metrics.append(uvf2)
+            names = (None, None)
+        # Data was only run in second iteration, and single pass runs of
+        # xrfi_run have no first iteration at all.
+        if ext != 'data_metrics' and all(files1):
+            metric_files.append((files2, [f[0] for f in files1]) + names)
         else:
-            # Data was only run in second iteration
-            files = [glob.glob(d + '/*' + ext + '2.h5')[0] for d in xrfi_dirs]
-            filled_metrics.append(UVFlag(files))
+            metric_files.append((files2, None) + names)
+    waits = []
+    timings = {}
+    filled_metrics = _prefetch(partial(_read_filled_metrics, **io_checks), metric_files,
+                               prefetch=prefetch, waits=waits)
 
     # Threshold each metric and save flag object
-    uvf_total = filled_metrics[0].copy()
-    uvf_total.to_flag(run_check=run_check, check_extra=check_extra,
-                      run_check_acceptability=run_check_acceptability)
     for i, uvf_m in enumerate(filled_metrics):
-        uvf_f = threshold_wf(uvf_m, nsig_f=nsig_f, nsig_t=nsig_t,
-                             nsig_f_adj=nsig_f_adj, nsig_t_adj=nsig_t_adj,
-                             detrend=False, run_check=run_check,
-                             check_extra=check_extra,
-                             run_check_acceptability=run_check_acceptability)
-        outfile = '.'.join([basename, types[i] + '_threshold_flags.h5'])
-        outpath = os.path.join(outdir, outfile)
-        uvf_f.write(outpath, clobber=clobber)
-        uvf_total |= uvf_f
+        start = time.perf_counter()
+        with context.stage(types[i]):
+            if i == 0:
+                uvf_total = uvf_m.copy()
+                uvf_total.to_flag(**checks)
+                uvf_total = FlagExpression(uvf_total)
+            uvf_f = threshold_wf(uvf_m, nsig_f=nsig_f, nsig_t=nsig_t,
+                                 nsig_f_adj=nsig_f_adj, nsig_t_adj=nsig_t_adj,
+                                 detrend=False, n_threads=n_threads, **checks)
+            outfile = '.'.join([basename, types[i] + '_threshold_flags.h5'])
+            outpath = os.path.join(outdir, outfile)
+            context.check_output(uvf_f)
+            uvf_f.write(outpath, clobber=clobber)
+            uvf_total |= uvf_f
+        timings[types[i]] = (time.perf_counter() - start, waits[i])
 
     # Read non thresholded flags and combine
-    files = [glob.glob(d + '/*.flags2.h5')[0] for d in xrfi_dirs]
-    uvf_total |= UVFlag(files)
+    if container:
+        files, product = containers, 'flags2'
+    else:
+        files, product = [glob.glob(d + '/*.flags2.h5')[0] for d in xrfi_dirs], None
+    uvf_total |= read_flags(files, product=product, **io_checks)
+    uvf_total = uvf_total.evaluate(**checks)
 
-    # Apply to abs calfits
-    uvc_a = UVCal()
+    # Apply to abs calfits, reading the next while flagging the current one
     incal_ext = 'abs'
     outcal_ext = 'flagged_abs'
-    for dfile in data_files:
-        basename = qm_utils.strip_extension(dfile)
-        abs_in = '.'.join([basename, incal_ext, 'calfits'])
-        abs_out = '.'.join([basename, outcal_ext, 'calfits'])
-        uvc_a.read_calfits(abs_in)
-
-        # select the times from the file we are going to flag
-        uvf_file = uvf_total.select(times=uvc_a.time_array, inplace=False)
-
-        flag_apply(uvf_file, uvc_a, force_pol=True, history=history,
-                   run_check=run_check, check_extra=check_extra,
-                   run_check_acceptability=run_check_acceptability)
-        uvc_a.write_calfits(abs_out, clobber=clobber)
+    basenames = [qm_utils.strip_extension(dfile) for dfile in data_files]
+    abs_files = [('.'.join([basename, incal_ext, 'calfits']),) for basename in basenames]
+    waits = []
+    for i, uvc_a in enumerate(_prefetch(partial(_read_calfits, **io_checks), abs_files,
+                                        prefetch=prefetch, waits=waits)):
+        start = time.perf_counter()
+        abs_out = '.'.join([basenames[i], outcal_ext, 'calfits'])
+        with context.stage(os.path.basename(abs_out)):
+            # select the times from the file we are going to flag
+            uvf_file = uvf_total.select(times=uvc_a.time_array, inplace=False)
+
+            flag_apply(uvf_file, uvc_a, force_pol=True, history=history, context=context)
+            uvc_a.write_calfits(abs_out, clobber=clobber)
+        timings[os.path.basename(abs_out)] = (time.perf_counter() - start, waits[i])
+    if verbose:
+        _print_timings(timings)
 
 
 def xrfi_h1c_run(indata, history, infile_format='miriad', extension='flags.h5',
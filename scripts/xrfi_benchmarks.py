@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 the HERA Project
+# Licensed under the MIT License
+"""Timing benchmarks for the xrfi algorithms.
+
+Run as a script to execute all benchmarks, or pass the names of individual
+benchmarks (e.g. "python xrfi_benchmarks.py detrend_medfilt").
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+import numpy as np
+import hera_qm.xrfi as xrfi
+from hera_qm.data import DATA_PATH
+from pyuvdata import UVData
+from pyuvdata import UVCal
+from pyuvdata import UVFlag
+from hera_qm.tests import real_noise
+
+
+def timeit(func, *args, **kwargs):
+    """Return the output of func and the wall time it took in seconds."""
+    t0 = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - t0
+
+
+def peak_memory(func, *args, **kwargs):
+    """Return the peak memory in MB allocated while running func."""
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2.**20
+
+
+def bench_detrend_medfilt(shape=(120, 1024), kernels=(8, 16, 32)):
+    """Compare the scipy and running median backends of detrend_medfilt."""
+    print('detrend_medfilt on a {0} x {1} waterfall'.format(*shape))
+    data = np.abs(real_noise(shape)) + np.linspace(1, 10, shape[1])
+    for K in kernels:
+        out_s, t_s = timeit(xrfi.detrend_medfilt, data, Kt=K, Kf=K, backend='scipy')
+        out_r, t_r = timeit(xrfi.detrend_medfilt, data, Kt=K, Kf=K, backend='running')
+        print('\tKt = Kf = {0:3d}: scipy {1:7.3f} s, running {2:7.3f} s, '
+              'speedup {3:5.2f}, identical: {4}'.format(K, t_s, t_r, t_s / t_r,
+                                                        np.array_equal(out_s, out_r)))
+
+
+def bench_detrend_medminfilt(shape=(120, 1024), kernels=(8, 16)):
+    """Time detrend_medminfilt against the other detrenders."""
+    print('detrend_medminfilt on a {0} x {1} waterfall'.format(*shape))
+    data = np.abs(real_noise(shape)) + np.linspace(1, 10, shape[1])
+    for K in kernels:
+        times = []
+        for alg in ['detrend_medminfilt', 'detrend_medfilt', 'detrend_meanfilt']:
+            _, t = timeit(xrfi.algorithm_dict[alg], data, Kt=K, Kf=K)
+            times.append(t)
+        print('\tKt = Kf = {0:3d}: medminfilt {1:7.3f} s, medfilt {2:7.3f} s, '
+              'meanfilt {3:7.3f} s'.format(K, *times))
+
+
+def bench_detrend_meanfilt(shape=(120, 1024), kernels=(8, 16, 32)):
+    """Compare the astropy and summed-area-table backends of detrend_meanfilt."""
+    print('detrend_meanfilt on a {0} x {1} waterfall'.format(*shape))
+    data = np.abs(real_noise(shape)) + np.linspace(1, 10, shape[1])
+    flags = np.zeros(shape, dtype=bool)
+    flags[:, ::50] = True
+    for K in kernels:
+        out_a, t_a = timeit(xrfi.detrend_meanfilt, data, flags=flags, Kt=K, Kf=K,
+                            backend='astropy')
+        out_s, t_s = timeit(xrfi.detrend_meanfilt, data, flags=flags, Kt=K, Kf=K,
+                            backend='sat')
+        print('\tKt = Kf = {0:3d}: astropy {1:7.3f} s, sat {2:7.3f} s, '
+              'speedup {3:5.2f}, max difference: {4:.2e}'.format(K, t_a, t_s, t_a / t_s,
+                                                                 np.nanmax(np.abs(out_a - out_s))))
+
+
+def bench_complex_detrend(shape=(120, 1024), K=8):
+    """Time and peak memory of the median detrenders for real and complex data."""
+    print('complex detrending on a {0} x {1} waterfall'.format(*shape))
+    data = real_noise(shape) + 1j * real_noise(shape)
+    for name, func, kwargs in [('detrend_medfilt', xrfi.detrend_medfilt, {'Kt': K, 'Kf': K}),
+                               ('modzscore_1d', xrfi.modzscore_1d, {'kern': K})]:
+        for label, d in [('real', data.real.copy()), ('complex', data)]:
+            _, t = timeit(func, d, **kwargs)
+            mem = peak_memory(func, d, **kwargs)
+            print('\t{0:16s} {1:8s}: {2:7.3f} s, peak memory {3:7.1f} MB'.format(
+                name, label, t, mem))
+
+
+def bench_xrfi_run_single_pass(kt_size=3):
+    """Compare the single masked median pass of xrfi_run with the two round pipeline."""
+    print('xrfi_run on the test data files')
+    cal_file = os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvcAA.omni.calfits')
+    vis_file = os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvh5')
+    obs = 'zen.2457698.40355.HH'
+    flags = {}
+    for single_pass in [False, True]:
+        tmp_path = tempfile.mkdtemp()
+        files = []
+        for ext, infile in [('.omni.calfits', cal_file), ('.abs.calfits', cal_file),
+                            ('.omni_vis.uvh5', vis_file), ('.uvh5', vis_file)]:
+            files.append(os.path.join(tmp_path, obs + ext))
+            shutil.copyfile(infile, files[-1])
+        _, t = timeit(xrfi.xrfi_run, *files, 'benchmark', kt_size=kt_size,
+                      single_pass=single_pass)
+        outfile = os.path.join(tmp_path, 'zen.2457698.40355.xrfi', obs + '.flags2.h5')
+        flags[single_pass] = UVFlag(outfile).flag_array
+        shutil.rmtree(tmp_path)
+        print('\tsingle_pass = {0!s:5s}: {1:7.3f} s, flagged fraction {2:.4f}'.format(
+            single_pass, t, flags[single_pass].mean()))
+    print('\tflag agreement {0:.4f}, flags in common / flags in either {1:.4f}'.format(
+        np.mean(flags[True] == flags[False]),
+        np.sum(flags[True] & flags[False]) / max(np.sum(flags[True] | flags[False]), 1)))
+
+
+def bench_detrend_n_threads(shape=(1000, 1024), K=8, n_threads=(1, 2, 4, 8)):
+    """Time the tiled, threaded detrending of a large waterfall."""
+    print('threaded detrending on a {0} x {1} waterfall'.format(*shape))
+    data = np.abs(real_noise(shape)) + np.linspace(1, 10, shape[1])
+    for name in ['detrend_medfilt', 'detrend_meanfilt']:
+        serial, t_serial = timeit(xrfi.algorithm_dict[name], data, Kt=K, Kf=K)
+        for n in n_threads:
+            out, t = timeit(xrfi.algorithm_dict[name], data, Kt=K, Kf=K, n_threads=n)
+            print('\t{0:16s} n_threads = {1:2d}: {2:7.3f} s, speedup {3:5.2f}, '
+                  'identical: {4}'.format(name, n, t, t_serial / t,
+                                          np.array_equal(out, serial, equal_nan=True)))
+
+
+def bench_workspace(shape=(60, 1024), nbls=50, K=8):
+    """Count the array allocations saved by reusing a Workspace across baselines."""
+    print('detrending {0} waterfalls of {1} x {2}'.format(nbls, *shape))
+    data = np.abs(real_noise((nbls,) + shape)) + np.linspace(1, 10, shape[1])
+    for name in ['detrend_medfilt', 'detrend_meanfilt']:
+        alg_func = xrfi.algorithm_dict[name]
+
+        def _run(workspace=None):
+            out = None if workspace is None else np.empty(shape)
+            for d in data:
+                alg_func(d, Kt=K, Kf=K, workspace=workspace, out=out)
+
+        _, t = timeit(_run)
+        ws = xrfi.Workspace()
+        _, t_ws = timeit(_run, ws)
+        print('\t{0:16s}: {1:7.3f} s without workspace, {2:7.3f} s with, speedup {3:5.2f}; '
+              '{4:d} buffers requested, {5:d} allocated'.format(
+                  name, t, t_ws, t / t_ws, ws.n_requests, ws.n_allocations))
+
+
+def _ws_flag_waterfall_iterative(metric, fin, nsig=2.):
+    """Grow the flags one neighbor at a time, as the watershed used to."""
+    from scipy.signal import convolve
+    kernel = {1: [1, 0, 1], 2: [[0, 1, 0], [1, 0, 1], [0, 1, 0]]}[metric.ndim]
+    fout = fin.copy()
+    while True:
+        nflags = np.sum(fout)
+        fout |= convolve(fout, kernel, mode='same').astype(bool) & (metric >= nsig)
+        if np.sum(fout) == nflags:
+            break
+    return fout
+
+
+def bench_watershed(shapes=((60, 1024), (500, 1536), (2000, 1536))):
+    """Compare the single-pass watershed with iterating neighbor convolutions on dense RFI."""
+    print('watershed on waterfalls with dense RFI')
+    for shape in shapes:
+        # broad satellite-like bands above nsig_adj, seeded by a few strong pixels
+        metric = real_noise(shape)
+        for f0 in range(0, shape[1], shape[1] // 8):
+            metric[:, f0:f0 + shape[1] // 16] += 3
+        fin = metric >= 6
+        fin[::shape[0] // 4, ::shape[1] // 8] = True
+        out, t = timeit(xrfi._ws_flag_waterfall, metric, fin)
+        ans, t_iter = timeit(_ws_flag_waterfall_iterative, metric, fin)
+        print('\t{0:5d} x {1:5d}: iterative {2:8.3f} s, single pass {3:7.3f} s, '
+              'speedup {4:7.1f}, identical: {5}'.format(shape[0], shape[1], t_iter, t,
+                                                      t_iter / t, np.array_equal(out, ans)))
+
+
+def _flag_apply_to_baseline(uvfs, uv):
+    """Apply waterfall flags by broadcasting each one to baselines, as flag_apply used to."""
+    net_flags = UVFlag(uv, mode='flag', copy_flags=True)
+    for uvf in uvfs:
+        uvf = uvf.copy()
+        uvf.to_baseline(uv, force_pol=True)
+        net_flags |= uvf
+    uv.flag_array += net_flags.flag_array
+
+
+def bench_flag_apply(nwaterfalls=5):
+    """Peak memory of applying several waterfall flags to the test visibilities."""
+    uv = UVData()
+    uv.read(os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvcAA'))
+    print('applying {0} waterfalls to {1} baselines'.format(nwaterfalls, uv.Nbls))
+    uvfs = []
+    for i in range(nwaterfalls):
+        uvfs.append(UVFlag(uv, mode='flag', waterfall=True))
+        uvfs[-1].flag_array = real_noise(uvfs[-1].flag_array.shape) > 2
+    for label, func in [('broadcast each', _flag_apply_to_baseline),
+                        ('broadcast once', lambda u, v: xrfi.flag_apply(u, v, force_pol=True))]:
+        uv_i = uv.copy()
+        _, t = timeit(func, uvfs, uv_i)
+        mem = peak_memory(func, uvfs, uv.copy())
+        print('\t{0:14s}: {1:7.3f} s, peak memory {2:7.1f} MB, flagged fraction {3:.4f}'.format(
+            label, t, mem, uv_i.flag_array.mean()))
+
+
+def bench_threshold_wf(shape=(10000, 1024), n_threads=(1, 4)):
+    """Compare np.nanmedian with the nan-aware medians threshold_wf collapses with."""
+    print('threshold_wf medians of a {0} x {1} waterfall'.format(*shape))
+    flagged_channels = real_noise(shape)
+    flagged_channels[:, 100:120] = np.nan
+    # a different fraction of each row (and so of each column) flagged
+    varying = real_noise(shape)
+    varying[np.random.rand(*shape) < np.random.rand(shape[0], 1) / 2] = np.nan
+
+    def _np_medians(data):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmedian(data, axis=1), np.nanmedian(data, axis=0)
+
+    def _nan_medians(data, n):
+        return xrfi._nanmedian(data, n_threads=n), xrfi._nanmedian(data.T, n_threads=n)
+
+    for label, data in [('flagged channels', flagged_channels), ('varying masks', varying)]:
+        ans, t_np = timeit(_np_medians, data)
+        for n in n_threads:
+            out, t = timeit(_nan_medians, data, n)
+            identical = all(np.array_equal(a, o, equal_nan=True) for a, o in zip(ans, out))
+            print('\t{0:16s}, n_threads = {1:2d}: np.nanmedian {2:7.3f} s, nan-aware {3:7.3f} s, '
+                  'speedup {4:6.2f}, identical: {5}'.format(label, n, t_np, t, t_np / t,
+                                                            identical))
+
+
+def bench_collapse_marginals(shape=(8000, 1, 1024, 2), ntimes=40):
+    """Compare separate channel and time collapses with the fused single pass."""
+    from pyuvdata import utils as uvutils
+    print('channel and time quadmean collapses of a {0} metric array'.format(shape))
+    metric = real_noise(shape)
+    weights = np.ones(shape)
+    t_inv = np.arange(shape[0]) % ntimes
+
+    def _separate():
+        fdata = uvutils.collapse(metric, 'quadmean', axis=(0, 1, 3), weights=weights)
+        tdata = [uvutils.collapse(metric[t_inv == t], 'quadmean', weights=weights[t_inv == t])
+                 for t in range(ntimes)]
+        return fdata, np.array(tdata)
+
+    def _fused():
+        return xrfi._collapse_marginals(metric, 'quadmean', 2, time_inv=t_inv, ntimes=ntimes,
+                                        weights=weights)[:2]
+
+    for label, func in [('separate', _separate), ('fused', _fused)]:
+        out, t = timeit(func)
+        mem = peak_memory(func)
+        print('\t{0:8s}: {1:7.3f} s, peak memory {2:7.1f} MB'.format(label, t, mem))
+
+
+def _xrfi_pipe_whole(filename, uvf_flags, **kwargs):
+    """Read a whole visibility file, apply flags and run xrfi_pipe on it."""
+    uv = UVData()
+    uv.read(filename)
+    xrfi.flag_apply(uvf_flags, uv, force_pol=True)
+    return xrfi.xrfi_pipe(uv, **kwargs)
+
+
+def bench_xrfi_pipe_chunked(chunk_sizes=(10, 50)):
+    """Peak memory of the data metric of xrfi_run, reading the file whole or in chunks."""
+    vis_file = os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvh5')
+    uv = UVData()
+    uv.read(vis_file)
+    print('data metric of {0} baselines'.format(uv.Nbls))
+    uvf_flags = UVFlag(uv, mode='flag', waterfall=True)
+    kwargs = dict(alg='detrend_meanfilt', Kt=3)
+    del uv
+    runs = [('whole file', lambda: _xrfi_pipe_whole(vis_file, uvf_flags, **kwargs))]
+    for chunk_size in chunk_sizes:
+        runs.append(('chunks of {}'.format(chunk_size),
+                     lambda n=chunk_size: xrfi.xrfi_pipe_chunked(vis_file, uvf_flags=uvf_flags,
+                                                                 chunk_size=n, **kwargs)))
+    for label, func in runs:
+        (uvf_m, uvf_f), t = timeit(func)
+        mem = peak_memory(func)
+        print('\t{0:14s}: {1:7.3f} s, peak memory {2:7.1f} MB, flagged fraction {3:.4f}'.format(
+            label, t, mem, uvf_f.flag_array.mean()))
+
+
+def bench_flags_container(nproducts=33, ntimes=60):
+    """Time to write and read back xrfi_run-like products as separate files or one container."""
+    uv = UVData()
+    uv.read(os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvcAA'))
+    uvf = UVFlag(uv, mode='flag', waterfall=True)
+    uvm = UVFlag(uv, mode='metric', waterfall=True)
+    uvm.metric_array = real_noise(uvm.metric_array.shape)
+    print('{0} products of shape {1}'.format(nproducts, uvf.flag_array.shape))
+    uvf_dict = {'product{}.h5'.format(i): uvf if i % 2 else uvm for i in range(nproducts)}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        def write_files():
+            xrfi._write_uvf_dict(uvf_dict, 'zen.h5', tmpdir, clobber=True)
+
+        def read_files():
+            return [xrfi.read_flags(os.path.join(tmpdir, 'zen.' + ext), run_check=False)
+                    for ext in uvf_dict]
+
+        def write_container():
+            xrfi._write_uvf_dict(uvf_dict, 'zen.h5', tmpdir, clobber=True, container=True)
+
+        def read_container():
+            container = os.path.join(tmpdir, 'zen.xrfi.h5')
+            return [xrfi.read_flags(container, product=os.path.splitext(ext)[0],
+                                    run_check=False) for ext in uvf_dict]
+
+        for label, write, read in [('separate files', write_files, read_files),
+                                   ('container', write_container, read_container)]:
+            _, t_write = timeit(write)
+            _, t_read = timeit(read)
+            size = sum(os.path.getsize(os.path.join(tmpdir, f)) for f in os.listdir(tmpdir)
+                       if (f == 'zen.xrfi.h5') == (label == 'container'))
+            print('\t{0:14s}: write {1:7.3f} s, read {2:7.3f} s, {3:7.1f} kB'.format(
+                label, t_write, t_read, size / 1024.))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_validate(nrepeat=5):
+    """Time xrfi_pipe on the omnical gains under each validation policy, and when profiled."""
+    uvc = UVCal()
+    uvc.read_calfits(os.path.join(DATA_PATH, 'zen.2457698.40355.xx.HH.uvcAA.omni.calfits'))
+    print('xrfi_pipe on omnical gains of shape {}'.format(uvc.gain_array.shape))
+
+    def run(context):
+        for _ in range(nrepeat):
+            xrfi.xrfi_pipe(uvc, alg='detrend_medfilt', Kt=8, Kf=8, context=context)
+
+    # the first run includes one-off setup, e.g. of the astropy time tables
+    xrfi.xrfi_pipe(uvc, alg='detrend_medfilt', Kt=8, Kf=8)
+    for validate in ['all', 'io', 'none']:
+        _, t = timeit(run, xrfi.PipelineContext(validate=validate))
+        print('	validate = {0:4s}: {1:7.3f} s'.format(validate, t / nrepeat))
+    context = xrfi.PipelineContext(validate='none', profile=True)
+    _, t = timeit(run, context)
+    print('	profiled      : {0:7.3f} s'.format(t / nrepeat))
+    context.print_stats()
+
+
+benchmarks = {'detrend_medfilt': bench_detrend_medfilt,
+              'detrend_medminfilt': bench_detrend_medminfilt,
+              'detrend_meanfilt': bench_detrend_meanfilt,
+              'complex_detrend': bench_complex_detrend,
+              'xrfi_run_single_pass': bench_xrfi_run_single_pass,
+              'detrend_n_threads': bench_detrend_n_threads,
+              'workspace': bench_workspace,
+              'watershed': bench_watershed,
+              'flag_apply': bench_flag_apply,
+              'threshold_wf': bench_threshold_wf,
+              'collapse_marginals': bench_collapse_marginals,
+              'xrfi_pipe_chunked': bench_xrfi_pipe_chunked,
+              'flags_container': bench_flags_container,
+              'validate': bench_validate}
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore')
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
@@ -10,9 +10,15 @@ from hera_qm import xrfi
 ap = utils.get_metrics_ArgumentParser('day_threshold_run')
 args = ap.parse_args()
 history = ' '.join(sys.argv)
+context = xrfi.PipelineContext(validate=args.validate, profile=args.profile)
 
 if args.run_if_first is None or sorted(args.data_files)[0] == args.run_if_first:
     xrfi.day_threshold_run(args.data_files, history, nsig_f=args.nsig_f, nsig_t=args.nsig_t,
-                           nsig_f_adj=args.nsig_f_adj, nsig_t_adj=args.nsig_t_adj, clobber=args.clobber)
+                           nsig_f_adj=args.nsig_f_adj, nsig_t_adj=args.nsig_t_adj, clobber=args.clobber,
+                           n_threads=args.n_threads, prefetch=args.prefetch,
+                           verbose=args.verbose, container=args.container,
+                           context=context)
+    if args.profile:
+        context.print_stats()
 else:
     print(sorted(args.data_files)[0], 'is not', args.run_if_first, '...skipping.')
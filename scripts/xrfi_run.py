@@ -10,9 +10,17 @@ from hera_qm import xrfi
 ap = utils.get_metrics_ArgumentParser('xrfi_run')
 args = ap.parse_args()
 history = ' '.join(sys.argv)
+context = xrfi.PipelineContext(validate=args.validate, profile=args.profile)
 
 xrfi.xrfi_run(args.ocalfits_file, args.acalfits_file, args.model_file, args.data_file,
               history, xrfi_path=args.xrfi_path,
               kt_size=args.kt_size, kf_size=args.kf_size, sig_init=args.sig_init,
               sig_adj=args.sig_adj, ex_ants=args.ex_ants, ant_str=args.ant_str,
-              metrics_file=args.metrics_file, clobber=args.clobber)
+              metrics_file=args.metrics_file, clobber=args.clobber,
+              single_pass=args.single_pass, n_threads=args.n_threads,
+              packed_flags=args.packed_flags, n_workers=args.n_workers,
+              executor=args.executor, prefetch=args.prefetch, verbose=args.verbose,
+              data_chunk_size=args.data_chunk_size, container=args.container,
+              context=context)
+if args.profile:
+    context.print_stats()